@@ -31,7 +31,7 @@ class msgcolor:
 
 INSTALL_PREFIX = "/opt"
 INSTALL_DIR = "scratch4acmeboards"
-files = ["scratch4acmeboards_handler.py", "s4ah_GPIOController.py"]
+files = ["scratch4acmeboards_handler.py", "s4ah_GPIOController.py", "s4ah_EdgeMonitor.py", "s4ah_GPIOChip.py", "s4ah_SensorQueue.py", "s4ah_Dispatcher.py", "s4ah_EventLoop.py", "s4ah_Stats.py", "s4ah_Logging.py", "s4ah_ScratchCodec.py", "s4ah_Waveform.py", "s4ah_InputFilter.py", "s4ah_PollScheduler.py", "s4ah_VirtualGPIO.py", "s4ah_Capture.py", "s4ah_Backoff.py", "s4ah_Workers.py", "s4ah_NetInfo.py", "s4ah_ADC.py", "s4ah_PWM.py", "s4ah_I2C.py", "s4ah_GPIOWorker.py"]
 
 parser = OptionParser("usage: %prog [options]")
 parser.add_option('-p','--prefix',dest="installprefix",default=INSTALL_PREFIX,help='installation path. Default: /opt')
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+#s4ah_ADC - analog inputs of scratch4acmeboards read by IIO buffered capture
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# The ADC channels of the board (in_voltageN of the first IIO device that
+# has them) are the pins ADC0, ADC1 ... of the controller: configADC0in
+# starts the capture of the channel. The kernel fills a buffer at the rate
+# of a hrtimer trigger and a single read() of /dev/iio:deviceN returns many
+# scans (one sample of each enabled channel); average scans are averaged
+# in a value, sent to Scratch only when it moved at least deadband from
+# the last one sent.
+
+
+import os
+import re
+import stat
+import time
+import errno
+import struct
+import logging
+import s4ah_GPIOController as S4AH
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+IIO_DEVICES = '/sys/bus/iio/devices/'
+IIO_DEV = '/dev/'
+# for developers only: fake device written by createOfflineDevice, its
+# character device is a FIFO the tests write the scans to
+OFFLINE_IIO_DEVICES = '/tmp/iio/sys/bus/iio/devices/'
+OFFLINE_IIO_DEV = '/tmp/iio/dev/'
+HRTIMER_TRIGGERS = '/sys/kernel/config/iio/triggers/hrtimer/'
+TRIGGER_NAME = 's4ah'
+
+DEFAULT_RATE = 100        # scans per second
+DEFAULT_AVERAGE = 10      # scans averaged in each value
+DEFAULT_DEADBAND = 4      # least change (raw units) sent to Scratch
+BUFFER_SECONDS = 2        # scans the kernel buffer holds, in seconds
+READ_SIZE = 65536
+
+CHANNEL_RE = re.compile(r'in_voltage(\d+)_en$')
+TYPE_RE = re.compile(r'(?P<endian>[bl]e):(?P<sign>[su])(?P<bits>\d+)/(?P<storage>\d+)(?:X\d+)?>>(?P<shift>\d+)$')
+STORAGE_FORMATS = {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}
+
+
+class ADCError(Exception):
+    pass
+
+
+def readAttr(path):
+    with open(path) as fh:
+        return fh.read().strip()
+
+
+def writeAttr(path, value):
+    with open(path, 'w') as fh:
+        fh.write(str(value))
+
+
+class ScanChannel:
+    """
+    a channel in the scans: position, struct format and the decoding of
+    its type, e.g. le:u10/16>>0 (little endian, unsigned, 10 bits stored
+    in 16, no shift)
+    """
+    def __init__(self, number, index, typeSpec):
+        match = TYPE_RE.match(typeSpec)
+        if match is None or int(match.group('storage')) not in STORAGE_FORMATS:
+            raise ADCError("channel %d: unsupported type %s" % (number, typeSpec))
+        self.number = number
+        self.index = index
+        self.endian = '<' if match.group('endian') == 'le' else '>'
+        self.signed = match.group('sign') == 's'
+        self.bits = int(match.group('bits'))
+        self.storage = int(match.group('storage')) // 8
+        self.format = STORAGE_FORMATS[self.storage * 8]
+        self.shift = int(match.group('shift'))
+        self.mask = (1 << self.bits) - 1
+        # most ADCs store the samples as they are: no decoding needed
+        self.plain = not self.signed and self.shift == 0 and self.bits == self.storage * 8
+
+    def decode(self, samples):
+        if self.plain:
+            return samples
+        values = [(sample >> self.shift) & self.mask for sample in samples]
+        if self.signed:
+            sign = 1 << (self.bits - 1)
+            values = [value - (sign << 1) if value & sign else value for value in values]
+        return values
+
+
+class ScanLayout:
+    """
+    struct format of a scan of the enabled channels: in index order, each
+    aligned to its size, the scan aligned to the largest one
+    """
+    def __init__(self, channels):
+        self.channels = sorted(channels, key=lambda channel: channel.index)
+        self.endian = self.channels[0].endian
+        if [channel for channel in self.channels if channel.endian != self.endian]:
+            raise ADCError("channels of mixed endianness")
+        fmt = ''
+        offset = 0
+        for channel in self.channels:
+            padding = -offset % channel.storage
+            fmt += 'x' * padding + channel.format
+            offset += padding + channel.storage
+        largest = max(channel.storage for channel in self.channels)
+        fmt += 'x' * (-offset % largest)
+        self.format = fmt
+        self.size = struct.calcsize('<' + fmt)
+
+    def unpack(self, data, scans):
+        """
+        the samples of scans scans, channel after channel of each scan
+        """
+        return struct.unpack_from(self.endian + self.format * scans, data)
+
+
+class IIODevice:
+    """
+    An IIO device with voltage channels: its sysfs directory and its
+    character device
+    """
+    def __init__(self, sysDir, devPath):
+        self.sysDir = sysDir
+        self.devPath = devPath
+        try:
+            self.name = readAttr(os.path.join(sysDir, 'name'))
+        except IOError:
+            self.name = os.path.basename(sysDir)
+        self.channels = sorted(int(match.group(1)) for match in
+                               [CHANNEL_RE.match(entry) for entry in os.listdir(self.scanPath(''))]
+                               if match)
+
+    def __repr__(self):
+        return "IIO device %s (%s), channels %s" % (self.name, self.devPath, self.channels)
+
+    def path(self, name):
+        return os.path.join(self.sysDir, name)
+
+    def scanPath(self, name):
+        return os.path.join(self.sysDir, 'scan_elements', name)
+
+    def scanChannel(self, number):
+        index = int(readAttr(self.scanPath('in_voltage%d_index' % number)))
+        return ScanChannel(number, index, readAttr(self.scanPath('in_voltage%d_type' % number)))
+
+    def setTrigger(self, rate):
+        """
+        the device is driven by its current trigger if set by the system,
+        otherwise by a hrtimer trigger created at rate scans per second
+        """
+        current = readAttr(self.path('trigger/current_trigger'))
+        if current and current != TRIGGER_NAME:
+            logger.debug("%s driven by trigger %s", self.name, current)
+            return
+        if not os.path.isdir(HRTIMER_TRIGGERS + TRIGGER_NAME):
+            try:
+                os.mkdir(HRTIMER_TRIGGERS + TRIGGER_NAME)
+            except OSError, e:
+                raise ADCError("no trigger for %s and no hrtimer trigger (%s)" % (self.name, e))
+        devices = os.path.dirname(self.sysDir.rstrip('/'))
+        for entry in os.listdir(devices):
+            if not entry.startswith('trigger'):
+                continue
+            try:
+                if readAttr(os.path.join(devices, entry, 'name')) != TRIGGER_NAME:
+                    continue
+                writeAttr(os.path.join(devices, entry, 'sampling_frequency'), rate)
+            except IOError:
+                continue
+            writeAttr(self.path('trigger/current_trigger'), TRIGGER_NAME)
+            logger.debug("%s driven by trigger %s at %s Hz", self.name, TRIGGER_NAME, rate)
+            return
+        raise ADCError("hrtimer trigger %s not found" % TRIGGER_NAME)
+
+    def start(self, numbers, rate, watermark):
+        """
+        capture the channels numbers: return the ScanLayout of the scans
+        """
+        self.stop()
+        for number in self.channels:
+            writeAttr(self.scanPath('in_voltage%d_en' % number), 1 if number in numbers else 0)
+        if os.path.exists(self.scanPath('in_timestamp_en')):
+            writeAttr(self.scanPath('in_timestamp_en'), 0)
+        layout = ScanLayout([self.scanChannel(number) for number in numbers])
+        writeAttr(self.path('buffer/length'), max(int(rate * BUFFER_SECONDS), watermark * 2))
+        if os.path.exists(self.path('buffer/watermark')):
+            writeAttr(self.path('buffer/watermark'), watermark)
+        self.setTrigger(rate)
+        writeAttr(self.path('buffer/enable'), 1)
+        return layout
+
+    def stop(self):
+        writeAttr(self.path('buffer/enable'), 0)
+
+    def open(self):
+        """
+        non blocking fd of the character device. The FIFO of the offline
+        device is opened also for writing: no hangup when a test writer closes
+        """
+        flags = os.O_RDONLY
+        if stat.S_ISFIFO(os.stat(self.devPath).st_mode):
+            flags = os.O_RDWR
+        return os.open(self.devPath, flags | os.O_NONBLOCK)
+
+
+def findDevice(devicesDir=IIO_DEVICES, devDir=IIO_DEV):
+    """
+    the first IIO device with voltage channels in scan_elements, None if
+    the board has none
+    """
+    try:
+        entries = sorted(os.listdir(devicesDir))
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.startswith('iio:device'):
+            continue
+        sysDir = os.path.join(devicesDir, entry)
+        try:
+            device = IIODevice(sysDir, os.path.join(devDir, entry))
+        except (IOError, OSError):
+            continue
+        if device.channels:
+            return device
+    return None
+
+
+def createOfflineDevice(devicesDir=OFFLINE_IIO_DEVICES, devDir=OFFLINE_IIO_DEV, channels=4, bits=10):
+    """
+    for developers only: the sysfs files of a fake ADC and a FIFO standing
+    for its character device. The timestamp channel is there to be disabled
+    """
+    sysDir = os.path.join(devicesDir, 'iio:device0')
+    if os.path.exists(os.path.join(sysDir, 'name')):
+        return
+    for name in ('scan_elements', 'buffer', 'trigger'):
+        os.makedirs(os.path.join(sysDir, name))
+    if not os.path.isdir(devDir):
+        os.makedirs(devDir)
+    files = {'name': 'fake-adc', 'buffer/enable': 0, 'buffer/length': 0, 'buffer/watermark': 1,
+             'trigger/current_trigger': 'fake-trigger',
+             'scan_elements/in_timestamp_en': 1, 'scan_elements/in_timestamp_index': channels,
+             'scan_elements/in_timestamp_type': 'le:s64/64>>0'}
+    for n in xrange(channels):
+        files['in_voltage%d_raw' % n] = 0
+        files['scan_elements/in_voltage%d_en' % n] = 0
+        files['scan_elements/in_voltage%d_index' % n] = n
+        files['scan_elements/in_voltage%d_type' % n] = 'le:u%d/16>>0' % bits
+    for (name, value) in files.items():
+        writeAttr(os.path.join(sysDir, name), value)
+    os.mkfifo(os.path.join(devDir, 'iio:device0'))
+
+
+class ADCMonitor:
+    """
+    The analog inputs: the channels of device become the pins ADC0, ADC1 ...
+    of the controller, captured while they are INPUT. read() takes all the
+    scans the kernel has buffered without blocking and returns the changes
+    (PinData, value) of the averaged values beyond the deadband: the event
+    loop calls it when fileno() is readable (once every average scans with
+    the buffer watermark), the sender thread at nextDeadline()
+    """
+    def __init__(self, controller, device, rate=DEFAULT_RATE, average=DEFAULT_AVERAGE,
+                 deadband=DEFAULT_DEADBAND):
+        self.controller = controller
+        self.device = device
+        self.rate = rate
+        self.average = max(average, 1)
+        self.deadband = deadband
+        self.deadbands = {}     # pin name -> deadband set by Scratch
+        self.sent = {}          # pin name -> last value sent
+        self.pins = controller.addAnalogPins([('ADC%d' % number, number) for number in device.channels])
+        self.layout = None
+        self.active = []        # PinData of the layout channels
+        self.pending = b''      # bytes of a partial scan
+        self.sums = []
+        self.count = 0
+        self.nextRead = None
+        self.fd = device.open()
+        controller.analog = self
+        logger.debug("%s: analog pins %s", device, [pin.name for pin in self.pins])
+
+    def fileno(self):
+        return self.fd
+
+    def nextDeadline(self):
+        return self.nextRead
+
+    def setMode(self, pin, mode):
+        """
+        called by the controller after the mode of an analog pin changed
+        """
+        if mode != S4AH.PINPUT:
+            self.sent.pop(pin.name, None)
+            pin.value = S4AH.PNONE
+        self.restart()
+
+    def restart(self):
+        """
+        capture the channels of the INPUT analog pins: the averages start again
+        """
+        active = [pin for pin in self.pins if pin.mode == S4AH.PINPUT]
+        try:
+            if active:
+                self.layout = self.device.start([pin.kernelId for pin in active], self.rate, self.average)
+            else:
+                self.device.stop()
+                self.layout = None
+        except (IOError, OSError, ADCError), e:
+            logger.error("Unable to start the capture of %s: %s", self.device.name, e)
+            self.layout = None
+        if self.layout is None:
+            active = []
+        else:
+            # the pins in the order of their channels in the scans
+            byNumber = dict((pin.kernelId, pin) for pin in active)
+            active = [byNumber[channel.number] for channel in self.layout.channels]
+        self.drain()
+        self.active = active
+        self.pending = b''
+        self.sums = [0] * len(active)
+        self.count = 0
+        self.nextRead = time.time() + self.average / float(self.rate) if active else None
+
+    def drain(self):
+        """
+        the scans of the old layout
+        """
+        while True:
+            try:
+                if not os.read(self.fd, READ_SIZE):
+                    return
+            except OSError:
+                return
+
+    def setDeadband(self, pinName, deadband):
+        pin = self.controller.lookupPin(pinName)
+        if pin is None or pin not in self.pins:
+            logger.error("deadband: %s is not an analog pin", pinName)
+            return
+        self.deadbands[pin.name] = deadband
+        logger.debug("deadband of %s set to %d", pin.name, deadband)
+
+    def read(self, now=None):
+        """
+        consume the buffered scans: return the changes (PinData, value)
+        """
+        data = [self.pending]
+        while True:
+            try:
+                chunk = os.read(self.fd, READ_SIZE)
+            except OSError, e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logger.error("Unable to read %s: %s", self.device.devPath, e)
+                break
+            if not chunk:
+                break
+            data.append(chunk)
+        if self.layout is None:
+            self.pending = b''
+            return []
+        if self.nextRead is not None:
+            self.nextRead = (now or time.time()) + self.average / float(self.rate)
+        data = b''.join(data)
+        scans = len(data) // self.layout.size
+        self.pending = data[scans * self.layout.size:]
+        if not scans:
+            return []
+
+        samples = self.layout.unpack(data, scans)
+        width = len(self.active)
+        changes = []
+        pos = 0
+        while pos < scans:
+            take = min(self.average - self.count, scans - pos)
+            for (i, channel) in enumerate(self.layout.channels):
+                self.sums[i] += sum(channel.decode(samples[pos * width + i:(pos + take) * width:width]))
+            self.count += take
+            pos += take
+            if self.count == self.average:
+                changes += self.averaged()
+        return changes
+
+    def averaged(self):
+        changes = []
+        for (i, pin) in enumerate(self.active):
+            value = int(round(self.sums[i] / float(self.count)))
+            last = self.sent.get(pin.name)
+            if last is None or abs(value - last) >= self.deadbands.get(pin.name, self.deadband):
+                self.sent[pin.name] = value
+                pin.value = value
+                changes.append((pin, value))
+        self.sums = [0] * len(self.active)
+        self.count = 0
+        return changes
+
+    def close(self):
+        try:
+            self.device.stop()
+        except (IOError, OSError):
+            pass
+        os.close(self.fd)
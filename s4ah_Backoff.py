@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#s4ah_Backoff - delays between the connection attempts of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import time
+import random
+
+
+INITIAL_DELAY = 0.025    # seconds before the first attempt after a disconnection
+MAX_DELAY = 3.0          # longest delay between two attempts
+FACTOR = 2.0
+
+
+class Backoff:
+    """
+    Jittered exponential delays between the connection attempts to a peer:
+    each delay is drawn between half and all of the current step, which
+    doubles at each attempt up to maxDelay. The jitter spreads the attempts
+    of the handlers of a classroom restarted together.
+    The steps start again from initialDelay only after a connection lasted
+    maxDelay seconds: a peer accepting and dropping at once is not hammered
+    """
+    def __init__(self, initialDelay=INITIAL_DELAY, maxDelay=MAX_DELAY, factor=FACTOR):
+        self.initialDelay = min(initialDelay, maxDelay)
+        self.maxDelay = maxDelay
+        self.factor = factor
+        self.step = self.initialDelay
+        self.connectedAt = None
+        self.random = random.Random()
+
+    def connected(self):
+        self.connectedAt = time.time()
+
+    def next(self):
+        """
+        delay (seconds) before the next attempt
+        """
+        if self.connectedAt is not None:
+            if time.time() - self.connectedAt >= self.maxDelay:
+                self.step = self.initialDelay
+            self.connectedAt = None
+        delay = self.random.uniform(self.step / 2.0, self.step)
+        self.step = min(self.step * self.factor, self.maxDelay)
+        return delay
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#s4ah_Capture - record of the Scratch mesh frames of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# A capture file is MAGIC followed by the records:
+#   RECORD header: usecs since the start (monotonic clock), kind, peer, length
+#   payload of length bytes: the frame without its 4 bytes length or,
+#   for a PEER record, the host of the peer numbered peer
+# The frames received are INBOUND, the frames queued to a peer OUTBOUND.
+
+
+import atexit
+import struct
+import logging
+import threading
+import s4ah_Stats as S4AH_ST
+import s4ah_SensorQueue as S4AH_SQ
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+MAGIC = 'S4AHCAP\x01'
+RECORD = struct.Struct('>QBBI')
+INBOUND = 0
+OUTBOUND = 1
+PEER = 2
+MAX_PEERS = 256
+WRITE_BUFFER = 65536
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureWriter:
+    """
+    Append the frames to a capture file. The engines call record() from
+    their threads (listeners and writers): the writes are serialized by
+    a lock and buffered, close() flushes them
+    """
+    def __init__(self, path):
+        self.fh = open(path, 'wb', WRITE_BUFFER)
+        self.fh.write(MAGIC)
+        self.lock = threading.Lock()
+        self.peers = {}          # host -> peer number
+        self.start = S4AH_ST.monotonic()
+        self.records = 0
+
+    def write(self, kind, peer, payload):
+        now = int((S4AH_ST.monotonic() - self.start) * 1000000)
+        self.fh.write(RECORD.pack(now, kind, peer, len(payload)))
+        self.fh.write(payload)
+        self.records += 1
+
+    def peer(self, host):
+        peer = self.peers.get(host)
+        if peer is None:
+            peer = len(self.peers) % MAX_PEERS
+            self.peers[host] = peer
+            self.write(PEER, peer, str(host))
+        return peer
+
+    def record(self, kind, host, payload):
+        """
+        record the frame payload (without the length) exchanged with host
+        """
+        with self.lock:
+            if self.fh is None:
+                return
+            try:
+                self.write(kind, self.peer(host), payload)
+            except IOError, e:
+                logger.error("capture stopped: %s", e)
+                self.fh = None
+
+    def inbound(self, host, payload):
+        self.record(INBOUND, host, payload)
+
+    def outbound(self, host, payload):
+        self.record(OUTBOUND, host, payload)
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+        logger.debug("capture closed: %d records", self.records)
+
+
+def start(path):
+    """
+    capture the frames of all the peers to path: the file is closed at
+    exit also when the handler exits without its cleanup. The engines find
+    the writer in S4AH_SQ.capture
+    """
+    S4AH_SQ.capture = CaptureWriter(path)
+    atexit.register(stop)
+
+
+def stop():
+    capture = S4AH_SQ.capture
+    if capture is not None:
+        S4AH_SQ.capture = None
+        capture.close()
+
+
+def readCapture(path):
+    """
+    generator of the records of a capture file as (secs, kind, host,
+    payload). CaptureError on a file that is not a capture
+    """
+    hosts = {}
+    with open(path, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise CaptureError("%s is not a capture file" % path)
+        while True:
+            header = fh.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return          # the end (or a capture cut while writing)
+            (usecs, kind, peer, length) = RECORD.unpack(header)
+            payload = fh.read(length)
+            if len(payload) < length:
+                return
+            if kind == PEER:
+                hosts[peer] = payload
+                continue
+            yield (usecs / 1000000.0, kind, hosts.get(peer, str(peer)), payload)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#s4ah_Dispatcher - table driven dispatch of the Scratch messages for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import re
+import logging
+import s4ah_GPIOController as S4AH
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+DEFAULT_CACHE_SIZE = 512
+
+# Allowed broadcasts:
+# pinXXNNon, pinXXNNoff (e.g pinPA25on, pinPA8off): to set the single pin XXNN on or off
+# allon, alloff: to set all the pins on the board on or off
+# sghdebugon, sghdebugoff (or also sghdebug on, sghdebug off): to turn the debug on or off
+# gettime, getip, getversion, getqueuestats, getstats, dumplog, shutdown, stophandler
+# configXXNNin, configXXNNout, configXXNNnu (e.g configPA25in, configPA8out, configPA10nu):
+#                 to configure the pin XXNN in OUTPUT or INPUT mode or NOT USED
+# groupNAME=XXNN,XXNN,... (e.g groupseg1=PA0,PA1,PA2): to define the pin group NAME,
+#                 the first pin is the bit 0 of the group value
+# waveNAME PERIOD DUTY [REPEAT] (e.g wavePA23 500 50, wavePA23 20 5 100): square wave on the pin
+#                 or pin group NAME, period in msecs, duty in percent, REPEAT periods (default forever)
+# seqNAME STEP V1,V2,... [REPEAT] (e.g seqmotor 5 1,2,4,8): values written on the pin or pin
+#                 group NAME one after the other, each for STEP msecs, REPEAT times (default forever)
+# waveNAMEstop (or waveNAME stop): stop the waveform or the sequence on NAME
+# debounceXXNN MSECS, majorityXXNN N M, intervalXXNN MSECS (e.g debouncePA25 20, majorityPA25 3 5,
+#                 intervalall 100): filters of the INPUT pin XXNN (or all the pins), 0 disables them
+# configADCNin, configADCNnu (e.g configADC0in): to start or stop the capture of the analog pin ADCN
+# deadbandADCN UNITS (e.g deadbandADC0 8): least change of the analog pin ADCN sent to Scratch
+BROADCAST_RE = re.compile(r'''
+      pin(?P<pin>\w+?)(?P<pinvalue>on|off)$
+    | all.*?(?P<allvalue>on|off)$
+    | sghdebug.*?(?P<debugvalue>on|off)$
+    | config(?P<configpin>\w+?)(?P<configmode>in|out|nu)$
+    | group(?P<groupname>[A-Za-z_]\w*?)\s*[=:]\s*(?P<grouppins>\w+(?:[\s,]+\w+)*)\s*$
+    | wave(?P<wavestop>\w+?)\s*stop$
+    | wave(?P<wavetarget>\w+?)\s+(?P<period>\d+(?:\.\d+)?)\s+(?P<duty>\d+(?:\.\d+)?)(?:\s+(?P<waverepeat>\d+))?\s*$
+    | seq(?P<seqtarget>\w+?)\s+(?P<steptime>\d+(?:\.\d+)?)\s+(?P<seqvalues>\w+(?:\s*,\s*\w+)*)(?:\s+(?P<seqrepeat>\d+))?\s*$
+    | (?P<filter>debounce|majority|interval|deadband)(?P<filterpin>\w+?)\s+(?P<filterargs>\d+(?:\s+\d+)?)\s*$
+    | (?P<simple>gettime|getip|getversion|getqueuestats|getstats|dumplog|shutdown|stophandler)
+    ''', re.VERBOSE)
+
+# Allowed sensors: pinXXNN (e.g pinPA25, pinPA8) and the names of the pin groups
+# (e.g seg1 = 7 sets the first 3 pins of the group seg1 on and the others off)
+# pwmXXNN (e.g pwmPB11 = 50): duty cycle in percent of the hardware PWM of the pin
+# pwmperiodXXNN (e.g pwmperiodPB11 = 20000): period in usecs of the PWM of the pin
+SENSOR_RE = re.compile(r'pwm(?P<pwmperiod>period)?(?P<pwmpin>\w+)$|pin(?P<pin>\w+)$')
+
+BROADCAST_VALUES = {'on': 1, 'off': 0}
+CONFIG_MODES = {'in': S4AH.PINPUT, 'out': S4AH.POUTPUT, 'nu': S4AH.PUNUSED}
+
+
+class LRUCache:
+    """
+    Bounded cache approximating LRU with two generations of dicts: a hit
+    costs a single dict lookup, entries not used during the last
+    generation are dropped. Used only by the listener thread
+    """
+    def __init__(self, size):
+        self.generationSize = max(size // 2, 1)
+        self.young = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.young[key]
+        except KeyError:
+            if key not in self.old:
+                self.misses += 1
+                return default
+            value = self.old[key]
+            self.put(key, value)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(self.young) >= self.generationSize:
+            self.old = self.young
+            self.young = {}
+        self.young[key] = value
+
+
+class CommandDispatcher:
+    """
+    Map a broadcast or a sensor name to (handler, PinData or argument, value)
+    with a single compiled regular expression. The resolutions, also the
+    ones of unknown messages, are memoized by the raw message string:
+    Scratch projects send the same few strings over and over.
+    handlers is a dict with the callables for the keys: pin, sensor, all,
+    sghdebug, config, group, definegroup, wave, sequence, wavestop, filter,
+    pwm, pwmperiod and the names of the simple broadcasts.
+    The sensor resolutions are forgotten when the pin groups change
+    """
+    def __init__(self, controller, handlers, cacheSize=DEFAULT_CACHE_SIZE):
+        self.controller = controller
+        self.handlers = handlers
+        self.cacheSize = cacheSize
+        self.broadcasts = LRUCache(cacheSize)
+        self.sensors = LRUCache(cacheSize)
+        self.groupsVersion = controller.groupsVersion
+
+    def resolvePin(self, pinName):
+        """
+        the PinData of the pin, or its name if unknown: the controller reports the error
+        """
+        return self.controller.lookupPin(pinName) or pinName
+
+    def parseBroadcast(self, msg):
+        match = BROADCAST_RE.match(msg)
+        if match is None:
+            return None
+        groups = match.groupdict()
+        if groups['pin'] is not None:
+            return (self.handlers['pin'], self.resolvePin(groups['pin']),
+                    BROADCAST_VALUES[groups['pinvalue']])
+        if groups['allvalue'] is not None:
+            return (self.handlers['all'], None, BROADCAST_VALUES[groups['allvalue']])
+        if groups['debugvalue'] is not None:
+            return (self.handlers['sghdebug'], None, groups['debugvalue'])
+        if groups['configpin'] is not None:
+            pin = groups['configpin']
+            if pin != 'all':
+                pin = self.resolvePin(pin)
+            return (self.handlers['config'], pin, CONFIG_MODES[groups['configmode']])
+        if groups['groupname'] is not None:
+            return (self.handlers['definegroup'], groups['groupname'],
+                    re.split(r'[\s,]+', groups['grouppins']))
+        if groups['wavestop'] is not None:
+            return (self.handlers['wavestop'], groups['wavestop'], None)
+        if groups['wavetarget'] is not None:
+            return (self.handlers['wave'], groups['wavetarget'],
+                    (float(groups['period']), float(groups['duty']), int(groups['waverepeat'] or 0)))
+        if groups['seqtarget'] is not None:
+            return (self.handlers['sequence'], groups['seqtarget'],
+                    (float(groups['steptime']), re.split(r'\s*,\s*', groups['seqvalues']),
+                     int(groups['seqrepeat'] or 0)))
+        if groups['filter'] is not None:
+            pin = groups['filterpin']
+            if pin != 'all':
+                pin = self.resolvePin(pin)
+            return (self.handlers['filter'], pin,
+                    (groups['filter'], [int(arg) for arg in groups['filterargs'].split()]))
+        return (self.handlers[groups['simple']], None, None)
+
+    def parseSensor(self, name):
+        if name.lower() in self.controller.pinGroups:
+            return (self.handlers['group'], name, None)
+        match = SENSOR_RE.match(name)
+        if match is None:
+            return None
+        if match.group('pwmpin') is not None:
+            handler = self.handlers['pwmperiod' if match.group('pwmperiod') else 'pwm']
+            return (handler, self.resolvePin(match.group('pwmpin')), None)
+        return (self.handlers['sensor'], self.resolvePin(match.group('pin')), None)
+
+    def resolveBroadcast(self, msg):
+        """
+        return (handler, pin, value) of the broadcast or None if unknown
+        """
+        command = self.broadcasts.get(msg, False)
+        if command is False:
+            command = self.parseBroadcast(msg)
+            self.broadcasts.put(msg, command)
+        return command
+
+    def resolveSensor(self, name):
+        """
+        return (handler, pin, None) of the sensor or None if unknown
+        """
+        if self.groupsVersion != self.controller.groupsVersion:
+            self.groupsVersion = self.controller.groupsVersion
+            self.sensors = LRUCache(self.cacheSize)
+        command = self.sensors.get(name, False)
+        if command is False:
+            command = self.parseSensor(name)
+            self.sensors.put(name, command)
+        return command
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#s4ah_EdgeMonitor - interrupt driven detection of the INPUT pins changes for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import stat
+import errno
+import select
+import struct
+import logging
+import threading
+import s4ah_GPIOController as S4AH
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+# sysfs value files signal a change with POLLPRI|POLLERR
+EDGE_EVENTS = select.EPOLLPRI | select.EPOLLERR
+
+# offline edges: the inotify events of the value files closed after a write
+IN_CLOSE_WRITE = 0x00000008
+IN_NONBLOCK = os.O_NONBLOCK
+INOTIFY_EVENT = struct.Struct('=iIII')    # wd, mask, cookie, length of the name that follows
+
+
+class OfflineEdgePoller:
+    """
+    For developers only: the value files of the offline tree are regular
+    files, which epoll refuses. This stand-in of the epoll object takes
+    them and signals EPOLLPRI when one is written (e.g. echo 1 > value),
+    watching each of them by inotify. The other fds (the wakeup pipe) and
+    the inotify fd are in a real epoll, whose fileno() can be put in an
+    event loop as the epoll of the sysfs files
+    """
+    def __init__(self):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.getErrno = ctypes.get_errno
+        self.addWatch = libc.inotify_add_watch
+        self.rmWatch = libc.inotify_rm_watch
+        self.inotifyFd = libc.inotify_init1(IN_NONBLOCK)
+        if self.inotifyFd < 0:
+            raise OSError(self.getErrno(), "inotify_init1 failed")
+        self.epoll = select.epoll()
+        self.epoll.register(self.inotifyFd, select.EPOLLIN)
+        self.watches = {}       # watch descriptor -> fd
+        self.fdWatches = {}     # fd -> watch descriptor
+
+    def fileno(self):
+        return self.epoll.fileno()
+
+    def register(self, fd, events):
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            self.epoll.register(fd, events)
+            return
+        wd = self.addWatch(self.inotifyFd, os.readlink('/proc/self/fd/%d' % fd), IN_CLOSE_WRITE)
+        if wd < 0:
+            raise OSError(self.getErrno(), "inotify_add_watch failed")
+        self.watches[wd] = fd
+        self.fdWatches[fd] = wd
+
+    def unregister(self, fd):
+        wd = self.fdWatches.pop(fd, None)
+        if wd is None:
+            self.epoll.unregister(fd)
+            return
+        del self.watches[wd]
+        self.rmWatch(self.inotifyFd, wd)
+
+    def written(self):
+        """
+        the fds of the files written since the last call, once each
+        """
+        fds = set()
+        while True:
+            try:
+                data = os.read(self.inotifyFd, 4096)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return fds
+                raise
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size + length
+                if mask & IN_CLOSE_WRITE and wd in self.watches:
+                    fds.add(self.watches[wd])
+
+    def poll(self, timeout=-1):
+        events = []
+        for (fd, event) in self.epoll.poll(timeout):
+            if fd == self.inotifyFd:
+                events.extend((written, select.EPOLLPRI) for written in self.written())
+            else:
+                events.append((fd, event))
+        return events
+
+    def close(self):
+        self.epoll.close()
+        os.close(self.inotifyFd)
+
+
+def newPoller(offline):
+    """
+    the epoll of the value files: offline the OfflineEdgePoller, if the
+    system has inotify
+    """
+    if offline:
+        try:
+            return OfflineEdgePoller()
+        except (OSError, AttributeError), e:
+            logger.debug("no inotify for the offline edges (%s): the pins are polled", e)
+    return select.epoll()
+
+
+class EdgeMonitor:
+    """
+    Wait on the value files of all the INPUT pins at once using epoll
+    (offline the OfflineEdgePoller, or the poller passed). The pins whose
+    edge attribute can't be configured or whose value file can't be
+    registered are left in polledPins: the caller has to read them as before
+    """
+    def __init__(self, controller, poller=None):
+        self.controller = controller
+        self.epoll = poller if poller is not None else newPoller(controller.offline)
+        self.fdPins = {}       # fd -> pin name for the pins driven by edges
+        self.pinFds = {}       # pin name -> fd
+        self.polledPins = []   # INPUT pins without edge support
+        self.initial = []      # (pin name, value) of the pins just watched, returned by wait()
+        self.dirty = True      # the INPUT pins set has to be checked again
+        self.lock = threading.Lock()
+        # self-pipe used to wake up wait() on mode changes or on stop
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        self.epoll.register(self.wakeupRead, select.EPOLLIN)
+        controller.modeListeners.append(self.modeChanged)
+
+    def modeChanged(self):
+        """
+        called by the controller when a pin mode changes
+        """
+        self.dirty = True
+        self.wakeup()
+
+    def wakeup(self):
+        """
+        interrupt a blocking wait()
+        """
+        try:
+            os.write(self.wakeupWrite, 'x')
+        except OSError:
+            pass
+
+    def readValue(self, fd):
+        """
+        read the value file from its beginning: this also clears the pending event
+        """
+        return int(S4AH.readValueFd(fd).strip() or 0)
+
+    def unwatch(self, pinName):
+        if self.initial:
+            self.initial = [(name, value) for (name, value) in self.initial if name != pinName]
+        fd = self.pinFds.pop(pinName)
+        del self.fdPins[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError):
+            pass
+        os.close(fd)
+
+    def sync(self):
+        """
+        align the monitored pins with the INPUT pins of the controller
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+
+            # the INPUT pins, not the analog ones
+            inputs = [pin.name for pin in self.controller.inputPins]
+
+            for pinName in self.pinFds.keys():
+                if pinName not in inputs:
+                    self.unwatch(pinName)
+
+            self.polledPins = []
+            for pinName in inputs:
+                if pinName in self.pinFds:
+                    continue
+                if not self.controller.setPinEdge(pinName, S4AH.EDGE_BOTH):
+                    self.polledPins.append(pinName)
+                    continue
+                fd = None
+                try:
+                    fd = os.open(self.controller.pinPath(pinName) + "/value", os.O_RDONLY)
+                    self.epoll.register(fd, EDGE_EVENTS)
+                except (IOError, OSError), e:
+                    logger.debug("pin %s can't be monitored by epoll (%s): polling it", pinName, e)
+                    if fd is not None:
+                        os.close(fd)
+                    self.controller.clearPinEdge(pinName)
+                    self.polledPins.append(pinName)
+                    continue
+                # as the first poll of a pin, its value when it becomes INPUT
+                self.initial.append((pinName, self.readValue(fd)))
+                self.fdPins[fd] = pinName
+                self.pinFds[pinName] = fd
+                logger.debug("pin %s monitored by edge", pinName)
+
+    def wait(self, timeout):
+        """
+        wait for edges up to timeout seconds (-1 waits forever).
+        Return the list of (pin name, current value) of the pins signalled
+        and of the pins watched by the last sync()
+        """
+        (changes, self.initial) = (self.initial, [])
+        if changes:
+            timeout = 0
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            # EINTR
+            logger.debug("epoll interrupted: %s", e)
+            return changes
+        for fd, event in events:
+            if fd == self.wakeupRead:
+                os.read(self.wakeupRead, 512)
+                continue
+            pinName = self.fdPins.get(fd)
+            if pinName is None:
+                continue
+            try:
+                changes.append((pinName, self.readValue(fd)))
+            except (IOError, OSError, ValueError), e:
+                logger.error("Error reading pin %s: %s", pinName, e)
+        return changes
+
+    def close(self):
+        """
+        release all the file descriptors and the edge configurations
+        """
+        with self.lock:
+            for pinName in self.pinFds.keys():
+                self.unwatch(pinName)
+                self.controller.clearPinEdge(pinName)
+            self.polledPins = []
+            self.initial = []
+            self.dirty = True
+        if self.modeChanged in self.controller.modeListeners:
+            self.controller.modeListeners.remove(self.modeChanged)
+        self.epoll.close()
+        os.close(self.wakeupRead)
+        os.close(self.wakeupWrite)
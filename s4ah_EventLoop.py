@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+#s4ah_EventLoop - single threaded engine of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import time
+import errno
+import heapq
+import fcntl
+import select
+import signal
+import socket
+import logging
+import threading
+from collections import deque
+import s4ah_GPIOController as S4AH
+import s4ah_SensorQueue as S4AH_SQ
+import s4ah_Dispatcher as S4AH_DP
+import s4ah_Stats as S4AH_ST
+import s4ah_ScratchCodec as S4AH_SC
+import s4ah_InputFilter as S4AH_IF
+import s4ah_PollScheduler as S4AH_PS
+import s4ah_Backoff as S4AH_BO
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+
+class Timer:
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.active = True
+
+    def cancel(self):
+        self.active = False
+
+
+class LoopPeer:
+    """
+    A Scratch mesh host served by the event loop: its socket, its receive
+    buffer and its backlog of frames (shared with the other peers). When the
+    backlog exceeds maxBacklog bytes it is replaced by a snapshot of the
+    latest values (resync), so a slow peer never holds up the others
+    """
+    def __init__(self, engine, host):
+        self.engine = engine
+        self.host = host
+        self.sock = None
+        self.connected = False
+        self.failed = False
+        self.attempts = 0
+        self.decoder = None
+        self.frames = deque()
+        self.backlog = 0
+        self.dispatcher = None
+        self.backoff = S4AH_BO.Backoff(maxDelay=engine.reconnectDelay)
+        # statistics
+        self.sentFrames = 0
+        self.resyncs = 0
+
+    def put(self, data):
+        """
+        send the dict data to this peer only (e.g. the replies to its commands)
+        """
+        self.sendFrame(S4AH_SC.encodeSensorUpdate(data.items()))
+
+    def stats(self):
+        """
+        counters of the shared queue and of this peer
+        """
+        stats = self.engine.queue.stats()
+        stats['peerbacklog'] = self.backlog
+        stats['peerframes'] = self.sentFrames
+        stats['peerresyncs'] = self.resyncs
+        return stats
+
+    def sendFrame(self, frame):
+        if self.backlog + len(frame) > self.engine.maxBacklog:
+            self.frames.clear()
+            self.backlog = 0
+            self.resyncs += 1
+            frame = self.engine.snapshot()
+            logger.debug("peer %s too slow: backlog replaced by a snapshot", self.host)
+        capture = S4AH_SQ.capture
+        if capture is not None:
+            capture.outbound(self.host, frame[4:])
+        self.frames.append(frame)
+        self.backlog += len(frame)
+        self.write()
+
+    def write(self):
+        """
+        write the backlog until the socket is full
+        """
+        while self.frames and self.connected:
+            frame = self.frames[0]
+            try:
+                start = time.time()
+                n = self.sock.send(frame)
+                S4AH_ST.stats.record('send', start)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.disconnected()
+                    return
+                break
+            self.backlog -= n
+            if n < len(frame):
+                self.frames[0] = frame[n:]
+                break
+            self.frames.popleft()
+            self.sentFrames += 1
+        if self.connected:
+            events = select.EPOLLIN | (select.EPOLLOUT if self.frames else 0)
+            self.engine.epoll.modify(self.sock.fileno(), events)
+
+    def connect(self):
+        logger.info('Trying to connect to %s...', self.host)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((self.host, self.engine.port))
+        if err not in (0, errno.EINPROGRESS):
+            self.connectFailed(os.strerror(err))
+            return
+        self.engine.register(self.sock.fileno(), select.EPOLLOUT, self.onConnect)
+
+    def onConnect(self, events):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.connectFailed(os.strerror(err))
+            return
+        self.engine.epoll.modify(self.sock.fileno(), select.EPOLLIN)
+        self.engine.fdHandlers[self.sock.fileno()] = self.onSocket
+        self.connected = True
+        self.attempts = 0
+        self.backoff.connected()
+        self.engine.peerConnected()
+        self.decoder = S4AH_SC.FrameDecoder()
+        self.frames.clear()
+        self.backlog = 0
+        commands = self.engine.commandsFactory(self, self.engine.stop)
+        self.dispatcher = S4AH_DP.CommandDispatcher(self.engine.controller, commands.handlers())
+        logger.info('Connected to %s!', self.host)
+        logger.info("Running....")
+        if self.engine.latest:
+            self.sendFrame(self.engine.snapshot())
+
+    def connectFailed(self, reason):
+        logger.info("There was an error connecting to Scratch!")
+        logger.info("I couldn't find a Mesh session at host: %s, port: %s (%s)", self.host, self.engine.port, reason)
+        self.closeSocket()
+        self.attempts += 1
+        if self.engine.maxAttempts != 0 and self.attempts >= self.engine.maxAttempts:
+            self.failed = True
+            self.engine.peerFailed()
+            return
+        self.engine.callLater(self.backoff.next(), self.connect)
+
+    def closeSocket(self):
+        if self.sock is not None:
+            self.engine.unregister(self.sock.fileno())
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+
+    def disconnected(self):
+        logger.info("Scratch %s disconnected", self.host)
+        self.closeSocket()
+        self.engine.peerDisconnected()
+        self.engine.callLater(self.backoff.next(), self.connect)
+
+    def onSocket(self, events):
+        if events & select.EPOLLOUT:
+            self.write()
+        if self.connected and events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            try:
+                start = time.time()
+                n = self.decoder.receive(self.sock)
+                S4AH_ST.stats.record('receive', start)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return
+                n = 0
+            if not n:
+                self.disconnected()
+                return
+            self.receiveFrames()
+
+    def receiveFrames(self):
+        """
+        dispatch all the complete frames received (Scratch pipelines them)
+        """
+        try:
+            for payload in self.decoder.frames():
+                start = time.time()
+                capture = S4AH_SQ.capture
+                if capture is not None:
+                    capture.inbound(self.host, payload)
+                msg = S4AH_SC.parseMessage(payload)
+                if msg is None:
+                    S4AH_ST.stats.count('unknown')
+                    logger.error("Unknown message: %s", payload[:64])
+                    continue
+                self.dispatch(msg, start)
+                if not self.connected:
+                    break
+        except S4AH_SC.CodecError, e:
+            logger.error("Scratch %s protocol error: %s", self.host, e)
+            self.disconnected()
+
+    def dispatch(self, msg, start):
+        """
+        resolve the commands of the message (parsed since start) and run them
+        """
+        (msgType, item) = msg
+        if msgType == 'broadcast':
+            command = self.dispatcher.resolveBroadcast(item)
+            S4AH_ST.stats.record('parse', start)
+            if command is None:
+                S4AH_ST.stats.count('unknown')
+                logger.error("Error parsing broadcast %s", item)
+                return
+            (handler, arg, value) = command
+            handler(arg, value)
+        else:
+            commands = []
+            for key in item:
+                command = self.dispatcher.resolveSensor(key)
+                if command is None:
+                    S4AH_ST.stats.count('unknown')
+                    logger.error("Error parsing sensor-update %s", key)
+                    continue
+                commands.append((command, item[key]))
+            S4AH_ST.stats.record('parse', start)
+            for ((handler, arg, value), itemValue) in commands:
+                handler(arg, itemValue)
+
+
+class EventLoopEngine:
+    """
+    Scratch connections, input monitoring, outbound queue and reconnection on
+    a single epoll loop: no threads, and no wakeups while nothing happens
+    (the input sweep timer runs only while there are polled INPUT pins).
+    SIGINT and SIGTERM stop the loop.
+    The input changes are put in the shared queue, each batch is encoded
+    once and written to all the connected peers.
+    commandsFactory(replies, onStop) returns the commands handlers of a peer.
+    A disconnected peer is retried after jittered exponential delays up to
+    reconnectDelay. The pins are reset resetGrace secs after the last peer
+    disconnected (at once with 0, never with a negative value): a Scratch
+    PC back in time finds its pins as it left them.
+    Other threads hand their results to the loop by callFromThread
+    """
+    def __init__(self, controller, hosts, port, commandsFactory, queue,
+                 edgeMonitor=None, sleepTime=0.050, reconnectDelay=S4AH_BO.MAX_DELAY, maxAttempts=0,
+                 maxBacklog=S4AH_SQ.DEFAULT_MAX_BACKLOG, inputFilters=None, pollScheduler=None,
+                 resetGrace=0, analogInputs=None):
+        self.controller = controller
+        self.inputFilters = inputFilters or S4AH_IF.InputFilters(controller)
+        self.port = port
+        self.commandsFactory = commandsFactory
+        self.queue = queue
+        self.edgeMonitor = edgeMonitor
+        self.analogInputs = analogInputs
+        # sleepTime is the poll interval of the idle INPUT pins
+        self.pollScheduler = pollScheduler or S4AH_PS.PollScheduler(controller, slowInterval=sleepTime)
+        self.reconnectDelay = reconnectDelay
+        self.resetGrace = resetGrace
+        self.resetTimer = None
+        self.maxAttempts = maxAttempts
+        self.maxBacklog = maxBacklog
+        self.epoll = select.epoll()
+        self.fdHandlers = {}
+        self.timers = []
+        self.timerSeq = 0
+        self.stopping = False
+        self.sweepTimer = None
+        self.polledNames = None     # edgeMonitor.polledPins of self.polled
+        self.polled = []
+        self.filterTimer = None
+        self.modeChangePosted = False
+        self.peers = [LoopPeer(self, host) for host in hosts]
+        self.latest = {}        # latest value sent of each sensor
+        # callbacks posted by other threads (e.g. the workers) and the pipe waking the loop
+        self.calls = deque()
+        # the pipe is closed by shutdown while other threads may be writing it
+        self.wakeLock = threading.Lock()
+        (self.wakeRead, self.wakeWrite) = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    # timers
+
+    def callLater(self, delay, callback):
+        timer = Timer(time.time() + delay, callback)
+        self.timerSeq += 1
+        heapq.heappush(self.timers, (timer.deadline, self.timerSeq, timer))
+        return timer
+
+    def runTimers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if timer.active:
+                try:
+                    timer.callback()
+                except Exception:
+                    logger.exception("timer %s failed", timer.callback)
+
+    def pollTimeout(self):
+        """
+        seconds until the next timer or the next allowed send, -1 if nothing is due
+        """
+        deadlines = [entry[0] for entry in self.timers[:1]]
+        if self.canSend():
+            nextSend = self.queue.nextSendTime()
+            if nextSend is not None:
+                deadlines.append(nextSend)
+        if not deadlines:
+            return -1
+        return max(min(deadlines) - time.time(), 0)
+
+    # fds
+
+    def register(self, fd, events, handler):
+        self.fdHandlers[fd] = handler
+        self.epoll.register(fd, events)
+
+    def unregister(self, fd):
+        self.fdHandlers.pop(fd, None)
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError):
+            pass
+
+    # signals
+
+    def onSignal(self, signum, frame):
+        logger.debug("signal %s received", signum)
+        self.stop()
+
+    def installSignals(self):
+        self.signalRead, self.signalWrite = os.pipe()
+        for fd in (self.signalRead, self.signalWrite):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.signalWrite)
+        signal.signal(signal.SIGINT, self.onSignal)
+        signal.signal(signal.SIGTERM, self.onSignal)
+        self.register(self.signalRead, select.EPOLLIN, self.onSignalPipe)
+
+    def onSignalPipe(self, events):
+        try:
+            os.read(self.signalRead, 512)
+        except OSError:
+            pass
+
+    # other threads
+
+    def callFromThread(self, callback, *args):
+        """
+        run callback(*args) on the loop thread: the only method of the
+        engine other threads may call
+        """
+        with self.wakeLock:
+            if self.wakeWrite is None:
+                return      # the loop is over
+            self.calls.append((callback, args))
+            try:
+                os.write(self.wakeWrite, b'w')
+            except OSError:
+                pass    # the pipe is full: the loop is already waking up
+
+    def onWakePipe(self, events):
+        try:
+            os.read(self.wakeRead, 4096)
+        except OSError:
+            pass
+        while self.calls:
+            (callback, args) = self.calls.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("call of %s failed", callback)
+
+    # peers
+
+    def connectedPeers(self):
+        return [peer for peer in self.peers if peer.connected]
+
+    def peerConnected(self):
+        if self.resetTimer is not None:
+            self.resetTimer.cancel()
+            self.resetTimer = None
+            logger.debug("pin reset canceled: Scratch is back")
+
+    def peerDisconnected(self):
+        if self.connectedPeers():
+            return
+        # the last peer is gone
+        logger.debug("outbound queue stats: %s", self.queue.stats())
+        if self.resetGrace == 0:
+            self.resetPins()
+        elif self.resetGrace > 0 and self.resetTimer is None:
+            logger.info("no Scratch connected: pins reset in %s secs", self.resetGrace)
+            self.resetTimer = self.callLater(self.resetGrace, self.resetPins)
+
+    def resetPins(self):
+        self.resetTimer = None
+        self.controller.resetAllPins()
+        logger.debug("Pin Reset Done")
+
+    def peerFailed(self):
+        if not [peer for peer in self.peers if not peer.failed]:
+            self.stop()
+
+    def snapshot(self):
+        """
+        frame with the latest value of every sensor, the queued ones included
+        """
+        values = dict(self.latest)
+        values.update(self.queue.pendingItems())
+        return S4AH_SC.encodeSensorUpdate(values.items())
+
+    def canSend(self):
+        """
+        a batch is taken only if a peer is idle: while all the peers are
+        busy the queue keeps coalescing
+        """
+        for peer in self.peers:
+            if peer.connected and not peer.frames:
+                return True
+        return False
+
+    def flush(self):
+        """
+        encode once the queued sensor-updates and write them to all the peers
+        """
+        while self.canSend():
+            batch = self.queue.takeBatch(time.time())
+            if batch is None:
+                break
+            self.latest.update(batch)
+            frame = S4AH_SC.encodeSensorUpdate(batch)
+            for peer in self.connectedPeers():
+                peer.sendFrame(frame)
+
+    # inputs
+
+    def putChanges(self, samples):
+        """
+        put in the queue the changes of the samples (PinData, value) that
+        pass the input filters
+        """
+        self.putFiltered(self.inputFilters.changes(samples))
+        self.scheduleFilters()
+
+    def putFiltered(self, changes):
+        bcast_dict = {}
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for (pin, currVal) in changes:
+            bcast_dict[pin.sensorName] = currVal
+            if debug:
+                logger.debug("Change detected in pin %s changed to %s", pin.name, currVal)
+        # queued also without peers: pin.value is already updated, the
+        # queue keeps the change until a peer connects
+        if bcast_dict:
+            if debug:
+                logger.debug('sending: %s', bcast_dict)
+            S4AH_ST.stats.count('changes', len(bcast_dict))
+            self.queue.put(bcast_dict)
+
+    def putSensors(self, bcast_dict):
+        """
+        put sensors read by another service (e.g. the I2C poller, through
+        callFromThread): queued even without peers, the queue keeps the
+        latest value of each until a peer connects
+        """
+        logger.debug('sending: %s', bcast_dict)
+        S4AH_ST.stats.count('changes', len(bcast_dict))
+        self.queue.put(bcast_dict)
+
+    def polledInputs(self):
+        """
+        INPUT pins not driven by edges: the same list until they change
+        """
+        if self.edgeMonitor:
+            if self.edgeMonitor.polledPins is not self.polledNames:
+                self.polledNames = self.edgeMonitor.polledPins
+                self.polled = [self.controller.ValidPins[key] for key in self.polledNames]
+            return self.polled
+        return self.controller.inputPins
+
+    def onModeChange(self):
+        """
+        listener of the controller, called by any thread (the waveforms,
+        the workers): the change is handled by the loop thread, once for
+        a burst of changes
+        """
+        if not self.modeChangePosted:
+            self.modeChangePosted = True
+            self.callFromThread(self.modeChanged)
+
+    def modeChanged(self):
+        """
+        a pin mode changed: start the sweep timer if needed
+        """
+        self.modeChangePosted = False
+        if self.edgeMonitor:
+            # the edge monitor wakes up its epoll fd: onEdge syncs it
+            return
+        self.scheduleSweep()
+
+    def scheduleSweep(self):
+        """
+        (re)arm the sweep timer at the next poll deadline, none without pins
+        """
+        now = time.time()
+        self.pollScheduler.setPins(self.polledInputs(), now)
+        deadline = self.pollScheduler.nextDeadline()
+        if self.sweepTimer is not None:
+            if deadline is not None and self.sweepTimer.deadline <= deadline:
+                return
+            self.sweepTimer.cancel()
+            self.sweepTimer = None
+        if deadline is not None:
+            self.sweepTimer = self.callLater(max(deadline - now, 0), self.sweep)
+
+    def sweep(self):
+        self.sweepTimer = None
+        now = time.time()
+        self.pollScheduler.setPins(self.polledInputs(), now)
+        pins = [pin for pin in self.pollScheduler.due(now) if pin.mode == S4AH.PINPUT]
+        if pins:
+            samples = self.controller.readInputs(pins)
+            self.pollScheduler.update(samples, now)
+            self.putChanges(samples)
+        self.scheduleSweep()
+
+    def scheduleFilters(self):
+        """
+        evaluate again the values held by the input filters when due
+        """
+        deadline = self.inputFilters.nextDeadline()
+        if deadline is None:
+            return
+        if self.filterTimer is not None:
+            if self.filterTimer.deadline <= deadline:
+                return
+            self.filterTimer.cancel()
+        self.filterTimer = self.callLater(max(deadline - time.time(), 0), self.expireFilters)
+
+    def expireFilters(self):
+        self.filterTimer = None
+        self.putFiltered(self.inputFilters.expire())
+        self.scheduleFilters()
+
+    def onAnalog(self, events):
+        """
+        scans buffered by the ADC: the changes are already filtered by the deadband
+        """
+        self.putFiltered(self.analogInputs.read())
+
+    def onEdge(self, events):
+        self.edgeMonitor.sync()
+        changes = self.edgeMonitor.wait(0)
+        self.putChanges([(self.controller.ValidPins[key], value) for (key, value) in changes])
+        self.scheduleSweep()
+
+    # main
+
+    def stop(self):
+        self.stopping = True
+
+    def run(self):
+        logger.debug("Event loop engine running")
+        self.installSignals()
+        self.register(self.wakeRead, select.EPOLLIN, self.onWakePipe)
+        self.controller.modeListeners.append(self.onModeChange)
+        if self.edgeMonitor:
+            self.register(self.edgeMonitor.epoll.fileno(), select.EPOLLIN, self.onEdge)
+        if self.analogInputs:
+            self.register(self.analogInputs.fileno(), select.EPOLLIN, self.onAnalog)
+        self.scheduleSweep()
+        for peer in self.peers:
+            peer.connect()
+        while not self.stopping:
+            self.flush()
+            try:
+                events = self.epoll.poll(self.pollTimeout())
+            except IOError, e:
+                if e.errno != errno.EINTR:
+                    raise
+                events = []
+            for (fd, event) in events:
+                handler = self.fdHandlers.get(fd)
+                if handler is not None:
+                    # a failing command or peer must not stop the other ones
+                    try:
+                        handler(event)
+                    except Exception:
+                        logger.exception("handler of fd %d failed", fd)
+            self.runTimers()
+        self.shutdown()
+
+    def shutdown(self):
+        logger.debug("Event loop engine stopping")
+        for peer in self.peers:
+            peer.closeSocket()
+        if self.onModeChange in self.controller.modeListeners:
+            self.controller.modeListeners.remove(self.onModeChange)
+        if self.edgeMonitor:
+            self.unregister(self.edgeMonitor.epoll.fileno())
+            self.edgeMonitor.close()
+        self.controller.resetAllPins()
+        if self.analogInputs:
+            self.unregister(self.analogInputs.fileno())
+        logger.debug("Pin Reset Done")
+        signal.set_wakeup_fd(-1)
+        self.epoll.close()
+        with self.wakeLock:
+            (wakeRead, wakeWrite) = (self.wakeRead, self.wakeWrite)
+            self.wakeWrite = None
+            os.close(wakeRead)
+            os.close(wakeWrite)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#s4ah_FakeMesh - local stand-in of a Scratch 1.4 mesh host for scratch4acmeboards tests
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import time
+import Queue
+import socket
+import subprocess
+import logging
+import threading
+import s4ah_ScratchCodec as S4AH_SC
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+PORT = 42001
+HANDLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scratch4acmeboards_handler.py')
+TIMEOUT = 5.0        # seconds waiting for the handler
+
+
+class FakeMesh:
+    """
+    Listen on the mesh port as Scratch does, accept the handler connection
+    and exchange framed messages with it. The received frames are collected
+    by a thread with the time of their arrival
+    """
+    def __init__(self, host='127.0.0.1', port=PORT):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(5)
+        self.conn = None
+        self.received = Queue.Queue()
+        self.reader = None
+
+    def accept(self, timeout=None):
+        """
+        wait for the handler to connect
+        """
+        self.server.settimeout(timeout)
+        self.conn, address = self.server.accept()
+        self.conn.settimeout(None)
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = threading.Thread(target=self.readFrames, name='FakeMeshReader')
+        self.reader.daemon = True
+        self.reader.start()
+        return address
+
+    def readFrames(self):
+        decoder = S4AH_SC.FrameDecoder()
+        try:
+            while decoder.receive(self.conn):
+                arrival = time.time()
+                for payload in decoder.frames():
+                    self.received.put((arrival, payload))
+        except (socket.error, S4AH_SC.CodecError):
+            pass
+        self.received.put((time.time(), None))
+
+    def sendRaw(self, payload):
+        self.conn.sendall(S4AH_SC.encodeFrame(payload))
+
+    def sendFrames(self, frames):
+        """
+        send already framed messages at once (pipelined)
+        """
+        self.conn.sendall(''.join(frames))
+
+    def broadcast(self, name):
+        self.conn.sendall(S4AH_SC.encodeBroadcast(name))
+
+    def sensorupdate(self, data):
+        self.conn.sendall(S4AH_SC.encodeSensorUpdate(data.items()))
+
+    def receive(self, timeout=None):
+        """
+        return (arrival time, payload) of the next frame, payload is None
+        when the handler disconnects. Raise Queue.Empty on timeout
+        """
+        return self.received.get(True, timeout)
+
+    def waitFor(self, text, timeout):
+        """
+        wait for a frame containing text: return (arrival time, payload) or None
+        """
+        deadline = time.time() + timeout
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                return None
+            try:
+                (arrival, payload) = self.receive(left)
+            except Queue.Empty:
+                return None
+            if payload is None:
+                return None
+            if text in payload:
+                return (arrival, payload)
+
+    def drain(self):
+        while True:
+            try:
+                self.received.get_nowait()
+            except Queue.Empty:
+                return
+
+    def disconnect(self):
+        """
+        close the connection as Scratch does when it quits: shutdown before
+        close, the reader thread still holds the socket
+        """
+        if self.conn is not None:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+                self.conn.close()
+            except socket.error:
+                pass
+            self.conn = None
+
+    def close(self):
+        self.disconnect()
+        self.server.close()
+
+
+class MeshSession:
+    """
+    The handler in a child process (offline, with the passed options)
+    connected to a fake Scratch mesh
+    """
+    def __init__(self, args, timeout=TIMEOUT):
+        self.mesh = FakeMesh()
+        self.timeout = timeout
+        self.devnull = open(os.devnull, 'w')
+        self.handler = subprocess.Popen([sys.executable, HANDLER, '-o', '-m', '127.0.0.1'] + list(args),
+                                        stdout=self.devnull, stderr=self.devnull, close_fds=True)
+
+    def connect(self):
+        """
+        wait for the handler: return False if it doesn't connect
+        """
+        try:
+            self.mesh.accept(self.timeout)
+            return True
+        except socket.timeout:
+            return False
+
+    def alive(self, timeout=None):
+        """
+        check the handler still answers
+        """
+        self.mesh.broadcast('getversion')
+        return self.mesh.waitFor('"version"', timeout or self.timeout) is not None
+
+    def close(self):
+        try:
+            self.mesh.broadcast('stophandler')
+        except (socket.error, AttributeError):
+            pass
+        self.mesh.close()
+        for i in range(20):
+            if self.handler.poll() is not None:
+                break
+            time.sleep(0.1)
+        else:
+            self.handler.terminate()
+            self.handler.wait()
+        self.devnull.close()
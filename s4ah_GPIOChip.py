@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+#s4ah_GPIOChip - GPIO character device backend (gpiochip v2 uAPI) for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import array
+import errno
+import fcntl
+import struct
+import logging
+import ablib as AB
+import s4ah_GPIOController as S4AH
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+# AT91 PIO banks: one gpiochip for each bank, 32 lines each
+BANKS = 'ABCDE'
+LINES_PER_BANK = 32
+# kernel id of PA0 in the ablib numbering
+KERNELID_BASE = 32
+
+CONSUMER = 'scratch4acmeboards'
+
+# from linux/gpio.h (gpio v2 uAPI)
+GPIO_V2_LINES_MAX = 64
+GPIO_V2_LINE_NUM_ATTRS_MAX = 10
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_OUTPUT = 1 << 3
+GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES = 2
+
+# struct gpio_v2_line_request: offsets, consumer, config (flags, num_attrs,
+# padding, attrs[10] of {id, padding, values, mask}), num_lines,
+# event_buffer_size, padding, fd
+LINE_REQUEST_FMT = ('=%dI32s' % GPIO_V2_LINES_MAX +
+                    'QI5I' + 'IIQQ' * GPIO_V2_LINE_NUM_ATTRS_MAX +
+                    'II5Ii')
+LINE_REQUEST_SIZE = struct.calcsize(LINE_REQUEST_FMT)
+LINE_REQUEST_FD_OFFSET = LINE_REQUEST_SIZE - 4
+# struct gpio_v2_line_values: bits, mask
+LINE_VALUES_FMT = '=QQ'
+LINE_VALUES_SIZE = struct.calcsize(LINE_VALUES_FMT)
+
+
+def _IOWR(type, nr, size):
+    return (3 << 30) | (size << 16) | (type << 8) | nr
+
+GPIO_V2_GET_LINE_IOCTL = _IOWR(0xB4, 0x07, LINE_REQUEST_SIZE)
+GPIO_V2_LINE_GET_VALUES_IOCTL = _IOWR(0xB4, 0x0E, LINE_VALUES_SIZE)
+GPIO_V2_LINE_SET_VALUES_IOCTL = _IOWR(0xB4, 0x0F, LINE_VALUES_SIZE)
+
+
+def newBuffer(size):
+    """
+    zeroed mutable buffer for ioctl: python 2 fcntl.ioctl doesn't accept a bytearray
+    """
+    return array.array('B', [0] * size)
+
+
+def packLineRequest(offsets, flags, outputValues=None):
+    """
+    build a gpio_v2_line_request. outputValues (a bitmap in the request
+    line order) sets the initial values of output lines
+    """
+    attrs = [0] * (4 * GPIO_V2_LINE_NUM_ATTRS_MAX)
+    numAttrs = 0
+    if outputValues is not None:
+        numAttrs = 1
+        attrs[0:4] = [GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES, 0,
+                      outputValues, (1 << len(offsets)) - 1]
+    args = list(offsets) + [0] * (GPIO_V2_LINES_MAX - len(offsets))
+    args.append(CONSUMER)
+    args += [flags, numAttrs] + [0] * 5 + attrs
+    args += [len(offsets), 0] + [0] * 5 + [-1]
+    buf = newBuffer(LINE_REQUEST_SIZE)
+    struct.pack_into(LINE_REQUEST_FMT, buf, 0, *args)
+    return buf
+
+
+def unpackLineRequest(buf):
+    """
+    return (offsets, flags, outputValues or None) of a gpio_v2_line_request
+    """
+    fields = struct.unpack_from(LINE_REQUEST_FMT, buf, 0)
+    numLines = fields[-8]
+    offsets = fields[:numLines]
+    flags = fields[GPIO_V2_LINES_MAX + 1]
+    numAttrs = fields[GPIO_V2_LINES_MAX + 2]
+    outputValues = None
+    first = GPIO_V2_LINES_MAX + 8
+    for i in range(numAttrs):
+        attr = fields[first + 4 * i:first + 4 * i + 4]
+        if attr[0] == GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES:
+            outputValues = attr[2] & attr[3]
+    return (offsets, flags, outputValues)
+
+
+class GPIOChips:
+    """
+    Access to the real /dev/gpiochipN devices
+    """
+    path = '/dev/gpiochip%d'
+
+    def open(self, bank):
+        return os.open(self.path % bank, os.O_RDWR)
+
+    def ioctl(self, fd, request, buf):
+        fcntl.ioctl(fd, request, buf, True)
+
+    def close(self, fd):
+        os.close(fd)
+
+
+class FakeGPIOChips:
+    """
+    In memory stand-in of the gpiochip devices and of the line request
+    ioctls, used in offline mode: it decodes the same structures the kernel
+    receives, so the backend can be tested on any Linux box
+    """
+    def __init__(self):
+        self.values = {}     # (bank, offset) -> line value
+        self.chips = {}      # fd -> bank
+        self.lines = {}      # fd -> (bank, offsets, flags)
+        self.nextFd = 1000
+        self.ioctls = 0
+
+    def open(self, bank):
+        if bank >= len(BANKS):
+            raise OSError(errno.ENOENT, "no gpiochip%d" % bank)
+        fd = self.nextFd
+        self.nextFd += 1
+        self.chips[fd] = bank
+        return fd
+
+    def close(self, fd):
+        self.chips.pop(fd, None)
+        self.lines.pop(fd, None)
+
+    def setValue(self, bank, offset, value):
+        """
+        change an input line as an external signal would do
+        """
+        self.values[(bank, offset)] = 1 if value else 0
+
+    def ioctl(self, fd, request, buf):
+        self.ioctls += 1
+        if request == GPIO_V2_GET_LINE_IOCTL:
+            if fd not in self.chips:
+                raise IOError(errno.EBADF, "not a gpiochip")
+            bank = self.chips[fd]
+            (offsets, flags, outputValues) = unpackLineRequest(buf)
+            for (lbank, loffsets, lflags) in self.lines.values():
+                if lbank == bank and set(loffsets) & set(offsets):
+                    raise IOError(errno.EBUSY, "line busy")
+            if flags & GPIO_V2_LINE_FLAG_OUTPUT and outputValues is not None:
+                for (i, offset) in enumerate(offsets):
+                    self.values[(bank, offset)] = (outputValues >> i) & 1
+            lineFd = self.nextFd
+            self.nextFd += 1
+            self.lines[lineFd] = (bank, offsets, flags)
+            struct.pack_into('=i', buf, LINE_REQUEST_FD_OFFSET, lineFd)
+        elif request in (GPIO_V2_LINE_GET_VALUES_IOCTL, GPIO_V2_LINE_SET_VALUES_IOCTL):
+            if fd not in self.lines:
+                raise IOError(errno.EBADF, "not a line request")
+            (bank, offsets, flags) = self.lines[fd]
+            (bits, mask) = struct.unpack_from(LINE_VALUES_FMT, buf, 0)
+            if request == GPIO_V2_LINE_SET_VALUES_IOCTL:
+                if not flags & GPIO_V2_LINE_FLAG_OUTPUT:
+                    raise IOError(errno.EPERM, "lines not in output")
+                for (i, offset) in enumerate(offsets):
+                    if mask & (1 << i):
+                        self.values[(bank, offset)] = (bits >> i) & 1
+            else:
+                bits = 0
+                for (i, offset) in enumerate(offsets):
+                    if mask & (1 << i) and self.values.get((bank, offset), 0):
+                        bits |= 1 << i
+                struct.pack_into(LINE_VALUES_FMT, buf, 0, bits, mask)
+        else:
+            raise IOError(errno.ENOTTY, "unknown ioctl")
+
+
+class LineRequest:
+    """
+    Lines of one PIO bank requested together in the same direction
+    """
+    def __init__(self, bank, mode, offsets, fd):
+        self.bank = bank
+        self.mode = mode
+        self.offsets = offsets
+        self.fd = fd
+        self.bits = dict((offset, 1 << i) for (i, offset) in enumerate(offsets))
+        self.allBits = (1 << len(offsets)) - 1
+        self.buf = newBuffer(LINE_VALUES_SIZE)   # reused by every get/set
+
+
+class GPIOChipBackend:
+    """
+    Backend using the GPIO character devices: all the INPUT lines of a PIO
+    bank belong to a single line request, so a full input sweep costs one
+    GPIO_V2_LINE_GET_VALUES_IOCTL for each bank. A request is released to
+    change its lines, so an OUTPUT line gets a request of its own: the other
+    outputs keep being driven while a pin is configured. The output lines
+    written together (e.g. a pin group) are merged in one request, released
+    again only when one of them leaves the OUTPUT mode
+    """
+    supportsEdge = False
+
+    def __init__(self, controller, offline, chips=None):
+        self.controller = controller
+        if chips is None:
+            chips = FakeGPIOChips() if offline else GPIOChips()
+        self.chips = chips
+        self.chipFds = {}     # bank -> gpiochip fd
+        self.lines = {}       # (bank, PINPUT) -> set of offsets
+        self.requests = {}    # (bank, PINPUT) -> LineRequest
+        self.outputRequests = {}    # (bank, offset) -> LineRequest of the OUTPUT line
+        self.outputs = {}     # (bank, offset) -> last value written
+        # reverse of the ablib board map, used when the pin name is not the MCU name
+        self.pinname2mcuName = dict((v, k) for (k, v) in
+                                    AB.mcuName2pinname.get(controller.boardName, {}).items())
+
+    def location(self, pin):
+        """
+        return (bank, offset) of the pin from its MCU name (e.g. PA23) or its kernel id
+        """
+        mcuName = self.pinname2mcuName.get(pin.name, pin.name)
+        if len(mcuName) > 2 and mcuName[0] == 'P' and mcuName[1] in BANKS and mcuName[2:].isdigit():
+            return (BANKS.index(mcuName[1]), int(mcuName[2:]))
+        return divmod(pin.kernelId - KERNELID_BASE, LINES_PER_BANK)
+
+    def chipFd(self, bank):
+        if bank not in self.chipFds:
+            self.chipFds[bank] = self.chips.open(bank)
+        return self.chipFds[bank]
+
+    def requestLines(self, bank, mode, offsets, buf):
+        self.chips.ioctl(self.chipFd(bank), GPIO_V2_GET_LINE_IOCTL, buf)
+        fd = struct.unpack_from('=i', buf, LINE_REQUEST_FD_OFFSET)[0]
+        logger.debug("gpiochip%d: %s lines %s requested", bank, mode, offsets)
+        return LineRequest(bank, mode, offsets, fd)
+
+    def requestInputs(self, bank):
+        """
+        (re)build the request of the INPUT lines of a bank. The old request
+        is released first: the kernel doesn't allow a line in two requests
+        """
+        key = (bank, S4AH.PINPUT)
+        old = self.requests.pop(key, None)
+        if old is not None:
+            self.chips.close(old.fd)
+        offsets = sorted(self.lines.get(key, ()))
+        if offsets:
+            buf = packLineRequest(offsets, GPIO_V2_LINE_FLAG_INPUT)
+            self.requests[key] = self.requestLines(bank, S4AH.PINPUT, offsets, buf)
+
+    def requestOutputs(self, bank, offsets):
+        """
+        request the OUTPUT lines of a bank together, driving the values last
+        written: their old requests must be already released
+        """
+        values = 0
+        for (i, offset) in enumerate(offsets):
+            if self.outputs.get((bank, offset)):
+                values |= 1 << i
+        buf = packLineRequest(offsets, GPIO_V2_LINE_FLAG_OUTPUT, values)
+        request = self.requestLines(bank, S4AH.POUTPUT, offsets, buf)
+        for offset in offsets:
+            self.outputRequests[(bank, offset)] = request
+        return request
+
+    def removeLine(self, bank, offset):
+        if offset in self.lines.get((bank, S4AH.PINPUT), ()):
+            self.lines[(bank, S4AH.PINPUT)].discard(offset)
+            self.requestInputs(bank)
+        request = self.outputRequests.pop((bank, offset), None)
+        if request is not None:
+            self.chips.close(request.fd)
+            others = [other for other in request.offsets if other != offset]
+            if others:
+                # only the lines written together with it are released a moment
+                self.requestOutputs(bank, others)
+
+    def setMode(self, pin, mode):
+        (bank, offset) = self.location(pin)
+        self.removeLine(bank, offset)
+        if mode == S4AH.PINPUT:
+            self.lines.setdefault((bank, mode), set()).add(offset)
+            self.requestInputs(bank)
+        elif mode == S4AH.POUTPUT:
+            self.requestOutputs(bank, [offset])
+
+    def release(self, pin):
+        (bank, offset) = self.location(pin)
+        self.removeLine(bank, offset)
+        self.outputs.pop((bank, offset), None)
+
+    def unexport(self, pin):
+        # a line removed from the requests is no longer driven
+        self.release(pin)
+
+    def write(self, pin, value):
+        (bank, offset) = self.location(pin)
+        request = self.outputRequests.get((bank, offset))
+        if request is None:
+            raise IOError("pin %s is not an output line" % pin.name)
+        value = 1 if float(value) else 0
+        bit = request.bits[offset]
+        struct.pack_into(LINE_VALUES_FMT, request.buf, 0, bit if value else 0, bit)
+        self.chips.ioctl(request.fd, GPIO_V2_LINE_SET_VALUES_IOCTL, request.buf)
+        self.outputs[(bank, offset)] = value
+
+    def writeMany(self, changes):
+        """
+        write the list of (pin, value) with one ioctl for each line request.
+        The requests of a bank whose lines are all written are merged in one
+        request driving the new values, written with one ioctl from then on
+        """
+        banks = {}   # bank -> {offset: value}
+        for (pin, value) in changes:
+            (bank, offset) = self.location(pin)
+            if (bank, offset) not in self.outputRequests:
+                raise IOError("pin %s is not an output line" % pin.name)
+            banks.setdefault(bank, {})[offset] = 1 if float(value) else 0
+        for (bank, values) in banks.items():
+            requests = set(self.outputRequests[(bank, offset)] for offset in values)
+            if len(requests) > 1 and all(set(request.offsets) <= set(values) for request in requests):
+                # the lines change now anyway: released and requested at the new values
+                for request in requests:
+                    self.chips.close(request.fd)
+                for offset in values:
+                    self.outputs[(bank, offset)] = values[offset]
+                self.requestOutputs(bank, sorted(values))
+                continue
+            for request in requests:
+                bits = mask = 0
+                for offset in request.offsets:
+                    if offset in values:
+                        mask |= request.bits[offset]
+                        if values[offset]:
+                            bits |= request.bits[offset]
+                struct.pack_into(LINE_VALUES_FMT, request.buf, 0, bits, mask)
+                self.chips.ioctl(request.fd, GPIO_V2_LINE_SET_VALUES_IOCTL, request.buf)
+            for offset in values:
+                self.outputs[(bank, offset)] = values[offset]
+
+    def getBits(self, request, mask):
+        struct.pack_into(LINE_VALUES_FMT, request.buf, 0, 0, mask)
+        self.chips.ioctl(request.fd, GPIO_V2_LINE_GET_VALUES_IOCTL, request.buf)
+        return struct.unpack_from(LINE_VALUES_FMT, request.buf, 0)[0]
+
+    def read(self, pin):
+        (bank, offset) = self.location(pin)
+        request = self.requests.get((bank, S4AH.PINPUT))
+        if request is None or offset not in request.bits:
+            request = self.outputRequests.get((bank, offset))
+        if request is None:
+            raise IOError("pin %s is not requested" % pin.name)
+        bit = request.bits[offset]
+        return 1 if self.getBits(request, bit) & bit else 0
+
+    def readInputs(self, pins):
+        """
+        one ioctl for each bank: all the INPUT lines of the bank are read at
+        once. The pins of a bank that can't be read are left out
+        """
+        bankBits = {}
+        failed = {}             # bank -> error
+        result = []
+        for pin in pins:
+            (bank, offset) = self.location(pin)
+            request = self.requests.get((bank, S4AH.PINPUT))
+            if request is None or offset not in request.bits or bank in failed:
+                continue
+            if bank not in bankBits:
+                try:
+                    bankBits[bank] = self.getBits(request, request.allBits)
+                except (IOError, OSError), e:
+                    failed[bank] = e
+                    continue
+            result.append((pin, 1 if bankBits[bank] & request.bits[offset] else 0))
+        for (bank, e) in failed.items():
+            logger.error("Error reading the input lines of bank %s: %s", bank, e)
+        return result
+
+    def close(self):
+        for request in set(self.requests.values()) | set(self.outputRequests.values()):
+            self.chips.close(request.fd)
+        self.requests = {}
+        self.outputRequests = {}
+        for fd in self.chipFds.values():
+            self.chips.close(fd)
+        self.chipFds = {}
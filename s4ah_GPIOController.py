@@ -18,9 +18,18 @@
 #Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 
-import ablib as AB
 import os
+import math
+import time
+import marshal
 import logging
+import s4ah_Stats as S4AH_ST
+
+try:
+    import ablib as AB
+except ImportError:
+    # only the virtual backend works without ablib
+    AB = None
 
 
 class S4AHException(Exception):
@@ -38,31 +47,281 @@ connector_name = {'Arietta_G25'   : ['J4.'],
                   'Acqua_A5'      : ['J1.', 'J2.', 'J3.'],
                   }
 
+# hardware PWM: the pins of each board wired to a channel of the SoC PWM
+# controller (pin -> channel). The pins of Aria and Daisy are named by
+# connector: not mapped yet
+pwm_channel = {'Arietta_G25'   : {'PB11': 0, 'PB12': 1, 'PB13': 2, 'PB14': 3},
+               'Acqua_A5'      : {'PA20': 0, 'PA22': 1},
+               }
+
                   
 PNONE = 255
 # to mantain aligned with ablib modes in pinmode
 POUTPUT = 'OUTPUT'
 PINPUT  = 'INPUT'
 PUNUSED = 'NOTUSED'  # unused pins are set to INPUT mode
+PPWM    = 'PWM'      # driven by the PWM controller, not a GPIO
+
+# GPIO access backends
+BACKEND_SYSFS = 'sysfs'
+BACKEND_GPIOCHIP = 'gpiochip'
+BACKEND_VIRTUAL = 'virtual'
+backends = [BACKEND_SYSFS, BACKEND_GPIOCHIP, BACKEND_VIRTUAL]
+
+# sysfs gpio tree: the offline one is written by the ablib modified for tests
+SYSFS_GPIO = '/sys/class/gpio/'
+OFFLINE_SYSFS_GPIO = '/tmp/ablib/sys/class/gpio/'
+
+# values admitted by the sysfs edge attribute
+EDGE_NONE = 'none'
+EDGE_BOTH = 'both'
+
+# board descriptors cached by loadBoardDescriptor: one file per board,
+# rebuilt when the installed ablib changes. CAP_GPIO is the capability of
+# every pin, other peripherals add their own
+BOARD_CACHE_DIR = '/var/cache/scratch4acmeboards/'
+BOARD_CACHE_FORMAT = 1
+CAP_GPIO = 'gpio'
 
+# precomputed payloads written to the cached value file descriptors
+VALUE_BYTES = {0: b'0', 1: b'1'}
+
+# latency histograms of the hot paths
+recordPinUpdate = S4AH_ST.stats.recorder('pinupdate')
+recordPinRead = S4AH_ST.stats.recorder('pinread')
+recordSweep = S4AH_ST.stats.recorder('sweep')
+recordGroupUpdate = S4AH_ST.stats.recorder('groupupdate')
+
+# os.pread/os.pwrite are not available on python 2
+_pread = getattr(os, 'pread', None)
+_pwrite = getattr(os, 'pwrite', None)
+
+
+def readValueFd(fd):
+    """
+    read a sysfs value file from its beginning without reopening it
+    """
+    if _pread:
+        return _pread(fd, 8, 0)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.read(fd, 8)
 
-class PinData():
+
+def writeValueFd(fd, data, seek=False):
+    """
+    write a sysfs value file without reopening it. sysfs ignores the file
+    offset, regular files (offline mode) need seek=True
+    """
+    if not seek:
+        os.write(fd, data)
+    elif _pwrite:
+        _pwrite(fd, data, 0)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def ablibSignature():
+    """
+    identify the installed ablib: its version and the size and time of
+    its source file (a modified ablib can keep the version)
+    """
+    path = getattr(AB, '__file__', '')
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    try:
+        st = os.stat(path)
+        return (str(AB.getVersion()), path, st.st_size, int(st.st_mtime))
+    except OSError:
+        return (str(AB.getVersion()), path, 0, 0)
+
+
+def buildBoardDescriptor(boardName):
+    """
+    read from ablib the pins of the board: sorted list of (pin name,
+    kernel id, connector label e.g. J4.32, capabilities)
+    """
+    pins = []
+    if boardName != 'Aria_G25':
+        for (name, label) in AB.mcuName2pinname[boardName].items():
+            pins.append((name, AB.pinname2kernelid(name), label, (CAP_GPIO,)))
+    else:
+        #Aria G25 has the pin name already ok in pin2kid dictionary of ablib
+        prefixes = tuple(connector_name[boardName])
+        for name in AB.pin2kid:
+            if name.startswith(prefixes):
+                pins.append((name, AB.pinname2kernelid(name), name, (CAP_GPIO,)))
+    pins.sort()
+    return pins
+
+
+def loadBoardDescriptor(boardName, cacheDir=BOARD_CACHE_DIR):
     """
-    Here are all the useful info about a single pin
+    return (descriptor, True if read from the cache): the cache file is
+    read at once and used only if written for the same board and ablib,
+    otherwise the descriptor is built and the file replaced. An empty
+    cacheDir disables the cache
     """
-    def __init__(self, instance, name):
+    if not cacheDir:
+        return (buildBoardDescriptor(boardName), False)
+    key = (BOARD_CACHE_FORMAT, boardName) + ablibSignature()
+    path = os.path.join(cacheDir, 'board-%s.cache' % boardName)
+    try:
+        with open(path, 'rb') as fh:
+            (cachedKey, pins) = marshal.loads(fh.read())
+        if cachedKey == key:
+            return (pins, True)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    pins = buildBoardDescriptor(boardName)
+    tmp = path + '.tmp'
+    try:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        with open(tmp, 'wb') as fh:
+            fh.write(marshal.dumps((key, pins)))
+        os.rename(tmp, path)
+    except (IOError, OSError), e:
+        logger.debug("unable to write the board cache %s: %s", path, e)
+    return (pins, False)
+
+
+class PinData(object):
+    """
+    Here are all the useful info about a single pin. The attributes are
+    slots: no dict for each pin, also on the boards with hundreds of them
+    """
+    __slots__ = ('index', 'instance', 'thread', 'name', 'sensorName', 'mode', 'value',
+                 'kernelId', 'invert', 'edge', 'valueFd', 'analog')
+
+    def __init__(self, instance, name, index=0, kernelId=None):
+        self.index = index     # position of the pin in GPIOController.pinTable
         self.instance = instance
         self.thread = None   # used to stop the threads started in INPUT mode
         self.name = name       # pin label according the board layout (usually the MCU name e.g PA23)
+        self.sensorName = intern('pin' + name)   # name of the Scratch sensor of the pin
         self.mode = PUNUSED    # it can be PUNUSED, POUTPUT, PINPUT
         self.value = PNONE
-        self.kernelId = AB.pinname2kernelid(name)
+        self.kernelId = AB.pinname2kernelid(name) if kernelId is None else kernelId
         self.invert = False
+        self.edge = False      # True when the sysfs edge attribute is configured
+        self.valueFd = None    # value file kept open while the pin is used
+        self.analog = False    # ADC channel (kernelId is its number): only INPUT or NOTUSED
 
     def __repr__(self):
         return "Pin %s, mode %s, value %f" % (self.name, self.mode, self.value)
 
 
+class SysfsBackend:
+    """
+    Default backend: pins are exported and configured by ablib, then their
+    sysfs value files are kept open while the pins are used
+    """
+    supportsEdge = True
+
+    def __init__(self, controller, offline):
+        self.controller = controller
+        # sysfs ignores the file offset, regular files (offline mode) need the seek
+        self.seekOnWrite = offline
+
+    def openValueFd(self, pin):
+        """
+        open (once) the value file of an exported pin: reads and writes
+        then cost a single syscall
+        """
+        if pin.valueFd is not None:
+            return
+        try:
+            pin.valueFd = os.open(self.controller.pinPath(pin.name) + "/value", os.O_RDWR)
+        except OSError, e:
+            logger.debug("unable to open value file of pin %s: %s", pin.name, e)
+            pin.valueFd = None
+
+    def closeValueFd(self, pin):
+        """
+        close the cached value file of the pin
+        """
+        if pin.valueFd is None:
+            return
+        try:
+            os.close(pin.valueFd)
+        except OSError:
+            pass
+        pin.valueFd = None
+
+    def setMode(self, pin, mode):
+        pin.instance = AB.Pin(pin.name, mode)
+        if mode == PUNUSED:
+            self.closeValueFd(pin)
+        else:
+            self.openValueFd(pin)
+
+    def release(self, pin):
+        self.closeValueFd(pin)
+        pin.instance = None
+        AB.Pin(pin.name, POUTPUT)
+
+    def unexport(self, pin):
+        """
+        give the line back to the kernel without driving it (e.g. to the
+        PWM controller)
+        """
+        self.closeValueFd(pin)
+        pin.instance = None
+        try:
+            with open(self.controller.sysfsRoot + "unexport", 'w') as fh:
+                fh.write(str(pin.kernelId))
+        except IOError, e:
+            # EINVAL: the line wasn't exported
+            logger.debug("unable to unexport pin %s: %s", pin.name, e)
+
+    def write(self, pin, value):
+        """
+        write the value using the cached descriptor when possible
+        """
+        data = VALUE_BYTES.get(value)
+        if pin.valueFd is not None and data is not None:
+            try:
+                writeValueFd(pin.valueFd, data, self.seekOnWrite)
+                return
+            except OSError, e:
+                raise IOError(str(e))
+        pin.instance.set_value(value)
+
+    def writeMany(self, changes):
+        """
+        write the list of (pin, value): one syscall for each pin
+        """
+        for (pin, value) in changes:
+            self.write(pin, value)
+
+    def read(self, pin):
+        if pin.valueFd is not None:
+            return int(readValueFd(pin.valueFd).strip() or 0)
+        return AB.get_value(pin.kernelId)
+
+    def readInputs(self, pins):
+        """
+        read all the passed pins: sysfs needs one syscall for each pin. A pin
+        that can't be read is left out, the others are returned
+        """
+        values = []
+        failed = []
+        for pin in pins:
+            try:
+                values.append((pin, self.read(pin)))
+            except (IOError, OSError, ValueError), e:
+                failed.append(pin.name)
+                error = e
+        if failed:
+            logger.error("Error reading input pins %s: %s", failed, error)
+        return values
+
+    def close(self):
+        for key in self.controller.ValidPins:
+            self.closeValueFd(self.controller.ValidPins[key])
+
+
 class GPIOController:
 
     def getRevision(self):
@@ -79,52 +338,44 @@ class GPIOController:
         except:
             return 0
 
-    def __init__(self, boardName, offline):
+    def __init__(self, boardName, offline, backend=BACKEND_SYSFS, cacheDir=BOARD_CACHE_DIR,
+                 virtualPins=0):
         self.boardName = boardName
         self.ValidPins = {}
         self.PNONE = PNONE
         self.POUTPUT = POUTPUT
         self.PINPUT = PINPUT
         self.PUNUSED = PUNUSED
+        self.offline = offline
+        self.sysfsRoot = OFFLINE_SYSFS_GPIO if offline else SYSFS_GPIO
+        # callables invoked without arguments each time a pin mode changes
+        self.modeListeners = []
+        # PinData of the pins in INPUT mode in pin order, a new list each
+        # time they change, built from inputIndex (pin index -> PinData)
+        # which is updated pin by pin
+        self.inputPins = []
+        self.inputIndex = {}
+        self.inputsChanged = False
+        # nesting of the changes of many pins (setAllPins ...): the
+        # listeners are informed once at the end
+        self.bulkDepth = 0
+        self.bulkChanged = False
+        # pin groups: lower case name -> list of pin names, the first pin is the bit 0
+        self.pinGroups = {}
+        self.groupsVersion = 0   # incremented each time a group is (re)defined
         
         #if self.boardName not in supportedBoards:
             #message = "board " + self.boardName + " not yet supported"
             #raise S4AHException (message)
 
-        if offline:
-            # for developers only: this is only for testing offline with
-            # an ablib modified to write on /tmp instead of real /sys area
-            testdir = "/tmp/ablib/sys/class/gpio/"
-            val = '0'
-            if self.boardName != 'Aria_G25':
-                for key in AB.mcuName2pinname[self.boardName]:
-                    dirname = testdir + "pio" + key[1:]
-                    if not os.path.exists(dirname):
-                        os.makedirs(dirname)
-                        fh = open(dirname + "/value", 'w')
-                        fh.write(val)
-                        fh.close()
-            else:
-                for key in AB.pin2kid.keys():
-                    for elem in connector_name[self.boardName]:
-                        if key.startswith(elem):
-                            dirname = testdir + "pio" + key[1:]
-                            if not os.path.exists(dirname):
-                                os.makedirs(dirname)
-                                fh = open(dirname + "/value", 'w')
-                                fh.write(val)
-                                fh.close()                
-            fh = open(testdir + "export", 'w')
-            fh.close()
-            fh = open(testdir + "unexport", 'w')
-            fh.close()
-            # end for developers only
+        virtual = (backend == BACKEND_VIRTUAL)
+        if AB is None and not virtual:
+            raise S4AHException("ablib not installed: only the virtual backend can be used")
 
         try:
             # check the correct version of ablib
-            test_version = AB.getVersion()
-            if test_version:
-                pass
+            if AB is not None:
+                test_version = AB.getVersion()
         except AttributeError, e:
             message = "Not supported ablib version " + str(e)
             raise S4AHException (message)
@@ -132,55 +383,232 @@ class GPIOController:
         self.piRevision = self.getRevision()
         logger.debug("Board Revision %s", self.piRevision)
 
-        # map the pinname to mcuName creating the reverse map of the ablib
-        # mcuName2pinname dict: this is needed to store in PinData the mcuName
-        # inv_map = {v:k for k, v in AB.mcuName2pinname[self.boardName].items()}
-
-        # read from ablib the available pins
-        if self.boardName != 'Aria_G25':
-            for key in AB.mcuName2pinname[self.boardName].keys():
-                self.ValidPins[key] = PinData(None, key)
-                logging.debug ("Configured pin %s", self.ValidPins[key])
+        # the available pins as read from ablib, usually from the cache. The
+        # virtual backend can also make up a board of virtualPins pins
+        if virtual and (virtualPins or AB is None):
+            import s4ah_VirtualGPIO
+            self.boardDescriptor = s4ah_VirtualGPIO.virtualBoardDescriptor(
+                virtualPins or s4ah_VirtualGPIO.DEFAULT_PINS)
+            self.descriptorCached = False
         else:
-            #Aria G25 has the pin name already ok in pin2kid dictionary of ablib
-            for key in AB.pin2kid.keys():
-                for elem in connector_name[self.boardName]:
-                    if key.startswith(elem):
-                        self.ValidPins[key] = PinData(None, key)
-                        logging.debug ("Configured pin %s", self.ValidPins[key])
+            (self.boardDescriptor, self.descriptorCached) = loadBoardDescriptor(self.boardName, cacheDir)
+        logger.debug("%d pins of board %s%s", len(self.boardDescriptor), self.boardName,
+                     " (cached)" if self.descriptorCached else "")
 
+        if offline and not virtual:
+            # for developers only: this is only for testing offline with
+            # an ablib modified to write on /tmp instead of real /sys area
+            testdir = OFFLINE_SYSFS_GPIO
+            if not os.path.exists(testdir):
+                os.makedirs(testdir)
+            for entry in self.boardDescriptor:
+                self.createOfflinePin(testdir + "pio" + entry[0][1:])
+            fh = open(testdir + "export", 'w')
+            fh.close()
+            fh = open(testdir + "unexport", 'w')
+            fh.close()
+            # end for developers only
+
+        # dense pin table in name order (the descriptor is sorted) and the
+        # name -> index map with the usual spellings of each name (exact,
+        # upper and lower case)
+        self.pinTable = []
+        self.pinIndex = {}
+        for (key, kernelId, label, caps) in self.boardDescriptor:
+            pin = PinData(None, key, len(self.pinTable), kernelId)
+            self.ValidPins[key] = pin
+            self.pinTable.append(pin)
+            for name in (key, key.upper(), key.lower()):
+                self.pinIndex[name] = pin.index
         self.numOfValidPins = len(self.ValidPins)
+        # the ADC monitor of the analog pins added by addAnalogPins
+        self.analog = None
+        # PWM channels of the board pins, the PWMOutputs created at the first use
+        self.pwmChannels = pwm_channel.get(self.boardName, {})
+        self.pwm = None
+
+        if backend == BACKEND_SYSFS:
+            self.backend = SysfsBackend(self, offline)
+        elif backend == BACKEND_GPIOCHIP:
+            import s4ah_GPIOChip
+            self.backend = s4ah_GPIOChip.GPIOChipBackend(self, offline)
+        elif virtual:
+            import s4ah_VirtualGPIO
+            self.backend = s4ah_VirtualGPIO.VirtualBackend(self)
+        else:
+            raise S4AHException("unknown GPIO backend " + str(backend))
+        logger.debug("GPIO backend %s", backend)
         # End init
 
 
+    def addAnalogPins(self, channels):
+        """
+        add the analog pins (name, channel number) after the GPIO ones: they
+        are never passed to the GPIO backend, their modes are applied by
+        self.analog. Return their PinData
+        """
+        pins = []
+        for (name, number) in channels:
+            pin = PinData(None, name, len(self.pinTable), number)
+            pin.analog = True
+            self.ValidPins[name] = pin
+            self.pinTable.append(pin)
+            for alias in (name, name.upper(), name.lower()):
+                self.pinIndex[alias] = pin.index
+            pins.append(pin)
+        self.numOfValidPins = len(self.ValidPins)
+        return pins
+
+
+    def lookupPin(self, pinName):
+        """
+        return the PinData of the pin name in any case, None if unknown
+        """
+        index = self.pinIndex.get(pinName)
+        if index is None:
+            index = self.pinIndex.get(pinName.upper())
+            if index is None:
+                return None
+        return self.pinTable[index]
+
+
+    def createOfflinePin(self, dirname):
+        """
+        for developers only: create the fake sysfs files of a single pin
+        """
+        if os.path.exists(dirname + "/edge"):
+            return
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+            fh = open(dirname + "/value", 'w')
+            fh.write('0')
+            fh.close()
+        if not os.path.exists(dirname + "/edge"):
+            fh = open(dirname + "/edge", 'w')
+            fh.write(EDGE_NONE)
+            fh.close()
+
+
+    def notifyModeChange(self, pins):
+        """
+        update the INPUT index with the pins whose mode changed and inform
+        the listeners (e.g. the edge monitor): during a bulk change only
+        once, at its end
+        """
+        for pin in pins:
+            if pin.mode == PINPUT and not pin.analog:
+                if pin.index not in self.inputIndex:
+                    self.inputIndex[pin.index] = pin
+                    self.inputsChanged = True
+            elif self.inputIndex.pop(pin.index, None) is not None:
+                self.inputsChanged = True
+        if self.bulkDepth:
+            self.bulkChanged = True
+            return
+        if self.inputsChanged:
+            self.inputsChanged = False
+            self.inputPins = [self.inputIndex[index] for index in sorted(self.inputIndex)]
+        for listener in self.modeListeners:
+            listener()
+
+
+    def beginBulk(self):
+        """
+        start changing the modes of many pins: to be closed by endBulk()
+        """
+        self.bulkDepth += 1
+
+
+    def endBulk(self):
+        self.bulkDepth -= 1
+        if self.bulkDepth == 0 and self.bulkChanged:
+            self.bulkChanged = False
+            self.notifyModeChange(())
+
+
+    def pinPath(self, pinName):
+        """
+        return the sysfs directory of the pin
+        """
+        return self.sysfsRoot + "pio" + self.ValidPins[pinName].name[1:]
+
+
+    def setPinEdge(self, pinName, edge):
+        """
+        configure the sysfs edge attribute of the pin (EDGE_NONE or EDGE_BOTH).
+        Return False if the pin doesn't support edges
+        """
+        pin = self.lookupPin(pinName)
+        if pin is None:
+            logger.error("setPinEdge: unknown pin %s", pinName)
+            return False
+        pinName = pin.name
+
+        if not self.backend.supportsEdge:
+            return False
+
+        try:
+            with open(self.pinPath(pinName) + "/edge", 'w') as fh:
+                fh.write(edge)
+        except IOError, e:
+            logger.debug("pin %s doesn't support edge %s: %s", pinName, edge, e)
+            pin.edge = False
+            return False
+
+        pin.edge = (edge != EDGE_NONE)
+        logger.debug("pin %s edge set to %s", pinName, edge)
+        return True
+
+
+    def clearPinEdge(self, pinName):
+        """
+        remove the edge configuration: the kernel refuses to switch
+        to output a pin with a configured edge
+        """
+        if self.ValidPins[pinName].edge:
+            self.setPinEdge(pinName, EDGE_NONE)
+
+
     def resetAllPins(self):
         """
         reset all pins
         """
         logger.debug("resetting all pins")
-        for key in self.ValidPins:
-            if self.ValidPins[key].mode != PUNUSED:
-                self.resetPin(self.ValidPins[key].name)
+        self.beginBulk()
+        try:
+            for pin in self.pinTable:
+                if pin.mode != PUNUSED:
+                    self.resetPin(pin.name)
+        finally:
+            self.endBulk()
 
 
     def resetPin(self, pinName):
         """
         reset all pins
         """
-        pinName = pinName.upper()
-        if pinName not in self.ValidPins.keys():
+        pin = self.lookupPin(pinName)
+        if pin is None:
             logger.error("unknown pin %s", pinName)
             return
+        pinName = pin.name
 
-        if  self.ValidPins[pinName].mode != PUNUSED:
+        if  pin.mode != PUNUSED:
             # set the default mode to OUTPUT: INPUT mode with trigger
             # should start one thread for each pin
-            self.ValidPins[pinName].instance = None
-            AB.Pin(pinName, POUTPUT)
-            self.ValidPins[pinName].mode = PUNUSED
-            self.ValidPins[pinName].value = PNONE
-            self.ValidPins[pinName].invert = False
+            self.clearPinEdge(pinName)
+            if pin.analog:
+                pin.mode = PUNUSED
+                self.analog.setMode(pin, PUNUSED)
+            elif pin.mode == PPWM:
+                self.releasePwm(pin)
+            else:
+                self.backend.release(pin)
+                pin.mode = PUNUSED
+            pin.value = PNONE
+            pin.invert = False
             logger.debug("reset pin %s", pinName)
+            self.notifyModeChange((pin,))
 
 
     def setAllPins(self, mode):
@@ -188,26 +616,47 @@ class GPIOController:
         set all pins with the passed mode
         """
         logger.debug("setting all pins to %s", mode)
-        for key in self.ValidPins:
-            self.setPinMode(self.ValidPins[key].name, mode)
+        self.beginBulk()
+        try:
+            for pin in self.pinTable:
+                if not pin.analog:
+                    self.setPinMode(pin.name, mode)
+        finally:
+            self.endBulk()
 
 
     def setPinMode(self, pinName, mode):
         """
         set pin mode for a single pin
         """
-        pinName = pinName.upper()
-        if pinName not in self.ValidPins.keys():
+        pin = self.lookupPin(pinName)
+        if pin is None:
             logger.error("setPinMode: unknown pin %s", pinName)
             return
+        pinName = pin.name
             
-        if self.ValidPins[pinName].mode == mode:
+        if pin.mode == mode:
             logger.debug("pin mode not changed: do nothing")
             return
 
-        self.ValidPins[pinName].mode = mode
-        AB.Pin(pinName, mode)
+        if pin.analog:
+            if mode == POUTPUT:
+                logger.error("setPinMode: %s is an analog input", pinName)
+                return
+            pin.mode = mode
+            self.analog.setMode(pin, mode)
+            logger.debug("pin %s set to %s mode", pinName, mode)
+            self.notifyModeChange((pin,))
+            return
+
+        if pin.mode == PPWM:
+            self.releasePwm(pin)
+        if mode != PINPUT:
+            self.clearPinEdge(pinName)
+        pin.mode = mode
+        self.backend.setMode(pin, mode)
         logger.debug("pin %s set to %s mode", pinName, mode)
+        self.notifyModeChange((pin,))
 
 
     def isNumeric(self, s):
@@ -227,37 +676,53 @@ class GPIOController:
         from ablib and stored in ValidPins or it has to be into the available MCU names (also read from ablib)
         """
 
-        pinName = pinName.upper()
-        if pinName not in self.ValidPins.keys():
+        pin = self.lookupPin(pinName)
+        if pin is None:
             logger.error("unknown pin %s", pinName)
             return
+        pinName = pin.name
+        if pin.analog:
+            logger.error("pin %s is an analog input: it can't be written", pinName)
+            return
 
-        if self.ValidPins[pinName].value == value:
-            logger.debug("pin %s value %s not changed: do nothing", pinName, value)
+        # the debug messages are built only when needed: this is a hot path
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if pin.value == value:
+            if debug:
+                logger.debug("pin %s value %s not changed: do nothing", pinName, value)
             return
-        else:
-            logger.debug("update pin:%s value:%s use:%s to value:%s", pinName, self.ValidPins[pinName].value, self.ValidPins[pinName].mode, value)
+        elif debug:
+            logger.debug("update pin:%s value:%s use:%s to value:%s", pinName, pin.value, pin.mode, value)
 
          #if not self.isNumeric(value):
              #logger.error("Value %s not admitted: pin %s unchanged", value, pinName)
              #return
 
+        start = time.time()
         try:
-            logger.debug("pin %s commanded to be %s", pinName, value)
-            if self.ValidPins[pinName].invert: # is True: Invert data value (useful for 7 segment common anode displays)
+            if debug:
+                logger.debug("pin %s commanded to be %s", pinName, value)
+            if pin.invert: # is True: Invert data value (useful for 7 segment common anode displays)
                 value = 1 - abs(value)
-            if self.ValidPins[pinName].mode == POUTPUT: # if already in output
-                self.ValidPins[pinName].value = value
-                self.ValidPins[pinName].instance.set_value(value) # set output to 1 or 0
-                logger.debug("pin %s set to %s", pinName, value)
-
-            elif self.ValidPins[pinName].mode in [PUNUSED, PINPUT]: # if pin is in input or not used
-                old_mode = self.ValidPins[pinName].mode;
-                self.ValidPins[pinName].mode = POUTPUT # switch it to output
-                self.ValidPins[pinName].instance = AB.Pin(pinName, POUTPUT)
-                self.ValidPins[pinName].value = value
-                self.ValidPins[pinName].instance.set_value(value) # set output to 1 to 0
+            if pin.mode == POUTPUT: # if already in output
+                pin.value = value
+                self.backend.write(pin, value) # set output to 1 or 0
+                recordPinUpdate(start)
+                if debug:
+                    logger.debug("pin %s set to %s", pinName, value)
+
+            elif pin.mode in [PUNUSED, PINPUT, PPWM]: # if pin is in input, not used or pwm
+                old_mode = pin.mode;
+                if pin.mode == PPWM:
+                    self.releasePwm(pin)
+                self.clearPinEdge(pinName)
+                pin.mode = POUTPUT # switch it to output
+                self.backend.setMode(pin, POUTPUT)
+                pin.value = value
+                self.backend.write(pin, value) # set output to 1 to 0
+                recordPinUpdate(start)
                 logger.debug("pin %s was %s - now output to value %s", pinName, old_mode, value)
+                self.notifyModeChange((pin,))
 
         except ValueError:
             logger.error("Error trying to update pin %s to value %s", pinName, value)
@@ -273,26 +738,199 @@ class GPIOController:
         from ablib and stored in ValidPins or it has to be into the available MCU names (also read from ablib)
         """
 
-        pinName = pinName.upper()
-        if pinName not in self.ValidPins.keys():
+        pin = self.lookupPin(pinName)
+        if pin is None:
             logger.error("pinRead: unknown pin %s", pinName)
             return
+        pinName = pin.name
+        if pin.analog:
+            # the last averaged value
+            return pin.value
 
         try:
-            return AB.get_value(self.ValidPins[pinName].kernelId)
+            start = time.time()
+            value = self.backend.read(pin)
+            recordPinRead(start)
+            return value
         except Exception, e:
             logger.error("Error reading pin %s: %s", pinName, str(e))
             return 0
 
+    def readInputs(self, pins=None):
+        """
+        read all the pins in INPUT mode (or the passed PinData) at once: return
+        a list of (PinData, value). Depending on the backend this costs a
+        syscall for each pin or for each PIO bank. The backends leave out the
+        pins (or banks) they can't read: the exception is a last resort
+        """
+        if pins is None:
+            pins = self.inputPins
+        if not pins:
+            return []
+        try:
+            start = time.time()
+            values = self.backend.readInputs(pins)
+            recordSweep(start)
+            return values
+        except Exception, e:
+            logger.error("Error reading input pins: %s", str(e))
+            return []
+
+    def definePinGroup(self, groupName, pinNames):
+        """
+        define (or redefine) the group groupName with the passed pins: the
+        first pin is the least significant bit of the group value.
+        Return False if a pin is unknown
+        """
+        pinNames = [pinName.strip() for pinName in pinNames if pinName.strip()]
+        unknown = [pinName for pinName in pinNames
+                   if self.lookupPin(pinName) is None or self.lookupPin(pinName).analog]
+        pins = [self.lookupPin(pinName).name for pinName in pinNames if pinName not in unknown]
+        if not pins or unknown:
+            logger.error("definePinGroup: group %s with unknown or analog pins %s", groupName, unknown)
+            return False
+        if self.pinGroups.get(groupName.lower()) == pins:
+            return True
+        self.pinGroups[groupName.lower()] = pins
+        self.groupsVersion += 1
+        logger.debug("pin group %s defined as %s", groupName, pins)
+        return True
+
+
+    def groupUpdate(self, groupName, value):
+        """
+        set the pins of the group to the bits of value (bit i to the pin i).
+        Only the pins whose value changed are written, switched to OUTPUT
+        when needed and then written in a single batch: the backend can
+        group the writes by PIO bank
+        """
+        pins = self.pinGroups.get(groupName.lower())
+        if pins is None:
+            logger.error("unknown pin group %s", groupName)
+            return
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            logger.error("Error trying to update pin group %s to value %s", groupName, value)
+            return
+        if value < 0 or value >> len(pins):
+            logger.error("Value %s out of range for pin group %s", value, groupName)
+            return
+
+        start = time.time()
+        changes = []
+        modeChanged = []
+        try:
+            for (i, pinName) in enumerate(pins):
+                pin = self.ValidPins[pinName]
+                bit = (value >> i) & 1
+                if pin.invert:
+                    bit = 1 - bit
+                if pin.mode == POUTPUT and pin.value == bit:
+                    continue
+                if pin.mode != POUTPUT:
+                    if pin.mode == PPWM:
+                        self.releasePwm(pin)
+                    self.clearPinEdge(pinName)
+                    pin.mode = POUTPUT
+                    self.backend.setMode(pin, POUTPUT)
+                    modeChanged.append(pin)
+                pin.value = bit
+                changes.append((pin, bit))
+            if changes:
+                self.backend.writeMany(changes)
+                recordGroupUpdate(start)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("pin group %s set to %s: %d pins written", groupName, value, len(changes))
+        except IOError, e:
+            logger.error("Unable to access pin group %s: %s", groupName, e)
+        if modeChanged:
+            self.notifyModeChange(modeChanged)
+
+
+    def pwmPin(self, pinName, caller):
+        """
+        the PinData of a pin with a PWM channel, switched to PWM mode:
+        None (and the error logged) if it has none
+        """
+        pin = self.lookupPin(pinName)
+        if pin is None or pin.name not in self.pwmChannels:
+            logger.error("%s: pin %s has no PWM channel on board %s", caller, pinName, self.boardName)
+            return None
+        if self.pwm is None:
+            import s4ah_PWM
+            self.pwm = s4ah_PWM.PWMOutputs(self, self.pwmChannels, self.offline)
+        return pin
+
+
+    def pwmUpdate(self, pinName, duty):
+        """
+        drive the pin by its PWM channel with duty cycle duty (percent):
+        only the values changed are written, the pin is switched to PWM
+        mode by the first update
+        """
+        pin = self.pwmPin(pinName, "pwmUpdate")
+        if pin is None:
+            return
+        if not 0 <= duty <= 100:
+            logger.error("duty cycle %s of pin %s out of range 0-100", duty, pin.name)
+            return
+        modeChanged = False
+        if pin.mode != PPWM:
+            self.clearPinEdge(pin.name)
+            if pin.mode != PUNUSED:
+                # not released to OUTPUT: the GPIO would drive the pin
+                self.backend.unexport(pin)
+            pin.mode = PPWM
+            pin.value = PNONE
+            modeChanged = True
+        try:
+            start = time.time()
+            self.pwm.setDuty(pin.name, duty)
+            recordPinUpdate(start)
+        except (IOError, OSError), e:
+            logger.error("Unable to drive pin %s by pwm: %s", pin.name, e)
+        if modeChanged:
+            logger.debug("pin %s set to %s mode", pin.name, PPWM)
+            self.notifyModeChange((pin,))
+
+
+    def pwmSetPeriod(self, pinName, period):
+        """
+        period (usecs) of the PWM of the pin, applied at once if running
+        """
+        pin = self.pwmPin(pinName, "pwmSetPeriod")
+        if pin is None:
+            return
+        if math.isnan(period) or math.isinf(period):
+            logger.error("invalid pwm period %s of pin %s", period, pin.name)
+            return
+        import s4ah_PWM
+        periodNs = int(period * 1000)
+        if periodNs < s4ah_PWM.MIN_PERIOD:
+            logger.error("pwm period %s of pin %s too short", period, pin.name)
+            return
+        try:
+            self.pwm.setPeriod(pin.name, periodNs)
+        except (IOError, OSError), e:
+            logger.error("Unable to set the pwm period of pin %s: %s", pin.name, e)
+
+
+    def releasePwm(self, pin):
+        """
+        stop the PWM of the pin, left NOTUSED
+        """
+        self.pwm.release(pin.name)
+        pin.mode = PUNUSED
+
+
     def setPinInvert(self, pinName, state=False):
         """
         invert the logic
         """
-        pinName = pinName.upper()
-        try:
-            self.ValidPins[pinName].invert = state
-        except ValueError, e:
-            pass
+        pin = self.lookupPin(pinName)
+        if pin is not None:
+            pin.invert = state
 
     def setAllInvert(self, state=False):
         """
@@ -310,8 +948,13 @@ class GPIOController:
             logger.error("Invalid value %s: pins unchanged", value)
             return
 
-        for key in self.ValidPins:
-            self.pinUpdate(self.ValidPins[key].name, value)
+        self.beginBulk()
+        try:
+            for pin in self.pinTable:
+                if not pin.analog:
+                    self.pinUpdate(pin.name, value)
+        finally:
+            self.endBulk()
 
 #### End of main program
 
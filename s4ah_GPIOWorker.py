@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+#s4ah_GPIOWorker - GPIO access by a separate process for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# With --gpioworker the GPIO backend runs in a forked process with its own
+# interpreter: the handler keeps the controller (modes, values, groups) and
+# its backend becomes a WorkerBackend, which sends the mode changes and the
+# writes as fixed size records through a pipe and reads the INPUT pins from
+# a shared memory map where the worker publishes them, without syscalls.
+# Each pin has a slot (sequence, generation, value): the sequence is odd
+# while the worker writes the slot (seqlock), the generation tells the
+# values read after the last mode change of the pin from the stale ones.
+
+
+import os
+import mmap
+import time
+import errno
+import select
+import signal
+import struct
+import logging
+import s4ah_GPIOController as S4AH
+import s4ah_Stats as S4AH_ST
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+# seconds between two reads of the INPUT pins by the worker, as the
+# fastest poll of the PollScheduler
+SAMPLE_INTERVAL = 0.005
+STOP_TIMEOUT = 2.0          # seconds the worker has to reset its pins at exit
+
+# command records: operation, pin index, argument
+OP_MODE = 1                 # argument: mode code << 24 | generation
+OP_RELEASE = 2              # argument: generation
+OP_WRITE = 3                # argument: value
+OP_UNEXPORT = 4             # argument: generation
+RECORD = struct.Struct('=BHi')
+RECORDS_PER_WRITE = select.PIPE_BUF // RECORD.size    # a pipe write up to PIPE_BUF is atomic
+
+SLOT = struct.Struct('=IIi')
+SEQUENCE = struct.Struct('=I')
+DATA = struct.Struct('=Ii')     # generation, value after the sequence
+UNSAMPLED = -1
+GENERATION_MASK = 0xffffff
+
+MODES = [S4AH.PUNUSED, S4AH.POUTPUT, S4AH.PINPUT]
+MODE_CODES = dict((mode, code) for (code, mode) in enumerate(MODES))
+
+
+class SharedPins:
+    """
+    The pin slots in an anonymous shared map, inherited by the worker at the fork
+    """
+    def __init__(self, numPins):
+        self.map = mmap.mmap(-1, max(numPins, 1) * SLOT.size)
+        for index in xrange(numPins):
+            SLOT.pack_into(self.map, index * SLOT.size, 0, 0, UNSAMPLED)
+
+    def publish(self, index, generation, value):
+        """
+        run by the worker, the only writer: the odd sequence, the data, the
+        even sequence, each copied at once (pack_into would clear the bytes
+        before writing them, a reader could take the zeros for a slot)
+        """
+        offset = index * SLOT.size
+        sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+        self.map[offset:offset + SEQUENCE.size] = SEQUENCE.pack((sequence + 1) & 0xffffffff)
+        self.map[offset + SEQUENCE.size:offset + SLOT.size] = DATA.pack(generation, value)
+        self.map[offset:offset + SEQUENCE.size] = SEQUENCE.pack((sequence + 2) & 0xffffffff)
+
+    def read(self, index):
+        """
+        (generation, value) of the pin, retried while the worker writes it
+        """
+        offset = index * SLOT.size
+        while True:
+            sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+            if sequence & 1:
+                continue
+            data = DATA.unpack_from(self.map, offset + SEQUENCE.size)
+            if SEQUENCE.unpack_from(self.map, offset)[0] == sequence:
+                return data
+
+    def close(self):
+        self.map.close()
+
+
+class WorkerBackend:
+    """
+    Backend of the handler process in front of the worker: the commands are
+    queued in the pipe (the caller never waits for the GPIO), the reads
+    return the latest values published by the worker. An INPUT pin not yet
+    read by the worker since its mode change is left out of readInputs
+    """
+    supportsEdge = False
+
+    def __init__(self, controller, shared, commandFd, pid):
+        self.controller = controller
+        self.shared = shared
+        self.commandFd = commandFd
+        self.pid = pid
+        self.generations = [0] * len(controller.pinTable)
+
+    def send(self, data):
+        try:
+            os.write(self.commandFd, data)
+        except (OSError, TypeError), e:
+            # TypeError: the worker is already closed
+            raise IOError("GPIO worker not running: %s" % e)
+
+    def nextGeneration(self, pin):
+        generation = (self.generations[pin.index] + 1) & GENERATION_MASK
+        self.generations[pin.index] = generation
+        return generation
+
+    def setMode(self, pin, mode):
+        generation = self.nextGeneration(pin)
+        self.send(RECORD.pack(OP_MODE, pin.index, MODE_CODES[mode] << 24 | generation))
+
+    def release(self, pin):
+        self.send(RECORD.pack(OP_RELEASE, pin.index, self.nextGeneration(pin)))
+
+    def unexport(self, pin):
+        self.send(RECORD.pack(OP_UNEXPORT, pin.index, self.nextGeneration(pin)))
+
+    def write(self, pin, value):
+        self.send(RECORD.pack(OP_WRITE, pin.index, int(value)))
+
+    def writeMany(self, changes):
+        """
+        the worker applies them with a single writeMany of its backend
+        """
+        records = [RECORD.pack(OP_WRITE, pin.index, int(value)) for (pin, value) in changes]
+        for start in xrange(0, len(records), RECORDS_PER_WRITE):
+            self.send(b''.join(records[start:start + RECORDS_PER_WRITE]))
+
+    def sample(self, pin):
+        (generation, value) = self.shared.read(pin.index)
+        if generation != self.generations[pin.index] or value == UNSAMPLED:
+            return None
+        return value
+
+    def read(self, pin):
+        value = self.sample(pin)
+        if value is None:
+            return pin.value if pin.value != S4AH.PNONE else 0
+        return value
+
+    def readInputs(self, pins):
+        values = []
+        for pin in pins:
+            value = self.sample(pin)
+            if value is not None:
+                values.append((pin, value))
+        return values
+
+    def close(self):
+        """
+        the worker resets its pins when the pipe is closed
+        """
+        if self.commandFd is None:
+            return
+        os.close(self.commandFd)
+        self.commandFd = None
+        deadline = time.time() + STOP_TIMEOUT
+        while not os.waitpid(self.pid, os.WNOHANG)[0]:
+            if time.time() > deadline:
+                logger.error("GPIO worker %d not stopping: killed", self.pid)
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+                break
+            time.sleep(0.010)
+        self.shared.close()
+        logger.debug("GPIO worker %d stopped", self.pid)
+
+
+class Worker:
+    """
+    The loop of the worker process: apply the commands of the pipe with the
+    real backend and read the INPUT pins every interval
+    """
+    def __init__(self, controller, shared, commandFd, interval=SAMPLE_INTERVAL):
+        self.controller = controller
+        self.backend = controller.backend
+        self.shared = shared
+        self.commandFd = commandFd
+        self.interval = interval
+        self.generations = [0] * len(controller.pinTable)
+        self.inputPins = []
+        self.inputIndex = {}    # pin index -> PinData of the INPUT pins
+        self.published = {}     # pin index -> value published
+
+    def modeChanged(self, pin, mode, generation):
+        pin.mode = mode
+        self.generations[pin.index] = generation
+        self.published.pop(pin.index, None)
+        self.shared.publish(pin.index, generation, UNSAMPLED)
+        if mode == S4AH.PINPUT and not pin.analog:
+            self.inputIndex[pin.index] = pin
+        else:
+            self.inputIndex.pop(pin.index, None)
+
+    def apply(self, data):
+        """
+        run the records of data: the consecutive writes are passed together
+        """
+        pinTable = self.controller.pinTable
+        changes = []
+        modesChanged = False
+        for offset in xrange(0, len(data), RECORD.size):
+            (op, index, argument) = RECORD.unpack_from(data, offset)
+            pin = pinTable[index]
+            if op == OP_WRITE:
+                pin.value = argument
+                changes.append((pin, argument))
+                continue
+            self.flush(changes)
+            changes = []
+            modesChanged = True
+            try:
+                if op == OP_MODE:
+                    mode = MODES[argument >> 24]
+                    self.modeChanged(pin, mode, argument & GENERATION_MASK)
+                    self.backend.setMode(pin, mode)
+                elif op == OP_RELEASE:
+                    self.modeChanged(pin, S4AH.PUNUSED, argument)
+                    self.backend.release(pin)
+                elif op == OP_UNEXPORT:
+                    self.modeChanged(pin, S4AH.PUNUSED, argument)
+                    self.backend.unexport(pin)
+            except (IOError, OSError), e:
+                logger.error("GPIO worker: unable to configure pin %s: %s", pin.name, e)
+        self.flush(changes)
+        if modesChanged:
+            # once for all the mode changes read together (e.g. configall)
+            self.inputPins = [self.inputIndex[index] for index in sorted(self.inputIndex)]
+
+    def flush(self, changes):
+        if not changes:
+            return
+        try:
+            self.backend.writeMany(changes)
+        except (IOError, OSError), e:
+            logger.error("GPIO worker: unable to write pins %s: %s", [pin.name for (pin, value) in changes], e)
+
+    def sample(self):
+        try:
+            values = self.backend.readInputs(self.inputPins)
+        except (IOError, OSError), e:
+            logger.error("GPIO worker: error reading input pins: %s", e)
+            return
+        for (pin, value) in values:
+            if self.published.get(pin.index) != value:
+                self.published[pin.index] = value
+                self.shared.publish(pin.index, self.generations[pin.index], value)
+
+    def run(self):
+        logger.debug("GPIO worker running as process %d ...", os.getpid())
+        pending = b''
+        nextSample = S4AH_ST.monotonic()
+        while True:
+            timeout = None
+            if self.inputPins:
+                timeout = max(nextSample - S4AH_ST.monotonic(), 0)
+            try:
+                ready = select.select([self.commandFd], [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if ready:
+                data = os.read(self.commandFd, RECORDS_PER_WRITE * RECORD.size)
+                if not data:
+                    break       # the handler closed the pipe (or is gone)
+                pending += data
+                complete = len(pending) - len(pending) % RECORD.size
+                self.apply(pending[:complete])
+                pending = pending[complete:]
+            now = S4AH_ST.monotonic()
+            if self.inputPins and now >= nextSample:
+                self.sample()
+                nextSample = max(nextSample + self.interval, now)
+        # the pins left used by a handler that didn't reset them
+        for pin in self.controller.pinTable:
+            if pin.mode != S4AH.PUNUSED and not pin.analog:
+                try:
+                    self.backend.release(pin)
+                except (IOError, OSError), e:
+                    logger.error("GPIO worker: unable to release pin %s: %s", pin.name, e)
+        self.backend.close()
+        logger.debug("GPIO worker stopped")
+
+
+def start(controller, afterFork=None, interval=SAMPLE_INTERVAL):
+    """
+    fork the worker with the current backend of the controller, which then
+    uses the returned WorkerBackend. To be called before starting threads:
+    afterFork() runs first in the worker (e.g. to set up the logging)
+    """
+    shared = SharedPins(len(controller.pinTable))
+    (readFd, writeFd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(writeFd)
+            # Ctrl-C reaches the whole process group: the handler stops the worker
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if afterFork is not None:
+                afterFork()
+            Worker(controller, shared, readFd, interval).run()
+        except Exception:
+            logger.exception("GPIO worker failed")
+            status = 1
+        os._exit(status)
+    os.close(readFd)
+    controller.backend = WorkerBackend(controller, shared, writeFd, pid)
+    logger.debug("GPIO worker started as process %d", pid)
+    return controller.backend
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+#s4ah_I2C - polling of the I2C sensors of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# The sensors are declared in a file (--i2c option), one line for each
+# Scratch sensor:
+#   NAME BUS ADDRESS REGISTER FORMAT [SCALE [OFFSET [MSECS]]]
+#   temperature 0 0x48 0x00 >h>>4 0.0625       # 12 bits, 1/16 degree
+#   light       0 0x23 -    >H    0.8333 0 200 # no register: plain read
+#   accx        1 0x53 0x32 <h    0.0039 0 50
+# FORMAT is a struct format (b B h H i I, < little or > big endian) with an
+# optional right shift; the value sent is raw * SCALE + OFFSET, read every
+# MSECS (default 100). A line
+#   init BUS ADDRESS REGISTER BYTE...
+# writes the bytes to the register at start (e.g. to power on a device).
+# The registers of a device read at the same rate are merged in ranges, and
+# all the ranges of a bus read at the same rate are read by one I2C_RDWR
+# ioctl: a write of the register and a read of the range for each.
+
+
+import os
+import time
+import array
+import errno
+import fcntl
+import struct
+import logging
+import threading
+import s4ah_Stats as S4AH_ST
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+# from linux/i2c-dev.h and linux/i2c.h
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+I2C_RDWR_IOCTL_MAX_MSGS = 42
+# struct i2c_msg: addr, flags, len, buf pointer; struct i2c_rdwr_ioctl_data: msgs pointer, nmsgs
+MSG_FMT = '@HHHP'
+MSG_SIZE = struct.calcsize(MSG_FMT)
+RDWR_FMT = '@PI'
+
+DEV_I2C = '/dev/i2c-%d'
+# for developers only: the registers of the fake devices are the 256 bytes
+# of the files i2c-BUS-0xADDRESS, a missing file is a device not answering
+OFFLINE_I2C = '/tmp/i2c/'
+
+DEFAULT_PERIOD = 0.1      # seconds between two reads of a sensor
+MAX_RANGE = 32            # bytes read together from the registers of a device
+DECIMALS = 4
+
+FORMATS = 'bBhHiI'
+
+recordI2C = S4AH_ST.stats.recorder('i2c')
+
+
+class I2CError(Exception):
+    pass
+
+
+def newBuffer(size):
+    """
+    zeroed buffer at a stable address: the kernel writes the read bytes there
+    """
+    return array.array('B', [0] * size)
+
+
+class I2CBus:
+    """
+    Access to a real /dev/i2c-N adapter
+    """
+    def __init__(self, number):
+        self.number = number
+        self.fd = self.open()
+
+    def open(self):
+        return os.open(DEV_I2C % self.number, os.O_RDWR)
+
+    def ioctl(self, request, arg):
+        fcntl.ioctl(self.fd, request, arg)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FakeI2CBus(I2CBus):
+    """
+    Stand-in of an adapter used in offline mode: it decodes the same
+    i2c_msg structures the kernel receives, the devices are register
+    files under root that a test can change while the handler runs
+    """
+    def __init__(self, number, root=OFFLINE_I2C):
+        self.root = root
+        self.pointers = {}     # address -> register pointer set by the last write
+        self.ioctls = 0
+        I2CBus.__init__(self, number)
+
+    def open(self):
+        return None
+
+    def close(self):
+        pass
+
+    def devicePath(self, address):
+        return os.path.join(self.root, 'i2c-%d-0x%02x' % (self.number, address))
+
+    def ioctl(self, request, arg):
+        import ctypes
+        if request != I2C_RDWR:
+            raise IOError(errno.ENOTTY, "unknown ioctl")
+        self.ioctls += 1
+        (msgs, count) = struct.unpack(RDWR_FMT, arg)
+        raw = ctypes.string_at(msgs, count * MSG_SIZE)
+        # the reads advance the pointer within the transaction only: a
+        # device without registers gives the same bytes to each plain read
+        pointers = {}
+        for i in xrange(count):
+            (address, flags, length, buf) = struct.unpack_from(MSG_FMT, raw, i * MSG_SIZE)
+            path = self.devicePath(address)
+            if not os.path.exists(path):
+                raise IOError(errno.ENXIO, "no device at 0x%02x" % address)
+            pointer = pointers.get(address, self.pointers.get(address, 0))
+            if flags & I2C_M_RD:
+                with open(path, 'rb') as fh:
+                    fh.seek(pointer)
+                    data = fh.read(length)
+                data += b'\0' * (length - len(data))
+                ctypes.memmove(buf, data, length)
+                pointer += length
+            else:
+                data = ctypes.string_at(buf, length)
+                if data:
+                    pointer = ord(data[0])
+                    if len(data) > 1:
+                        with open(path, 'r+b') as fh:
+                            fh.seek(pointer)
+                            fh.write(data[1:])
+                        pointer += len(data) - 1
+                    self.pointers[address] = ord(data[0])
+            pointers[address] = pointer & 0xff
+
+
+class Transaction:
+    """
+    I2C messages packed once and sent by a single I2C_RDWR ioctl at each
+    poll: the read bytes are found in buffers
+    """
+    def __init__(self, messages):
+        """
+        messages: list of (address, bytes to write) or (address, length to read)
+        """
+        if len(messages) > I2C_RDWR_IOCTL_MAX_MSGS:
+            raise I2CError("%d messages in a transaction" % len(messages))
+        self.buffers = []
+        self.msgs = newBuffer(MSG_SIZE * len(messages))
+        for (i, (address, payload)) in enumerate(messages):
+            if isinstance(payload, int):
+                (flags, buf) = (I2C_M_RD, newBuffer(payload))
+            else:
+                (flags, buf) = (0, array.array('B', payload))
+            struct.pack_into(MSG_FMT, self.msgs, i * MSG_SIZE, address, flags, len(buf), buf.buffer_info()[0])
+            self.buffers.append(buf)
+        self.arg = struct.pack(RDWR_FMT, self.msgs.buffer_info()[0], len(messages))
+
+    def run(self, bus):
+        start = time.time()
+        bus.ioctl(I2C_RDWR, self.arg)
+        recordI2C(start)
+
+
+class Sensor:
+    def __init__(self, name, bus, address, register, fmt, shift, scale, offset, period):
+        self.name = name
+        self.bus = bus
+        self.address = address
+        self.register = register      # None: a plain read of the device
+        self.format = struct.Struct(fmt)
+        self.shift = shift
+        self.scale = scale
+        self.offset = offset
+        self.period = period
+        self.block = None
+        self.position = 0             # of the value in the bytes of the block
+
+    def decode(self, data):
+        raw = self.format.unpack_from(data, self.position)[0] >> self.shift
+        if self.scale == 1 and self.offset == 0:
+            return raw
+        return round(raw * self.scale + self.offset, DECIMALS)
+
+
+def parseNumber(word):
+    return int(word, 0)
+
+
+def parseFormat(word):
+    """
+    return (struct format, shift) of e.g. >h>>4
+    """
+    (fmt, sep, shift) = word.partition('>>')
+    if not fmt or fmt[-1] not in FORMATS or len(fmt) > 2 or (len(fmt) == 2 and fmt[0] not in '<>'):
+        raise ValueError("invalid format %s" % word)
+    if len(fmt) == 1:
+        fmt = '>' + fmt
+    return (fmt, int(shift) if sep else 0)
+
+
+def parseConfig(path):
+    """
+    return (sensors, inits) of a config file, inits is a list of (bus,
+    address, bytes to write). I2CError on errors
+    """
+    sensors = []
+    inits = []
+    names = set()
+    try:
+        with open(path) as fh:
+            lines = fh.readlines()
+    except IOError, e:
+        raise I2CError(str(e))
+    for (n, line) in enumerate(lines):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        try:
+            if words[0] == 'init':
+                inits.append((parseNumber(words[1]), parseNumber(words[2]),
+                              [parseNumber(word) & 0xff for word in words[3:]]))
+                if len(inits[-1][2]) < 1:
+                    raise ValueError("no register")
+                continue
+            (name, bus, address) = (words[0], parseNumber(words[1]), parseNumber(words[2]))
+            register = None if words[3] == '-' else parseNumber(words[3]) & 0xff
+            (fmt, shift) = parseFormat(words[4])
+            scale = float(words[5]) if len(words) > 5 else 1
+            offset = float(words[6]) if len(words) > 6 else 0
+            period = float(words[7]) / 1000.0 if len(words) > 7 else DEFAULT_PERIOD
+        except (IndexError, ValueError), e:
+            raise I2CError("%s line %d: %s" % (path, n + 1, e))
+        if name in names:
+            raise I2CError("%s line %d: sensor %s declared twice" % (path, n + 1, name))
+        if period <= 0:
+            raise I2CError("%s line %d: invalid period" % (path, n + 1))
+        names.add(name)
+        sensors.append(Sensor(name, bus, address, register, fmt, shift, scale, offset, period))
+    return (sensors, inits)
+
+
+class Block:
+    """
+    bytes read together from a device: from register (None for a plain
+    read) for length bytes, decoded by its sensors
+    """
+    def __init__(self, address, register, length):
+        self.address = address
+        self.register = register
+        self.length = length
+        self.sensors = []
+        self.buffer = None
+        self.alone = None       # Transaction of this block only, after an error
+        self.failing = False
+
+    def messages(self):
+        if self.register is None:
+            return [(self.address, self.length)]
+        return [(self.address, [self.register]), (self.address, self.length)]
+
+
+def buildBlocks(sensors):
+    """
+    merge the registers of the same device into blocks of up to MAX_RANGE bytes
+    """
+    blocks = []
+    byDevice = {}
+    for sensor in sensors:
+        byDevice.setdefault(sensor.address, []).append(sensor)
+    for address in sorted(byDevice):
+        current = None
+        plain = [sensor for sensor in byDevice[address] if sensor.register is None]
+        ranged = sorted([sensor for sensor in byDevice[address] if sensor.register is not None],
+                        key=lambda sensor: sensor.register)
+        for sensor in plain:
+            block = Block(address, None, sensor.format.size)
+            block.sensors.append(sensor)
+            blocks.append(block)
+        for sensor in ranged:
+            end = sensor.register + sensor.format.size
+            if current is None or end - current.register > MAX_RANGE:
+                current = Block(address, sensor.register, 0)
+                blocks.append(current)
+            current.length = max(current.length, end - current.register)
+            sensor.position = sensor.register - current.register
+            current.sensors.append(sensor)
+    for block in blocks:
+        for sensor in block.sensors:
+            sensor.block = block
+    return blocks
+
+
+class PollGroup:
+    """
+    the blocks of a bus read at the same rate, in as few transactions as possible
+    """
+    def __init__(self, bus, period, sensors):
+        self.bus = bus
+        self.period = period
+        self.deadline = 0.0
+        self.blocks = buildBlocks(sensors)
+        self.transactions = []
+        chunk = []
+        messages = 0
+        for block in self.blocks:
+            if messages + len(block.messages()) > I2C_RDWR_IOCTL_MAX_MSGS:
+                self.transactions.append(self.prepare(chunk))
+                chunk = []
+                messages = 0
+            chunk.append(block)
+            messages += len(block.messages())
+        if chunk:
+            self.transactions.append(self.prepare(chunk))
+
+    def prepare(self, blocks):
+        messages = []
+        for block in blocks:
+            messages += block.messages()
+        transaction = Transaction(messages)
+        # the read buffer of each block is the last of its messages
+        position = 0
+        for block in blocks:
+            position += len(block.messages())
+            block.buffer = transaction.buffers[position - 1]
+        return (transaction, blocks)
+
+    def read(self):
+        """
+        run the transactions: return the blocks read. When a transaction
+        fails its blocks are read one by one, to skip the devices not answering
+        """
+        done = []
+        for (transaction, blocks) in self.transactions:
+            try:
+                transaction.run(self.bus)
+                done += blocks
+                for block in blocks:
+                    block.failing = False
+                continue
+            except IOError:
+                pass
+            for block in blocks:
+                if block.alone is None:
+                    block.alone = Transaction(block.messages())
+                try:
+                    block.alone.run(self.bus)
+                except IOError, e:
+                    if not block.failing:
+                        logger.error("I2C bus %d device 0x%02x not answering: %s",
+                                     self.bus.number, block.address, e)
+                    block.failing = True
+                    continue
+                block.failing = False
+                # the block has its own buffer when read alone
+                block.buffer[:] = block.alone.buffers[-1]
+                done.append(block)
+        return done
+
+
+class I2CPoller(threading.Thread):
+    """
+    A thread reading the I2C sensors at their rates, off the listener and
+    sender threads: the changed values are passed as a dict to deliver(),
+    which returns False when there is no Scratch to send them to (they
+    are sent again at the next read)
+    """
+    def __init__(self, sensors, inits, deliver, offline=False):
+        threading.Thread.__init__(self, name='I2CPoller')
+        self.daemon = True
+        self.deliver = deliver
+        self.inits = inits
+        self.last = {}          # sensor name -> value delivered
+        self._stop = threading.Event()
+        self.buses = {}
+        for number in sorted(set([sensor.bus for sensor in sensors] + [init[0] for init in inits])):
+            try:
+                self.buses[number] = FakeI2CBus(number) if offline else I2CBus(number)
+            except OSError, e:
+                raise I2CError("unable to open I2C bus %d: %s" % (number, e))
+        byGroup = {}
+        for sensor in sensors:
+            byGroup.setdefault((sensor.bus, sensor.period), []).append(sensor)
+        self.groups = [PollGroup(self.buses[bus], period, byGroup[(bus, period)])
+                       for (bus, period) in sorted(byGroup)]
+        logger.debug("I2C: %d sensors in %d transactions on buses %s", len(sensors),
+                     sum(len(group.transactions) for group in self.groups), sorted(self.buses))
+
+    def stop(self):
+        self._stop.set()
+
+    def stopped(self):
+        return self._stop.isSet()
+
+    def initDevices(self):
+        for (bus, address, data) in self.inits:
+            try:
+                Transaction([(address, data)]).run(self.buses[bus])
+            except IOError, e:
+                logger.error("I2C init of bus %d device 0x%02x failed: %s", bus, address, e)
+
+    def poll(self, group):
+        changes = {}
+        for block in group.read():
+            data = block.buffer.tostring()
+            for sensor in block.sensors:
+                value = sensor.decode(data)
+                if self.last.get(sensor.name) != value:
+                    changes[sensor.name] = value
+        if changes and self.deliver(changes):
+            self.last.update(changes)
+
+    def run(self):
+        logger.debug("I2C poller running as thread %s ...", self.name)
+        self.initDevices()
+        while not self.stopped():
+            now = S4AH_ST.monotonic()
+            for group in self.groups:
+                if group.deadline <= now:
+                    self.poll(group)
+                    # no catching up after a late read: the next one is a period later
+                    group.deadline = max(group.deadline + group.period, now)
+            if not self.groups:
+                return
+            self._stop.wait(max(min(group.deadline for group in self.groups) - S4AH_ST.monotonic(), 0))
+
+    def close(self):
+        self.stop()
+        if self.ident is not None:
+            self.join(1.0)
+        for bus in self.buses.values():
+            bus.close()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#s4ah_InputFilter - debounce and glitch filters of the INPUT pins for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import time
+import logging
+import threading
+from collections import deque
+import s4ah_GPIOController as S4AH
+import s4ah_Stats as S4AH_ST
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+# filter kinds configured by the broadcasts
+DEBOUNCE = 'debounce'    # debouncePA25 20: the value must be stable for 20 msecs
+MAJORITY = 'majority'    # majorityPA25 3 5: the value of at least 3 of the last 5 samples
+INTERVAL = 'interval'    # intervalPA25 100: at most a report every 100 msecs
+MAX_SAMPLES = 32
+
+
+class PinFilter:
+    """
+    Filter state of a single INPUT pin. The raw samples (polls or edges)
+    select a target value: the raw one or, with majority, the value of at
+    least n of the last m samples. The target is reported once it has been
+    stable for debounce secs and interval secs have passed since the last
+    report; until then deadline tells when to evaluate it again.
+    The raw transitions that never reach Scratch are counted as suppressed
+    """
+    def __init__(self, mode):
+        self.mode = mode          # last mode seen of the pin
+        self.debounce = 0.0
+        self.interval = 0.0
+        self.majority = None      # (n, m)
+        self.samples = None       # last m raw samples
+        self.reset()
+
+    def reset(self):
+        self.raw = None
+        self.target = None
+        self.targetSince = 0.0
+        self.lastReport = None
+        self.deadline = None
+        self.transitions = 0      # raw transitions since the last report
+        if self.majority:
+            self.samples = deque(maxlen=self.majority[1])
+
+    def configure(self, kind, args):
+        if kind == DEBOUNCE:
+            self.debounce = args[0] / 1000.0
+        elif kind == INTERVAL:
+            self.interval = args[0] / 1000.0
+        elif kind == MAJORITY:
+            if len(args) != 2 or args[0] < 2:
+                self.majority = None
+            else:
+                self.majority = (args[0], args[1])
+        self.reset()
+
+    def enabled(self):
+        return bool(self.debounce or self.interval or self.majority)
+
+    def sample(self, raw, reported, now):
+        """
+        add a raw sample: return the value to report or None
+        """
+        if raw != self.raw:
+            if self.raw is not None:
+                self.transitions += 1
+            self.raw = raw
+        target = raw
+        if self.majority:
+            self.samples.append(raw)
+            (n, m) = self.majority
+            votes = self.samples.count(raw)
+            if votes < n:
+                # no majority yet: keep the previous decision
+                target = self.target if self.target is not None else reported
+        if target != self.target:
+            self.target = target
+            self.targetSince = now
+        return self.evaluate(reported, now)
+
+    def evaluate(self, reported, now):
+        """
+        report the target when stable and allowed: return it or None
+        """
+        self.deadline = None
+        if self.target is None or self.target == reported:
+            # back to the reported value: the transitions were glitches
+            if self.transitions:
+                S4AH_ST.stats.count('suppressed', self.transitions)
+                self.transitions = 0
+            return None
+        stableAt = self.targetSince + self.debounce
+        allowedAt = self.lastReport + self.interval if self.lastReport is not None else now
+        if now >= stableAt and now >= allowedAt:
+            if self.transitions > 1:
+                S4AH_ST.stats.count('suppressed', self.transitions - 1)
+            self.transitions = 0
+            self.lastReport = now
+            return self.target
+        self.deadline = max(stableAt, allowedAt)
+        return None
+
+
+class InputFilters:
+    """
+    Filter stage between the reads of the INPUT pins and the sensor-updates:
+    changes() replaces the comparison of the read value with PinData.value.
+    Pins without filters are reported at the first change as before.
+    The senders call expire() at nextDeadline(): with edges no new sample
+    could arrive to release a held value
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.filters = {}     # pin name -> PinFilter of the filtered pins
+        self.lock = threading.Lock()
+        controller.modeListeners.append(self.modeChanged)
+
+    def configure(self, pinName, kind, args):
+        """
+        set a filter of a pin ('all' for every pin): a 0 argument disables it
+        """
+        pin = self.controller.lookupPin(pinName)
+        if pinName.lower() == 'all':
+            pinNames = self.controller.ValidPins.keys()
+        elif pin is not None:
+            pinNames = [pin.name]
+        else:
+            logger.error("%s: unknown pin %s", kind, pinName)
+            return False
+        if kind == MAJORITY and len(args) == 2 and not 0 < args[0] <= args[1] <= MAX_SAMPLES:
+            logger.error("%s: invalid samples %s, at most %d", kind, args, MAX_SAMPLES)
+            return False
+        with self.lock:
+            for name in pinNames:
+                pinFilter = self.filters.get(name) or PinFilter(self.controller.ValidPins[name].mode)
+                pinFilter.configure(kind, args)
+                if pinFilter.enabled():
+                    self.filters[name] = pinFilter
+                else:
+                    self.filters.pop(name, None)
+        logger.debug("%s of pins %s set to %s", kind, pinNames, args)
+        return True
+
+    def modeChanged(self):
+        """
+        the pins leaving the INPUT mode restart from a clean state, the
+        reset ones (back to unused) also lose their filters
+        """
+        with self.lock:
+            for name in self.filters.keys():
+                pinFilter = self.filters[name]
+                mode = self.controller.ValidPins[name].mode
+                if mode == pinFilter.mode:
+                    continue
+                if mode == S4AH.PUNUSED:
+                    del self.filters[name]
+                    continue
+                if pinFilter.mode == S4AH.PINPUT:
+                    pinFilter.reset()
+                pinFilter.mode = mode
+
+    def changes(self, samples, now=None):
+        """
+        return the list of (PinData, value) to report for the samples
+        (PinData, raw value), updating PinData.value
+        """
+        result = []
+        if not self.filters:
+            for (pin, value) in samples:
+                if value != pin.value:
+                    pin.value = value
+                    result.append((pin, value))
+            return result
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for (pin, value) in samples:
+                pinFilter = self.filters.get(pin.name)
+                if pinFilter is not None:
+                    value = pinFilter.sample(value, pin.value, now)
+                    if value is None:
+                        continue
+                if value != pin.value:
+                    pin.value = value
+                    result.append((pin, value))
+        return result
+
+    def nextDeadline(self):
+        """
+        time of the first held value to evaluate again, None if none
+        """
+        deadlines = [pinFilter.deadline for pinFilter in self.filters.values()
+                     if pinFilter.deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def expire(self, now=None):
+        """
+        return the list of (PinData, value) of the held values now due
+        """
+        result = []
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for name in self.filters:
+                pinFilter = self.filters[name]
+                if pinFilter.deadline is None or pinFilter.deadline > now:
+                    continue
+                pin = self.controller.ValidPins[name]
+                value = pinFilter.evaluate(pin.value, now)
+                if value is not None and value != pin.value:
+                    pin.value = value
+                    result.append((pin, value))
+        return result
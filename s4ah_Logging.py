@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#s4ah_Logging - non blocking logging pipeline of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import sys
+import time
+import Queue
+import atexit
+import logging
+import logging.handlers
+import threading
+from collections import deque
+
+
+LOG_FILENAME = "/tmp/scratch4acmeboards.log"
+RING_FILENAME = "/tmp/scratch4acmeboards.ring.log"
+LOG_FORMAT = "%(asctime)s - %(module)s.%(funcName)s %(lineno)d: %(message)s"
+DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+DEFAULT_QUEUE_SIZE = 10000   # records waiting for the writer, others are dropped
+DEFAULT_RING_SIZE = 0        # recent records kept in memory (0 = no ring buffer)
+RING_DUMP_INTERVAL = 10.0    # min seconds between two dumps caused by errors
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hand the records to the writer thread: the caller never waits for the
+    disk. When the queue is full the records are dropped and counted
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        merge the arguments in the message: they could change before the
+        writer formats the record
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(threading.Thread):
+    """
+    Thread writing the queued records with the real handlers
+    """
+    def __init__(self, queue, handlers):
+        threading.Thread.__init__(self, name='LogWriter')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join(5.0)
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keep the last records in memory, formatted only when dumped: on demand
+    (dumplog broadcast) or when an error is logged
+    """
+    def __init__(self, size, path=RING_FILENAME):
+        logging.Handler.__init__(self)
+        self.records = deque(maxlen=size)
+        self.path = path
+        self.lastDump = 0.0
+        self.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+
+    def emit(self, record):
+        self.records.append(record)
+        if record.levelno >= logging.ERROR and time.time() - self.lastDump >= RING_DUMP_INTERVAL:
+            self.dump()
+
+    def dump(self):
+        """
+        write the records in memory to the ring file: return how many
+        """
+        self.lastDump = time.time()
+        records = list(self.records)
+        try:
+            with open(self.path, 'w') as fh:
+                for record in records:
+                    fh.write(self.format(record) + '\n')
+        except IOError:
+            return 0
+        return len(records)
+
+
+class LogPipeline:
+    """
+    Logging configuration of the handler: the records of every logger go
+    once through the root logger to a single output (stdout or the rolling
+    file), INFO and above also to the console. With background=True the
+    output is written by a thread. With a ring buffer the DEBUG records are
+    always created (and kept in memory) and the debug flag filters the output
+    """
+    def __init__(self, printToStdout=False, debug=False, background=True,
+                 ringSize=DEFAULT_RING_SIZE, queueSize=DEFAULT_QUEUE_SIZE):
+        formatter = logging.Formatter(LOG_FORMAT, DATE_FORMAT)
+        if printToStdout:
+            self.output = logging.StreamHandler(sys.stdout)
+            handlers = [self.output]
+        else:
+            # each run starts a new log, as with filemode='w': the handler
+            # opens it in append mode whatever the mode when maxBytes is set
+            open(LOG_FILENAME, 'w').close()
+            self.output = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=20000000, backupCount=2)
+            console = logging.StreamHandler()
+            console.setLevel(logging.INFO)
+            console.setFormatter(logging.Formatter("%(message)s"))
+            handlers = [self.output, console]
+        self.output.setFormatter(formatter)
+
+        self.root = logging.getLogger()
+        for handler in list(self.root.handlers):
+            self.root.removeHandler(handler)
+
+        self.writer = None
+        self.queueHandler = None
+        if background:
+            self.queueHandler = QueueHandler(Queue.Queue(queueSize))
+            self.writer = LogWriter(self.queueHandler.queue, handlers)
+            self.writer.start()
+            self.root.addHandler(self.queueHandler)
+        else:
+            for handler in handlers:
+                self.root.addHandler(handler)
+
+        self.ring = None
+        if ringSize:
+            self.ring = RingBufferHandler(ringSize)
+            self.root.addHandler(self.ring)
+        self.setDebug(debug)
+        atexit.register(self.close)
+
+    def setDebug(self, on):
+        """
+        turn the DEBUG messages on or off at runtime (sghdebug broadcast)
+        """
+        level = logging.DEBUG if on else logging.INFO
+        if self.ring:
+            self.root.setLevel(logging.DEBUG)
+            self.output.setLevel(level)
+        else:
+            self.root.setLevel(level)
+
+    def dumpRing(self):
+        """
+        write the ring buffer to its file: return the number of records
+        """
+        if self.ring is None:
+            return 0
+        return self.ring.dump()
+
+    def dropped(self):
+        return self.queueHandler.dropped if self.queueHandler else 0
+
+    def afterFork(self):
+        """
+        called in a forked process (e.g. the GPIO worker): the writer thread
+        is not there, the records are written synchronously to the output
+        only (no console, no ring buffer)
+        """
+        for handler in list(self.root.handlers):
+            self.root.removeHandler(handler)
+        # a lock held by a thread of the parent at the fork would stay held
+        self.output.createLock()
+        self.root.addHandler(self.output)
+        self.queueHandler = None
+        self.writer = None
+        self.ring = None
+
+    def close(self):
+        """
+        write the queued records and stop the writer
+        """
+        if self.writer is not None and self.writer.isAlive():
+            self.writer.stop()
+        self.output.flush()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#s4ah_NetInfo - addresses of the network interfaces for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# The IPv4 addresses are read with the SIOCGIFCONF ioctl and the interface
+# of the default route from /proc/net/route: no process is spawned. They
+# are kept until a netlink socket subscribed to the address and route
+# changes has something to read.
+
+
+import time
+import array
+import errno
+import fcntl
+import select
+import socket
+import struct
+import logging
+import threading
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+SIOCGIFCONF = 0x8912
+IFNAMSIZ = 16
+# struct ifreq: the name and a union whose largest member is struct ifmap
+IFREQ_SIZE = IFNAMSIZ + max(16, 2 * struct.calcsize('L') + 8)
+MAX_INTERFACES = 32
+ROUTE_FILE = '/proc/net/route'
+RTF_UP = 0x0001
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+# without netlink the addresses are read again when older than this (seconds)
+FALLBACK_TTL = 10.0
+
+
+def interfaceAddresses():
+    """
+    [(interface, IPv4 address)] of the interfaces up with an address
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        size = MAX_INTERFACES * IFREQ_SIZE
+        buf = array.array('B', '\0' * size)
+        ifconf = struct.pack('iL', size, buf.buffer_info()[0])
+        length = struct.unpack('iL', fcntl.ioctl(s.fileno(), SIOCGIFCONF, ifconf))[0]
+    finally:
+        s.close()
+    data = buf.tostring()
+    addresses = []
+    for offset in xrange(0, length, IFREQ_SIZE):
+        name = data[offset:offset + IFNAMSIZ].split('\0', 1)[0]
+        # struct sockaddr_in: family, port, address
+        address = socket.inet_ntoa(data[offset + IFNAMSIZ + 4:offset + IFNAMSIZ + 8])
+        addresses.append((name, address))
+    return addresses
+
+
+def defaultRouteInterfaces(path=ROUTE_FILE):
+    """
+    interfaces of the default routes, the preferred (lowest metric) first
+    """
+    routes = []
+    try:
+        with open(path) as fh:
+            lines = fh.readlines()[1:]
+    except IOError:
+        return []
+    for line in lines:
+        fields = line.split()
+        try:
+            if fields[1] == '00000000' and int(fields[3], 16) & RTF_UP:
+                routes.append((int(fields[6]), fields[0]))
+        except (IndexError, ValueError):
+            continue
+    return [name for (metric, name) in sorted(routes)]
+
+
+def chooseAddress(addresses, defaultInterfaces):
+    """
+    the address a Scratch PC reaches the board at: the one of the default
+    route interface, else the first one not on loopback, else None
+    """
+    for name in defaultInterfaces:
+        for (interface, address) in addresses:
+            if interface == name:
+                return address
+    for (interface, address) in addresses:
+        if not address.startswith('127.'):
+            return address
+    return None
+
+
+class NetInfo:
+    """
+    Cache of the interface addresses: read again only after the kernel
+    notified an address, link or route change (or every FALLBACK_TTL
+    seconds where netlink isn't available). Thread safe
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.addresses = None
+        self.readTime = 0
+        self.netlink = None
+        try:
+            self.netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self.netlink.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+            self.netlink.setblocking(0)
+        except (AttributeError, socket.error), e:
+            logger.debug("no netlink notifications (%s): addresses read every %d secs", e, FALLBACK_TTL)
+            self.close()
+
+    def changed(self):
+        """
+        drain the notifications: True if there were any
+        """
+        if self.netlink is None:
+            return time.time() - self.readTime > FALLBACK_TTL
+        notified = False
+        while select.select([self.netlink], [], [], 0)[0]:
+            try:
+                self.netlink.recv(65536)
+            except socket.error, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                # ENOBUFS: notifications lost, the cache is stale anyway
+                if e.errno != errno.ENOBUFS:
+                    raise
+            notified = True
+        return notified
+
+    def refresh(self):
+        with self.lock:
+            if self.addresses is None or self.changed():
+                self.addresses = (interfaceAddresses(), defaultRouteInterfaces())
+                self.readTime = time.time()
+                logger.debug("interface addresses %s, default route on %s", *self.addresses)
+            return self.addresses
+
+    def address(self):
+        """
+        the IPv4 address of the board, None without network
+        """
+        return chooseAddress(*self.refresh())
+
+    def close(self):
+        if self.netlink is not None:
+            self.netlink.close()
+            self.netlink = None
+
+
+_provider = None
+_providerLock = threading.Lock()
+
+
+def provider():
+    """
+    the NetInfo shared by the whole handler, created at the first use
+    """
+    global _provider
+    with _providerLock:
+        if _provider is None:
+            _provider = NetInfo()
+        return _provider
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#s4ah_PWM - hardware PWM outputs of scratch4acmeboards by the sysfs pwm class
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# The PWM controller of the SoC drives the pin by itself: period and duty
+# cycle are written once in /sys/class/pwm/pwmchipN/pwmM, then no CPU is
+# used for each cycle. The pins must be given to the PWM controller by the
+# device tree of the board.
+
+
+import os
+import logging
+import s4ah_GPIOController as S4AH
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+PWM_ROOT = '/sys/class/pwm/'
+# for developers only: fake tree written by createOfflineTree
+OFFLINE_PWM_ROOT = '/tmp/ablib/sys/class/pwm/'
+DEFAULT_PERIOD = 1000000     # nsecs: 1 kHz, servos need 20 msecs (pwmperiod 20000)
+MIN_PERIOD = 1000            # nsecs
+
+
+def findChip(root, channels):
+    """
+    directory of the first pwm chip with at least channels channels, None if none
+    """
+    try:
+        entries = sorted(entry for entry in os.listdir(root) if entry.startswith('pwmchip'))
+    except OSError:
+        return None
+    for entry in entries:
+        try:
+            with open(os.path.join(root, entry, 'npwm')) as fh:
+                if int(fh.read().strip()) >= channels:
+                    return os.path.join(root, entry)
+        except (IOError, ValueError):
+            continue
+    return None
+
+
+def createOfflineTree(root=OFFLINE_PWM_ROOT, channels=4):
+    """
+    for developers only: a pwm chip whose channels are already exported
+    (no kernel creates them on export)
+    """
+    chip = os.path.join(root, 'pwmchip0')
+    if os.path.exists(os.path.join(chip, 'npwm')):
+        return
+    for n in xrange(channels):
+        channel = os.path.join(chip, 'pwm%d' % n)
+        os.makedirs(channel)
+        for (name, value) in (('period', 0), ('duty_cycle', 0), ('enable', 0), ('polarity', 'normal')):
+            with open(os.path.join(channel, name), 'w') as fh:
+                fh.write(str(value))
+    for (name, value) in (('npwm', channels), ('export', ''), ('unexport', '')):
+        with open(os.path.join(chip, name), 'w') as fh:
+            fh.write(str(value))
+
+
+class PWMChannel:
+    """
+    An exported channel and the values last written to it: a value equal
+    to the one written is skipped, the duty_cycle file stays open
+    """
+    def __init__(self, chip, number):
+        self.chip = chip
+        self.number = number
+        self.path = os.path.join(chip, 'pwm%d' % number)
+        self.period = None       # nsecs written
+        self.duty = None         # nsecs written
+        self.enabled = False
+        self.dutyFd = None
+
+    def write(self, name, value):
+        with open(os.path.join(self.path, name), 'w') as fh:
+            fh.write(str(value))
+
+
+class PWMOutputs:
+    """
+    The PWM channels of the pins in PWM mode. The duty cycle is in percent
+    of the period, kept when the period changes: setPeriod() is applied at
+    once to a running channel, else at the first setDuty()
+    """
+    def __init__(self, controller, channels, offline=False):
+        self.controller = controller
+        self.pinChannels = channels     # pin name -> channel number
+        self.seek = offline             # the fake tree has regular files
+        root = PWM_ROOT
+        if offline:
+            root = OFFLINE_PWM_ROOT
+            createOfflineTree(root, max(channels.values()) + 1)
+        self.chip = findChip(root, max(channels.values()) + 1)
+        if self.chip is None:
+            logger.error("no pwm chip with %d channels in %s", max(channels.values()) + 1, root)
+        self.channels = {}      # pin name -> exported PWMChannel
+        self.periods = {}       # pin name -> period (nsecs) set by Scratch
+        self.percents = {}      # pin name -> duty cycle (percent) set by Scratch
+
+    def channel(self, pinName):
+        """
+        the PWMChannel of the pin, exported at the first use
+        """
+        channel = self.channels.get(pinName)
+        if channel is not None:
+            return channel
+        if self.chip is None:
+            raise IOError("no pwm chip")
+        channel = PWMChannel(self.chip, self.pinChannels[pinName])
+        if not os.path.isdir(channel.path):
+            with open(os.path.join(self.chip, 'export'), 'w') as fh:
+                fh.write(str(channel.number))
+        channel.dutyFd = os.open(os.path.join(channel.path, 'duty_cycle'), os.O_WRONLY)
+        # a duty cycle left by a previous user could exceed the new period
+        self.writeDuty(channel, 0)
+        self.channels[pinName] = channel
+        logger.debug("pin %s on pwm channel %s", pinName, channel.path)
+        return channel
+
+    def writeDuty(self, channel, duty):
+        data = str(duty)
+        S4AH.writeValueFd(channel.dutyFd, data, self.seek)
+        if self.seek:
+            # a regular file of the fake tree keeps the longer old value
+            os.ftruncate(channel.dutyFd, len(data))
+        channel.duty = duty
+
+    def apply(self, pinName):
+        """
+        write the period and the duty cycle that changed: the duty cycle
+        can never exceed the period, their order depends on the direction
+        """
+        channel = self.channel(pinName)
+        period = self.periods.get(pinName, DEFAULT_PERIOD)
+        duty = int(round(period * self.percents[pinName] / 100.0))
+        if period != channel.period and (channel.period is None or period > channel.period):
+            channel.write('period', period)
+            channel.period = period
+        if duty != channel.duty:
+            self.writeDuty(channel, duty)
+        if period != channel.period:
+            channel.write('period', period)
+            channel.period = period
+        if not channel.enabled:
+            channel.write('enable', 1)
+            channel.enabled = True
+
+    def setDuty(self, pinName, percent):
+        if self.percents.get(pinName) == percent and pinName in self.channels:
+            return
+        self.percents[pinName] = percent
+        self.apply(pinName)
+
+    def setPeriod(self, pinName, period):
+        if self.periods.get(pinName, DEFAULT_PERIOD) == period:
+            return
+        self.periods[pinName] = period
+        if pinName in self.channels:
+            self.apply(pinName)
+
+    def release(self, pinName):
+        """
+        stop the channel of the pin and give it back: the pin can be a GPIO again
+        """
+        channel = self.channels.pop(pinName, None)
+        self.percents.pop(pinName, None)
+        if channel is None:
+            return
+        try:
+            os.close(channel.dutyFd)
+            channel.write('enable', 0)
+            if not self.seek:
+                with open(os.path.join(self.chip, 'unexport'), 'w') as fh:
+                    fh.write(str(channel.number))
+        except (IOError, OSError), e:
+            logger.error("Unable to release pwm channel %s: %s", channel.path, e)
+        logger.debug("pin %s released by pwm channel %s", pinName, channel.path)
+
+    def close(self):
+        for pinName in self.channels.keys():
+            self.release(pinName)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#s4ah_PollScheduler - adaptive polling of the INPUT pins for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import fcntl
+import select
+import logging
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+FAST_INTERVAL = 0.005    # poll interval (seconds) of a pin that just changed
+SLOW_INTERVAL = 0.050    # poll interval of an idle pin
+DEFAULT_BUDGET = 1000    # max pin reads per second of all the pins together
+
+
+class PolledPin:
+    def __init__(self, pin, interval, deadline):
+        self.pin = pin
+        self.interval = interval
+        self.deadline = deadline
+        self.last = None      # last raw value read
+
+
+class PollScheduler:
+    """
+    Per pin poll deadlines: a pin that changed is polled every fastInterval,
+    then its interval doubles at each read without changes up to
+    slowInterval. When the pins together would exceed budget reads per
+    second all the intervals are stretched. With no pins there is no
+    deadline: the sender waits on the wakeup pipe until a mode changes
+    """
+    def __init__(self, controller, fastInterval=FAST_INTERVAL, slowInterval=SLOW_INTERVAL,
+                 budget=DEFAULT_BUDGET):
+        self.fastInterval = min(fastInterval, slowInterval)
+        self.slowInterval = slowInterval
+        self.budget = budget
+        self.pins = None          # the list of PinData last passed to setPins
+        self.polled = {}          # pin name -> PolledPin
+        self.rate = 0.0           # reads per second of the current intervals
+        (self.wakeRead, self.wakeWrite) = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        controller.modeListeners.append(self.wakeup)
+
+    def setPins(self, pins, now):
+        """
+        poll the passed PinData: the controller (and the edge monitor)
+        build a new list when the pins change, so the same list costs nothing
+        """
+        if pins is self.pins:
+            return
+        self.pins = pins
+        polled = {}
+        for pin in pins:
+            # new pins are read at once at the fast rate
+            polled[pin.name] = self.polled.get(pin.name) or PolledPin(pin, self.fastInterval, now)
+        self.polled = polled
+        self.rate = sum(1.0 / entry.interval for entry in polled.values())
+        logger.debug("polling %d pins", len(polled))
+
+    def stretch(self):
+        """
+        factor applied to the intervals to stay within the budget
+        """
+        if self.budget and self.rate > self.budget:
+            return self.rate / self.budget
+        return 1.0
+
+    def nextDeadline(self):
+        """
+        time of the next read, None if there are no pins to poll
+        """
+        if not self.polled:
+            return None
+        return min(entry.deadline for entry in self.polled.values())
+
+    def due(self, now):
+        """
+        PinData to read now: their next deadline is set at once, so a pin
+        that can't be read doesn't keep the caller busy
+        """
+        pins = []
+        stretch = self.stretch()
+        for entry in self.polled.values():
+            if entry.deadline <= now:
+                entry.deadline = now + entry.interval * stretch
+                pins.append(entry.pin)
+        return pins
+
+    def update(self, samples, now):
+        """
+        adapt the intervals to the samples (PinData, raw value) just read
+        """
+        stretch = self.stretch()
+        for (pin, value) in samples:
+            entry = self.polled.get(pin.name)
+            if entry is None:
+                continue
+            self.rate -= 1.0 / entry.interval
+            if value != entry.last:
+                entry.last = value
+                entry.interval = self.fastInterval
+            else:
+                entry.interval = min(entry.interval * 2, self.slowInterval)
+            self.rate += 1.0 / entry.interval
+            entry.deadline = now + entry.interval * stretch
+
+    def wakeup(self):
+        """
+        interrupt wait(): called by the controller at each mode change
+        """
+        try:
+            os.write(self.wakeWrite, b'w')
+        except OSError:
+            pass
+
+    def wait(self, timeout):
+        """
+        sleep up to timeout seconds (None forever) or until wakeup()
+        """
+        if select.select([self.wakeRead], [], [], timeout)[0]:
+            try:
+                os.read(self.wakeRead, 4096)
+            except OSError:
+                pass
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#s4ah_ScratchCodec - Scratch 1.4 mesh wire protocol codec for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# A mesh message is a 4 bytes big endian length followed by the payload:
+#   broadcast "name"
+#   sensor-update "name" value "name" "value" ...
+# Quoted strings escape the quote doubling it ("").
+
+
+import re
+import struct
+
+
+RECV_SIZE = 65536            # initial size of the receive buffer
+MAX_FRAME = 1048576          # longer frames are a protocol error
+HEADER = struct.Struct('>I')
+
+# a quoted string (the closing quote can be missing at the end) or a bare word
+TOKEN_RE = re.compile(r'"((?:[^"]|"")*)(?:"|$)|([^ ]+)')
+
+
+class CodecError(Exception):
+    pass
+
+
+def quote(s):
+    """
+    quote a string as Scratch wants it
+    """
+    return '"' + s.replace('"', '""') + '"'
+
+
+def encodeFrame(payload):
+    """
+    return the framed payload (4 bytes length + payload) as a string
+    """
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    return HEADER.pack(len(payload)) + payload
+
+
+def encodeSensorUpdate(data):
+    """
+    return the framed sensor-update message (4 bytes length + payload) for
+    the list of (sensor, value)
+    """
+    parts = ['sensor-update']
+    for (key, value) in data:
+        parts.append(quote(key))
+        if isinstance(value, basestring):
+            parts.append(quote(value))
+        else:
+            parts.append(str(value))
+    return encodeFrame(' '.join(parts))
+
+
+def encodeBroadcast(name):
+    return encodeFrame('broadcast ' + quote(name))
+
+
+def tokenizeSlow(payload):
+    """
+    split a payload in words with escaped quotes or unbalanced quotes
+    """
+    tokens = []
+    for (quoted, bare) in TOKEN_RE.findall(payload):
+        if bare:
+            tokens.append(bare)
+        elif '""' in quoted:
+            tokens.append(quoted.replace('""', '"'))
+        else:
+            tokens.append(quoted)
+    return tokens
+
+
+def tokenize(payload):
+    """
+    split a Scratch message in words: quoted strings are single words.
+    Payloads without escaped quotes are split in a single pass by str.split
+    """
+    if '""' in payload or payload.count('"') & 1:
+        return tokenizeSlow(payload)
+    parts = payload.split('"')
+    last = len(parts) - 1
+    tokens = []
+    for i in xrange(0, last + 1, 2):
+        part = parts[i]
+        if part:
+            # a quote inside a bare word (e.g. ab"c) is not a delimiter
+            if (i > 0 and part[0] != ' ') or (i < last and part[-1] != ' '):
+                return tokenizeSlow(payload)
+            tokens.extend([word for word in part.split(' ') if word])
+        if i < last:
+            tokens.append(parts[i + 1])
+    return tokens
+
+
+def parseMessage(payload):
+    """
+    return the message as scratchpy does: ('broadcast', name) or
+    ('sensor-update', {sensor: value}). None for other messages
+    """
+    if payload.startswith('broadcast "') and payload.endswith('"') and payload.count('"') == 2:
+        # the common case: a broadcast without escaped quotes
+        return ('broadcast', payload[11:-1])
+    tokens = tokenize(payload)
+    if not tokens:
+        return None
+    if tokens[0] == 'broadcast' and len(tokens) > 1:
+        return ('broadcast', tokens[1])
+    if tokens[0] == 'sensor-update':
+        return ('sensor-update', dict(zip(tokens[1::2], tokens[2::2])))
+    return None
+
+
+class FrameEncoder:
+    """
+    Frame outbound messages into a reusable buffer: frame() returns a view
+    valid until the next call, for messages written at once (e.g. sendall)
+    """
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+
+    def frame(self, payload):
+        n = len(payload)
+        if n + 4 > len(self.buf):
+            self.buf = bytearray(max(n + 4, 2 * len(self.buf)))
+        HEADER.pack_into(self.buf, 0, n)
+        self.buf[4:4 + n] = payload
+        return memoryview(self.buf)[:4 + n]
+
+    def send(self, sock, payload):
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        sock.sendall(self.frame(payload))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of inbound frames: the socket is read with recv_into
+    straight into a buffer and the pipelined frames are cut from it by
+    offsets, without concatenating or slicing the received data. Only the
+    payloads are copied out
+    """
+    def __init__(self, size=RECV_SIZE, maxFrame=MAX_FRAME):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0          # first byte not yet decoded
+        self.end = 0            # first free byte
+        self.needed = 4         # bytes needed to complete the next frame
+        self.maxFrame = maxFrame
+
+    def makeRoom(self):
+        """
+        make room for at least the next frame at the end of the buffer
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buf) - self.start >= self.needed and self.end < len(self.buf):
+            return
+        pending = self.end - self.start
+        size = max(self.needed, pending + 1)
+        if size <= len(self.buf):
+            # move the partial frame to the front (same length: no resize)
+            self.buf[:pending] = self.buf[self.start:self.end]
+        else:
+            buf = bytearray(max(size, 2 * len(self.buf)))
+            buf[:pending] = self.buf[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
+        self.start = 0
+        self.end = pending
+
+    def receive(self, sock):
+        """
+        read the socket once: return the number of bytes read, 0 at the end
+        of the stream. socket errors are raised
+        """
+        self.makeRoom()
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """
+        add already read data (e.g. a recording)
+        """
+        offset = 0
+        while offset < len(data):
+            self.makeRoom()
+            n = min(len(data) - offset, len(self.buf) - self.end)
+            self.buf[self.end:self.end + n] = data[offset:offset + n]
+            self.end += n
+            offset += n
+
+    def frames(self):
+        """
+        generator of the complete payloads received. CodecError is raised
+        for a frame longer than maxFrame
+        """
+        while self.end - self.start >= 4:
+            n = HEADER.unpack_from(self.buf, self.start)[0]
+            if n > self.maxFrame:
+                raise CodecError("frame of %d bytes" % n)
+            if self.end - self.start < 4 + n:
+                self.needed = 4 + n
+                return
+            payload = self.view[self.start + 4:self.start + 4 + n].tobytes()
+            self.start += 4 + n
+            self.needed = 4
+            yield payload
+        self.needed = 4
+
+    def pending(self):
+        return self.end - self.start
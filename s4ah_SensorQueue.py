@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+#s4ah_SensorQueue - coalescing outbound sensor-update queue for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import time
+import errno
+import select
+import socket
+import logging
+import threading
+import s4ah_Stats as S4AH_ST
+import s4ah_ScratchCodec as S4AH_SC
+from collections import OrderedDict, deque
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+DEFAULT_MAX_RATE = 100       # sensor-update frames per second (0 = no limit)
+DEFAULT_MAX_BATCH = 64       # sensors in a single sensor-update frame
+DEFAULT_MAX_PENDING = 1024   # distinct sensors waiting to be sent
+DEFAULT_MAX_BACKLOG = 65536  # bytes waiting to be written to a single peer
+
+# the CaptureWriter of the running handler, set by s4ah_Capture.start() and
+# None when not capturing: the engines check it before each record, so
+# without --capture it costs a test and s4ah_Capture is not imported
+capture = None
+
+
+class SensorUpdateQueue:
+    """
+    Single outbound path of the sensor values sent to Scratch. A sensor
+    not yet sent keeps only its latest value (coalescing), so a fast
+    toggling input or a slow Scratch PC can't make the queue grow
+    """
+    def __init__(self, maxRate=DEFAULT_MAX_RATE, maxBatch=DEFAULT_MAX_BATCH,
+                 maxPending=DEFAULT_MAX_PENDING):
+        self.minInterval = 1.0 / maxRate if maxRate else 0.0
+        self.maxBatch = maxBatch
+        self.maxPending = maxPending
+        self.pending = OrderedDict()
+        self.cond = threading.Condition(threading.RLock())
+        self.closed = False
+        self.lastSent = 0.0
+        # statistics
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.sentFrames = 0
+        self.sentSensors = 0
+
+    def put(self, data):
+        """
+        queue the sensors of the dict data: never blocks
+        """
+        with self.cond:
+            for key in data:
+                if key in self.pending:
+                    self.coalesced += 1
+                elif len(self.pending) >= self.maxPending:
+                    self.dropped += 1
+                    continue
+                else:
+                    self.queued += 1
+                self.pending[key] = data[key]
+            self.cond.notify()
+
+    def takeBatch(self, now):
+        """
+        return a list of (sensor, value) if the max rate allows to send
+        now, otherwise None. Never blocks
+        """
+        with self.cond:
+            if not self.pending or now < self.lastSent + self.minInterval:
+                return None
+            batch = []
+            while self.pending and len(batch) < self.maxBatch:
+                batch.append(self.pending.popitem(last=False))
+            self.lastSent = now
+            self.sentFrames += 1
+            self.sentSensors += len(batch)
+            return batch
+
+    def nextSendTime(self):
+        """
+        time when the pending sensors can be sent, None if nothing is pending
+        """
+        with self.cond:
+            if not self.pending:
+                return None
+            return self.lastSent + self.minInterval
+
+    def getBatch(self):
+        """
+        wait for pending sensors respecting the max rate and return a list
+        of (sensor, value). Return None when the queue is closed
+        """
+        with self.cond:
+            while True:
+                if self.closed:
+                    return None
+                if self.pending:
+                    wait = self.lastSent + self.minInterval - time.time()
+                    if wait <= 0:
+                        return self.takeBatch(time.time())
+                    self.cond.wait(wait)
+                else:
+                    self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def pendingItems(self):
+        """
+        list of the (sensor, value) queued and not yet sent
+        """
+        with self.cond:
+            return self.pending.items()
+
+    def depth(self):
+        return len(self.pending)
+
+    def stats(self):
+        """
+        counters useful to size the queue
+        """
+        with self.cond:
+            return {'queuedepth': len(self.pending),
+                    'queuequeued': self.queued,
+                    'queuecoalesced': self.coalesced,
+                    'queuedropped': self.dropped,
+                    'queueframes': self.sentFrames,
+                    'queuesensors': self.sentSensors}
+
+
+class PeerWriter(threading.Thread):
+    """
+    Thread writing the frames of a single Scratch peer. The frames are
+    already encoded (the same frame object is shared by all the peers) and
+    the socket is written with MSG_DONTWAIT, so a slow peer only grows its
+    own backlog. When the backlog exceeds maxBacklog bytes it is replaced
+    by a snapshot of the latest values (resync)
+    """
+    def __init__(self, session, fanout, maxBacklog=DEFAULT_MAX_BACKLOG, host=None):
+        threading.Thread.__init__(self)
+        self.scratch_socket = session.socket
+        self.host = host
+        self.fanout = fanout
+        self.maxBacklog = maxBacklog
+        self.frames = deque()
+        self.backlog = 0
+        self.cond = threading.Condition(threading.Lock())
+        self._stop = threading.Event()
+        self.onError = None     # called with the exception when the socket breaks
+        # statistics
+        self.sentFrames = 0
+        self.resyncs = 0
+        logger.debug("Writer Init")
+
+    def sendFrame(self, frame):
+        """
+        queue an encoded frame: never blocks
+        """
+        with self.cond:
+            if self.backlog + len(frame) > self.maxBacklog:
+                self.frames.clear()
+                self.resyncs += 1
+                frame = self.fanout.snapshot()
+                self.backlog = 0
+                logger.debug("peer too slow: backlog replaced by a snapshot")
+            if capture is not None:
+                capture.outbound(self.host, frame[4:])
+            self.frames.append(frame)
+            self.backlog += len(frame)
+            self.cond.notify()
+
+    def put(self, data):
+        """
+        send the dict data to this peer only (e.g. the replies to its commands)
+        """
+        self.sendFrame(S4AH_SC.encodeSensorUpdate(data.items()))
+
+    def stats(self):
+        """
+        counters of the shared queue and of this peer
+        """
+        stats = self.fanout.queue.stats()
+        with self.cond:
+            stats['peerbacklog'] = self.backlog
+            stats['peerframes'] = self.sentFrames
+            stats['peerresyncs'] = self.resyncs
+        return stats
+
+    def stop(self):
+        """
+        Set the thread as stopped
+        """
+        self._stop.set()
+        with self.cond:
+            self.cond.notify()
+
+    def stopped(self):
+        """
+        Check if this thread is stopped
+        """
+        return self._stop.isSet()
+
+    def write(self, frame):
+        """
+        write the whole frame without blocking on the socket: wait for
+        writability in small steps to notice the stop
+        """
+        view = memoryview(frame)
+        while view and not self.stopped():
+            try:
+                n = self.scratch_socket.send(view, socket.MSG_DONTWAIT)
+                view = view[n:]
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                select.select([], [self.scratch_socket], [], 0.1)
+
+    def run(self):
+        logger.debug("Writer running in thread %s ...", self.name)
+        while not self.stopped():
+            with self.cond:
+                while not self.frames and not self.stopped():
+                    self.cond.wait()
+                if self.stopped():
+                    break
+                frame = self.frames.popleft()
+                self.backlog -= len(frame)
+            try:
+                start = time.time()
+                self.write(frame)
+                S4AH_ST.stats.record('send', start)
+                self.sentFrames += 1
+            except socket.error, e:
+                logger.debug("writer raises socket error %s", e)
+                if self.onError:
+                    self.onError(e)
+                break
+        logger.debug("Writer stopped")
+
+
+class FrameFanout(threading.Thread):
+    """
+    Thread taking the coalesced batches of the shared queue: each batch is
+    encoded once and the same frame is handed to every connected peer
+    """
+    def __init__(self, queue):
+        threading.Thread.__init__(self)
+        self.queue = queue
+        self.peers = []
+        self.lock = threading.Lock()
+        self.latest = {}        # latest value sent of each sensor
+        self._stop = threading.Event()
+
+    def addPeer(self, writer):
+        with self.lock:
+            self.peers.append(writer)
+        if self.latest:
+            writer.sendFrame(self.snapshot())
+
+    def removePeer(self, writer):
+        with self.lock:
+            if writer in self.peers:
+                self.peers.remove(writer)
+
+    def snapshot(self):
+        """
+        frame with the latest value of every sensor sent
+        """
+        with self.lock:
+            return S4AH_SC.encodeSensorUpdate(self.latest.items())
+
+    def stop(self):
+        self._stop.set()
+        self.queue.close()
+
+    def stopped(self):
+        return self._stop.isSet()
+
+    def run(self):
+        logger.debug("Fanout running in thread %s ...", self.name)
+        while not self.stopped():
+            batch = self.queue.getBatch()
+            if batch is None:
+                break
+            frame = S4AH_SC.encodeSensorUpdate(batch)
+            with self.lock:
+                self.latest.update(batch)
+                peers = list(self.peers)
+            for writer in peers:
+                writer.sendFrame(frame)
+        logger.debug("Fanout stopped")
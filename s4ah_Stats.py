@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+#s4ah_Stats - latency histograms and counters of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import time
+import errno
+import select
+import socket
+import bisect
+import logging
+import threading
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+# Measured stages:
+# receive   session.receive (threads engine, it includes the wait for the message)
+#           or the recv of the socket (eventloop engine)
+# parse     from the raw message to the resolved command handlers
+# pinupdate write of an OUTPUT pin
+# groupupdate write of the changed pins of a pin group
+# pinread   read of a single pin
+# sweep     read of all the polled INPUT pins
+# send      write of a sensor-update frame to a Scratch peer
+STAGES = ['receive', 'parse', 'pinupdate', 'groupupdate', 'pinread', 'sweep', 'send']
+
+CLOCK_MONOTONIC = 1
+
+
+def _monotonicClock():
+    """
+    return a function reading CLOCK_MONOTONIC in seconds: python 2 has no
+    time.monotonic, clock_gettime is called through ctypes. time.time is
+    the last resort
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    import ctypes
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for name in (None, 'librt.so.1'):
+        try:
+            # PyDLL keeps the GIL during the (vDSO, very short) call: the
+            # timespec can be shared by the threads
+            clock_gettime = ctypes.PyDLL(name).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+        ref = ctypes.byref(ts)
+        def monotonic():
+            clock_gettime(CLOCK_MONOTONIC, ref)
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return monotonic
+    return time.time
+
+
+def monotonic():
+    """
+    seconds of a clock not affected by the changes of the system time. The
+    clock is resolved by the first call, which replaces this function: the
+    handler doesn't load ctypes at start (callers use S4AH_ST.monotonic())
+    """
+    global monotonic
+    monotonic = _monotonicClock()
+    return monotonic()
+
+# upper bounds of the buckets in seconds: 1, 2, 5 steps from 1 usec to 50 secs
+BUCKETS = [m * 10.0 ** e for e in range(-6, 2) for m in (1, 2, 5)]
+# samples kept raw before being counted in the buckets
+FOLD_SIZE = 256
+
+
+class Histogram:
+    """
+    Fixed buckets histogram of durations. Adding a sample is a list append:
+    the samples are counted in the buckets FOLD_SIZE at a time or when the
+    numbers are read. The percentiles are the upper bounds of the buckets
+    """
+    def __init__(self):
+        self.samples = []
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        del self.samples[:]
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.samples.append(elapsed)
+        if len(self.samples) >= FOLD_SIZE:
+            self.fold()
+
+    def fold(self):
+        """
+        count the raw samples in the buckets
+        """
+        # the list is emptied in place: the recorders keep a reference to it
+        samples = self.samples[:]
+        del self.samples[:len(samples)]
+        counts = self.counts
+        for elapsed in samples:
+            counts[bisect.bisect_left(BUCKETS, elapsed)] += 1
+        if samples:
+            self.count += len(samples)
+            self.total += sum(samples)
+            self.max = max(self.max, max(samples))
+
+    def percentile(self, p):
+        """
+        upper bound (in seconds) of the bucket holding the p percentile
+        """
+        self.fold()
+        if not self.count:
+            return 0.0
+        target = max(int(self.count * p / 100.0 + 0.999999), 1)
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                break
+        if i < len(BUCKETS):
+            return min(BUCKETS[i], self.max)
+        return self.max
+
+    def toDict(self):
+        self.fold()
+        return {'count': self.count,
+                'mean_ms': self.total * 1000.0 / self.count if self.count else 0.0,
+                'max_ms': self.max * 1000.0,
+                'p50_ms': self.percentile(50) * 1000.0,
+                'p90_ms': self.percentile(90) * 1000.0,
+                'p99_ms': self.percentile(99) * 1000.0,
+                'buckets': [[bound * 1000.0, n] for (bound, n) in zip(BUCKETS + [None], self.counts) if n]}
+
+
+class Stats:
+    """
+    Histograms of the stages and counters, always on. The updates are not
+    locked: with several threads a rare sample can be lost, which is fine
+    for statistics and keeps the hot paths cheap
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = dict((name, Histogram()) for name in STAGES)
+        self.counters = {}
+
+    def record(self, name, start):
+        """
+        add the time elapsed since start to the histogram name
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        samples = histogram.samples
+        samples.append(time.time() - start)
+        if len(samples) >= FOLD_SIZE:
+            histogram.fold()
+
+    def add(self, name, elapsed):
+        """
+        add a duration measured by the caller (e.g. on the monotonic clock)
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(elapsed)
+
+    def recorder(self, name):
+        """
+        return a function(start) doing the same as record(name, start) at a
+        fraction of the cost: used by the hot paths (e.g. pinUpdate)
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        samples = histogram.samples
+        append = samples.append
+        fold = histogram.fold
+        now = time.time
+        def record(start):
+            append(now() - start)
+            if len(samples) >= FOLD_SIZE:
+                fold()
+        return record
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        self.started = time.time()
+        for name in self.histograms:
+            self.histograms[name].clear()
+        self.counters.clear()
+
+    def sensors(self):
+        """
+        p50 and p99 (msecs) of the used stages and the counters as Scratch sensors
+        """
+        data = {}
+        for name in self.histograms:
+            histogram = self.histograms[name]
+            histogram.fold()
+            if histogram.count:
+                data['stat_%s_p50' % name] = round(histogram.percentile(50) * 1000.0, 3)
+                data['stat_%s_p99' % name] = round(histogram.percentile(99) * 1000.0, 3)
+                data['stat_%s_count' % name] = histogram.count
+        for name in self.counters:
+            data['stat_' + name] = self.counters[name]
+        return data
+
+    def dump(self):
+        """
+        all the numbers as a JSON string
+        """
+        import json     # only needed by the stats file and socket
+        return json.dumps({'uptime': time.time() - self.started,
+                           'histograms': dict((name, self.histograms[name].toDict())
+                                              for name in self.histograms),
+                           'counters': self.counters}, sort_keys=True)
+
+    def writeFile(self, path):
+        """
+        write the dump replacing the file atomically
+        """
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as fh:
+                fh.write(self.dump() + '\n')
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            logger.error("unable to write stats to %s: %s", path, e)
+
+
+class StatsServer(threading.Thread):
+    """
+    UNIX socket sending the dump to each client that connects, e.g.
+    socat - UNIX-CONNECT:/tmp/scratch4acmeboards.stats
+    The eventloop engine registers fileno() and calls serveOne(), the
+    threads engine starts the thread
+    """
+    def __init__(self, path, stats):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.stats = stats
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self._stop = threading.Event()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def serveOne(self):
+        try:
+            conn = self.sock.accept()[0]
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        try:
+            conn.sendall(self.stats.dump() + '\n')
+        except socket.error, e:
+            logger.debug("stats client error %s", e)
+        conn.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def stopped(self):
+        return self._stop.isSet()
+
+    def run(self):
+        while not self.stopped():
+            if select.select([self.sock], [], [], 0.5)[0]:
+                self.serveOne()
+
+    def close(self):
+        self.stop()
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def processStartTime():
+    """
+    time.time() of the start of this process (before the interpreter
+    loaded anything), None if /proc can't tell it
+    """
+    try:
+        with open('/proc/self/stat') as fh:
+            # the fields after the command name, which can contain spaces
+            fields = fh.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as fh:
+            uptime = float(fh.read().split()[0])
+        started = int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return time.time() - (uptime - started)
+
+
+class StartupProfile:
+    """
+    Wall clock time of the startup phases: mark() closes the current phase.
+    The first phase (interpreter) goes from the process start to start
+    """
+    def __init__(self, start):
+        self.phases = []      # (name, seconds)
+        self.last = start
+        processStart = processStartTime()
+        if processStart is not None:
+            self.phases.append(('interpreter', max(start - processStart, 0.0)))
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        """
+        the lines of the timing report
+        """
+        lines = ['startup profile:']
+        for (phase, elapsed) in self.phases:
+            lines.append('  %-12s %8.1f ms' % (phase, elapsed * 1000.0))
+        lines.append('  %-12s %8.1f ms' % ('total', sum(elapsed for (phase, elapsed) in self.phases) * 1000.0))
+        return lines
+
+
+# statistics of the whole handler
+stats = Stats()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#s4ah_VirtualGPIO - in memory GPIO backend with scripted inputs for scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# A stimulus script drives the INPUT pins of the virtual backend, one line
+# for each pin (or shell pattern of pin names, e.g. V* or PA?):
+#   PA3   square PERIOD [DUTY]              square wave, period in msecs, duty in percent (50)
+#   PA4   burst  GAP COUNT BOUNCE [SEED]    bursts of COUNT toggles BOUNCE msecs apart (a bouncing
+#                                           button) at random intervals of GAP msecs on average
+#   PA5   trace  FILE [loop]                recorded trace: lines "MSECS VALUE" from the start
+# Empty lines and the text after # are ignored. The value of a pin is
+# computed when the pin is read: no thread, the cost doesn't grow with the rates.
+
+
+import os
+import bisect
+import random
+import fnmatch
+import logging
+import s4ah_GPIOController as S4AH
+import s4ah_Stats as S4AH_ST
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+DEFAULT_PINS = 64       # pins of the virtual board when ablib isn't available
+
+
+class StimulusError(Exception):
+    pass
+
+
+def virtualBoardDescriptor(numPins=DEFAULT_PINS):
+    """
+    board descriptor (see S4AH.loadBoardDescriptor) of numPins pins V0, V1 ...
+    """
+    return sorted(('V%d' % i, i, 'V.%d' % i, (S4AH.CAP_GPIO,)) for i in xrange(numPins))
+
+
+class SquareWave:
+    def __init__(self, period, duty=50.0):
+        if period <= 0 or not 0 <= duty <= 100:
+            raise StimulusError("square: invalid period %s or duty %s" % (period, duty))
+        self.period = period
+        self.high = period * duty / 100.0
+
+    def value(self, t):
+        return 1 if t % self.period < self.high else 0
+
+    def clone(self, n):
+        return self
+
+
+class Bursts:
+    """
+    random bursts of toggles: the events are drawn when the time passes,
+    the reads of a pin have increasing times
+    """
+    def __init__(self, gap, count, bounce, seed=None):
+        if gap <= 0 or count < 1 or bounce < 0:
+            raise StimulusError("burst: invalid gap %s, count %s or bounce %s" % (gap, count, bounce))
+        self.gap = gap
+        self.count = count
+        self.bounce = bounce
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.level = 0
+        self.pending = 0         # toggles left in the current burst
+        self.next = self.random.expovariate(1.0 / gap)
+
+    def value(self, t):
+        while self.next <= t:
+            if not self.pending:
+                self.pending = self.count
+            self.level ^= 1
+            self.pending -= 1
+            if self.pending:
+                self.next += self.bounce
+            else:
+                self.next += self.random.expovariate(1.0 / self.gap)
+        return self.level
+
+    def clone(self, n):
+        """
+        the same bursts for the n-th pin of a pattern: a different seed
+        """
+        seed = self.seed + n if self.seed is not None else None
+        return Bursts(self.gap, self.count, self.bounce, seed)
+
+
+class Trace:
+    """
+    recorded values: (secs, value) sorted by time, repeated if loop
+    """
+    def __init__(self, events, loop=False):
+        if not events:
+            raise StimulusError("trace: no values")
+        self.times = [t for (t, v) in events]
+        self.values = [v for (t, v) in events]
+        self.loop = loop and self.times[-1] > 0
+
+    def value(self, t):
+        if self.loop:
+            t %= self.times[-1]
+        i = bisect.bisect_right(self.times, t)
+        return self.values[max(i - 1, 0)]
+
+    def clone(self, n):
+        return self
+
+
+def readTrace(path):
+    events = []
+    with open(path) as fh:
+        for line in fh:
+            words = line.split('#', 1)[0].split()
+            if not words:
+                continue
+            try:
+                events.append((float(words[0]) / 1000.0, 1 if int(words[1]) else 0))
+            except (IndexError, ValueError):
+                raise StimulusError("%s: invalid line %s" % (path, line.strip()))
+    events.sort()
+    return events
+
+
+def parseStimulus(words, baseDir):
+    """
+    return the stimulus of a script line split in words (without the pin)
+    """
+    kind = words[0].lower()
+    args = words[1:]
+    try:
+        if kind == 'square':
+            return SquareWave(float(args[0]) / 1000.0, float(args[1]) if len(args) > 1 else 50.0)
+        if kind == 'burst':
+            seed = int(args[3]) if len(args) > 3 else None
+            return Bursts(float(args[0]) / 1000.0, int(args[1]), float(args[2]) / 1000.0, seed)
+        if kind == 'trace':
+            path = os.path.join(baseDir, args[0])
+            return Trace(readTrace(path), len(args) > 1 and args[1].lower() == 'loop')
+    except (IndexError, ValueError):
+        raise StimulusError("%s: invalid arguments %s" % (kind, ' '.join(args)))
+    except IOError, e:
+        raise StimulusError("trace: %s" % e)
+    raise StimulusError("unknown stimulus %s" % kind)
+
+
+class VirtualBackend:
+    """
+    Pins kept in memory, indexed by PinData.index: no ablib, no sysfs, no
+    syscalls. The INPUT pins with a stimulus read its value at the time of
+    the read, the others read the last value written
+    """
+    supportsEdge = False
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.levels = bytearray(len(controller.pinTable))
+        self.stimuli = [None] * len(controller.pinTable)
+        self.start = S4AH_ST.monotonic()
+
+    def loadStimulus(self, path):
+        """
+        read a stimulus script: StimulusError on errors. The pins matched by
+        several lines take the last one
+        """
+        pinNames = [pin.name for pin in self.controller.pinTable]
+        stimuli = list(self.stimuli)
+        try:
+            with open(path) as fh:
+                lines = fh.readlines()
+        except IOError, e:
+            raise StimulusError(str(e))
+        for (n, line) in enumerate(lines):
+            words = line.split('#', 1)[0].split()
+            if not words:
+                continue
+            if len(words) < 2:
+                raise StimulusError("%s line %d: expected pin kind arguments" % (path, n + 1))
+            pin = self.controller.lookupPin(words[0])
+            matched = [pin.name] if pin is not None else fnmatch.filter(pinNames, words[0].upper())
+            if not matched:
+                raise StimulusError("%s line %d: unknown pin %s" % (path, n + 1, words[0]))
+            stimulus = parseStimulus(words[1:], os.path.dirname(path))
+            for (i, name) in enumerate(matched):
+                # the stateful stimuli (bursts) are cloned for each pin
+                stimuli[self.controller.lookupPin(name).index] = stimulus.clone(i)
+        self.stimuli = stimuli
+        self.start = S4AH_ST.monotonic()
+        logger.debug("stimulus %s loaded: %d pins driven", path,
+                     len([s for s in stimuli if s is not None]))
+
+    def setMode(self, pin, mode):
+        pass
+
+    def release(self, pin):
+        self.levels[pin.index] = 0
+
+    def unexport(self, pin):
+        self.release(pin)
+
+    def write(self, pin, value):
+        self.levels[pin.index] = 1 if value else 0
+
+    def writeMany(self, changes):
+        for (pin, value) in changes:
+            self.write(pin, value)
+
+    def read(self, pin, now=None):
+        stimulus = self.stimuli[pin.index]
+        if stimulus is None or pin.mode != S4AH.PINPUT:
+            return self.levels[pin.index]
+        if now is None:
+            now = S4AH_ST.monotonic() - self.start
+        value = stimulus.value(now)
+        self.levels[pin.index] = value
+        return value
+
+    def readInputs(self, pins):
+        """
+        read all the passed pins at the same time
+        """
+        now = S4AH_ST.monotonic() - self.start
+        return [(pin, self.read(pin, now)) for pin in pins]
+
+    def close(self):
+        pass
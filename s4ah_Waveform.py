@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#s4ah_Waveform - waveforms and step sequences on the output pins of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import fcntl
+import heapq
+import select
+import logging
+import threading
+import s4ah_GPIOController as S4AH
+import s4ah_Stats as S4AH_ST
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+MIN_STEP = 0.0005     # shorter steps (seconds) can't be driven from python
+
+# statistics: lateness of each step (histogram) and steps skipped because
+# their time was already over when the thread woke up (counter)
+JITTER_STAGE = 'wavejitter'
+MISSED_COUNTER = 'wavemissed'
+
+
+class Waveform:
+    """
+    A sequence of (value, seconds) steps driven on a pin or on a pin group,
+    repeated repeat times (0 = forever). The last value written stays
+    """
+    def __init__(self, target, isGroup, steps, repeat=0):
+        self.target = target
+        self.isGroup = isGroup
+        self.steps = steps
+        self.repeat = repeat
+        self.index = 0          # step to write at deadline
+        self.cycles = 0         # completed repetitions
+        self.deadline = 0.0     # monotonic time of the next step
+        self.written = False    # after the first write the pins must stay OUTPUT
+        self.active = True
+
+    def __repr__(self):
+        return "Waveform %s, steps %s, repeat %d" % (self.target, self.steps, self.repeat)
+
+    def isLastStep(self):
+        return (self.repeat and self.cycles == self.repeat - 1
+                and self.index == len(self.steps) - 1)
+
+    def advance(self):
+        self.deadline += self.steps[self.index][1]
+        self.index += 1
+        if self.index == len(self.steps):
+            self.index = 0
+            self.cycles += 1
+
+
+class WaveformScheduler(threading.Thread):
+    """
+    Drive all the active waveforms from a single thread: a heap of the
+    deadlines on the monotonic clock and a select on a wakeup pipe, which
+    sleeps exactly until the next step or until a waveform is changed.
+    The thread starts with the first waveform. A waveform stops when one of
+    its pins is no longer an OUTPUT (e.g. configured as INPUT or reset):
+    the scheduler is a mode listener of the controller
+    """
+    def __init__(self, controller):
+        threading.Thread.__init__(self, name='WaveformScheduler')
+        self.daemon = True
+        self.controller = controller
+        self.heap = []          # (deadline, seq, Waveform)
+        self.seq = 0
+        self.waveforms = {}     # target -> active Waveform
+        # reentrant: the writes of fire() notify the mode changes to modeChanged()
+        self.lock = threading.RLock()
+        (self.wakeRead, self.wakeWrite) = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._stop = threading.Event()
+        controller.modeListeners.append(self.modeChanged)
+
+    def stop(self):
+        self._stop.set()
+        self.wake()
+
+    def stopped(self):
+        return self._stop.isSet()
+
+    def wake(self):
+        try:
+            os.write(self.wakeWrite, b'w')
+        except OSError:
+            pass    # the pipe is full: the thread is already waking up
+
+    def resolveTarget(self, target):
+        """
+        return (name, isGroup) of a pin or pin group name, None if unknown
+        """
+        pin = self.controller.lookupPin(target)
+        if pin is not None:
+            return (pin.name, False)
+        if target.lower() in self.controller.pinGroups:
+            return (target.lower(), True)
+        logger.error("unknown pin or pin group %s", target)
+        return None
+
+    def add(self, target, steps, repeat):
+        """
+        start a waveform on target, replacing the one already running on it
+        """
+        resolved = self.resolveTarget(target)
+        if resolved is None:
+            return None
+        if [duration for (value, duration) in steps if duration < MIN_STEP]:
+            logger.error("waveform on %s with steps shorter than %.1f ms", target, MIN_STEP * 1000)
+            return None
+        (name, isGroup) = resolved
+        limit = 1 << len(self.controller.pinGroups[name]) if isGroup else 2
+        if [value for (value, duration) in steps if not 0 <= value < limit]:
+            logger.error("waveform on %s with values out of range 0-%d", target, limit - 1)
+            return None
+        waveform = Waveform(name, isGroup, steps, repeat)
+        with self.lock:
+            old = self.waveforms.get(waveform.target)
+            if old is not None:
+                old.active = False
+            self.waveforms[waveform.target] = waveform
+            # the first step is written at once: the pins are OUTPUT on return
+            waveform.deadline = S4AH_ST.monotonic()
+            self.fire(waveform, waveform.deadline)
+        logger.debug("%s started", waveform)
+        if self.ident is None:
+            self.start()
+        self.wake()
+        return waveform
+
+    def push(self, waveform):
+        self.seq += 1
+        heapq.heappush(self.heap, (waveform.deadline, self.seq, waveform))
+
+    def squareWave(self, target, period, duty, repeat=0):
+        """
+        period in seconds, duty in percent (of the period the pin is on)
+        """
+        if duty <= 0:
+            steps = [(0, period)]
+        elif duty >= 100:
+            steps = [(1, period)]
+        else:
+            steps = [(1, period * duty / 100.0), (0, period * (100 - duty) / 100.0)]
+        return self.add(target, steps, repeat)
+
+    def sequence(self, target, stepTime, values, repeat=0):
+        """
+        write the values one after the other, each for stepTime seconds
+        """
+        return self.add(target, [(value, stepTime) for value in values], repeat)
+
+    def stopWaveform(self, target):
+        resolved = self.resolveTarget(target)
+        if resolved is None:
+            return
+        with self.lock:
+            waveform = self.waveforms.pop(resolved[0], None)
+            if waveform is not None:
+                waveform.active = False
+                logger.debug("%s stopped", waveform)
+
+    def stopAll(self):
+        with self.lock:
+            for target in self.waveforms:
+                self.waveforms[target].active = False
+            self.waveforms.clear()
+            del self.heap[:]
+
+    def isOutput(self, waveform):
+        if waveform.isGroup:
+            pins = self.controller.pinGroups.get(waveform.target, ())
+        else:
+            pins = (waveform.target,)
+        for pinName in pins:
+            if self.controller.ValidPins[pinName].mode != S4AH.POUTPUT:
+                return False
+        return bool(pins)
+
+    def modeChanged(self):
+        """
+        stop the waveforms whose pins are no longer in OUTPUT mode
+        """
+        with self.lock:
+            for waveform in self.waveforms.values():
+                if waveform.written and not self.isOutput(waveform):
+                    logger.debug("%s stopped: pins no longer in OUTPUT mode", waveform)
+                    self.finish(waveform)
+
+    def finish(self, waveform):
+        waveform.active = False
+        if self.waveforms.get(waveform.target) is waveform:
+            del self.waveforms[waveform.target]
+
+    def fire(self, waveform, now):
+        """
+        write the step due of the waveform and schedule the next one
+        """
+        S4AH_ST.stats.add(JITTER_STAGE, now - waveform.deadline)
+        # the steps already over are skipped: the phase is kept
+        while (waveform.deadline + waveform.steps[waveform.index][1] <= now
+               and not waveform.isLastStep()):
+            S4AH_ST.stats.count(MISSED_COUNTER)
+            waveform.advance()
+
+        value = waveform.steps[waveform.index][0]
+        if waveform.isGroup:
+            self.controller.groupUpdate(waveform.target, value)
+        else:
+            self.controller.pinUpdate(waveform.target, value)
+        waveform.written = True
+
+        if waveform.isLastStep():
+            logger.debug("%s completed", waveform)
+            self.finish(waveform)
+            return
+        waveform.advance()
+        self.push(waveform)
+
+    def runDue(self, now=None):
+        """
+        fire the waveforms whose deadline is over at now (default: the
+        monotonic clock): return the seconds until the next deadline, None
+        if there are no waveforms
+        """
+        with self.lock:
+            clock = now is None
+            if clock:
+                now = S4AH_ST.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                waveform = heapq.heappop(self.heap)[2]
+                if waveform.active:
+                    self.fire(waveform, now)
+            if not self.heap:
+                return None
+            if clock:
+                now = S4AH_ST.monotonic()   # the writes took some time
+            return max(self.heap[0][0] - now, 0)
+
+    def run(self):
+        logger.debug("Waveform scheduler running as thread %s ...", self.name)
+        while not self.stopped():
+            timeout = self.runDue()
+            if select.select([self.wakeRead], [], [], timeout)[0]:
+                try:
+                    os.read(self.wakeRead, 4096)
+                except OSError:
+                    pass
+
+    def close(self):
+        if self.modeChanged in self.controller.modeListeners:
+            self.controller.modeListeners.remove(self.modeChanged)
+        self.stopAll()
+        self.stop()
+        if self.ident is not None:
+            self.join(1.0)
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
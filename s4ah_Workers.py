@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#s4ah_Workers - worker threads for the slow commands of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import Queue
+import logging
+import threading
+import s4ah_Stats as S4AH_ST
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_PENDING = 8      # jobs waiting for a worker, the others are dropped
+
+# statistics: jobs dropped because the pool was full (counter)
+DROPPED_COUNTER = 'jobsdropped'
+
+
+def callDirectly(callback, result):
+    return callback(result)
+
+
+class WorkerPool:
+    """
+    A few daemon threads running the commands that can block (process
+    spawns, network lookups), so the listener goes on dispatching the pin
+    commands. submit() never blocks: when maxPending jobs are already
+    waiting the job is dropped.
+    The result of a job is passed to its callback through deliver(callback,
+    result): called by the worker itself by default, the event loop
+    engine replaces it to run the callbacks on its own thread.
+    The threads start with the first job
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, maxPending=DEFAULT_MAX_PENDING):
+        self.jobs = Queue.Queue(maxPending)
+        self.numWorkers = workers
+        self.threads = []
+        self.lock = threading.Lock()
+        self.deliver = callDirectly
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for n in xrange(self.numWorkers):
+                thread = threading.Thread(target=self.run, name='Worker-%d' % n)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, name, function, callback=None):
+        """
+        run function() on a worker, then callback(result) if passed:
+        return False if the job was dropped
+        """
+        self.start()
+        try:
+            self.jobs.put_nowait((name, function, callback))
+        except Queue.Full:
+            S4AH_ST.stats.count(DROPPED_COUNTER)
+            logger.error("%s dropped: %d jobs already waiting", name, self.jobs.qsize())
+            return False
+        return True
+
+    def run(self):
+        logger.debug("Worker running as thread %s ...", threading.currentThread().name)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            (name, function, callback) = job
+            try:
+                result = function()
+            except Exception:
+                logger.exception("%s failed", name)
+                continue
+            if callback is not None:
+                try:
+                    self.deliver(callback, result)
+                except Exception:
+                    logger.exception("reply of %s failed", name)
+
+    def close(self, timeout=1.0):
+        """
+        stop the workers after the jobs already submitted
+        """
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        for thread in threads:
+            try:
+                self.jobs.put(None, True, timeout)
+            except Queue.Full:
+                break
+        for thread in threads:
+            thread.join(timeout)
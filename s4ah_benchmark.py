@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+#s4ah_benchmark - offline benchmarks of scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# For developers only: like the -o option of the handler it needs the
+# ablib modified to write on /tmp instead of the real /sys area
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import platform
+from optparse import OptionParser
+import s4ah_GPIOController as S4AH
+import s4ah_Dispatcher as S4AH_DP
+import s4ah_FakeMesh as S4AH_FM
+import s4ah_ScratchCodec as S4AH_SC
+import s4ah_Stats as S4AH_ST
+import s4ah_Waveform as S4AH_WF
+
+
+logger = logging.getLogger('s4ah_root_logger')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'benchmark_baseline.json')
+DEFAULT_TOLERANCE = 25.0     # percent of worsening accepted before a regression
+ENGINES = ['threads', 'eventloop']
+LATENCY_TIMEOUT = 5.0        # seconds waiting for a single sensor-update
+# options added to the command line of every handler started (e.g. --gpioworker)
+HANDLER_ARGS = []
+
+# broadcasts sent by a typical Scratch project: a few strings over and over
+BROADCASTS = ['pinPA23on', 'pinPA23off', 'configPA24in', 'configPA25out',
+              'allon', 'alloff', 'sghdebugoff', 'getversion', 'unknownmessage']
+
+
+def percentile(values, p):
+    """
+    nearest-rank percentile of the sorted list values
+    """
+    if not values:
+        return None
+    index = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+class Results:
+    """
+    Collect the measures as name -> {value, unit, better}. better is
+    'lower' for times and 'higher' for throughputs
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.notes = []
+
+    def add(self, name, value, unit, better='lower'):
+        self.metrics[name] = {'value': value, 'unit': unit, 'better': better}
+        print "%-55s %12.3f %s" % (name, value, unit)
+
+    def skip(self, name, reason):
+        self.notes.append("%s skipped: %s" % (name, reason))
+        print "%-55s skipped (%s)" % (name, reason)
+
+    def toDict(self):
+        return {'meta': {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                         'host': platform.node(),
+                         'platform': platform.platform(),
+                         'python': platform.python_version(),
+                         'ablib': str(S4AH.AB.getVersion()) if S4AH.AB else None},
+                'metrics': self.metrics,
+                'notes': self.notes}
+
+
+def compare(current, baseline, tolerance):
+    """
+    compare two results dicts: return the list of the regressions as
+    (name, baseline value, current value, worsening percent)
+    """
+    regressions = []
+    for name in sorted(current['metrics']):
+        if name not in baseline['metrics']:
+            continue
+        new = current['metrics'][name]
+        old = baseline['metrics'][name]['value']
+        if not old or new['value'] is None:
+            continue
+        if new['better'] == 'lower':
+            change = (new['value'] - old) * 100.0 / old
+        else:
+            change = (old - new['value']) * 100.0 / old
+        if change > tolerance:
+            regressions.append((name, old, new['value'], change))
+    return regressions
+
+
+def boardPins(controller):
+    """
+    pin names of the board in a stable order
+    """
+    return sorted(controller.ValidPins.keys())
+
+
+def pinCounts(total):
+    """
+    pin counts measured by the sweep: powers of two up to all the pins
+    """
+    counts = []
+    n = 1
+    while n < total:
+        counts.append(n)
+        n *= 2
+    counts.append(total)
+    return counts
+
+
+def benchSweep(results, prefix, controller, iterations):
+    """
+    time of a whole input sweep for a growing number of INPUT pins
+    """
+    pins = boardPins(controller)
+    configured = 0
+    for count in pinCounts(len(pins)):
+        while configured < count:
+            controller.setPinMode(pins[configured], S4AH.PINPUT)
+            configured += 1
+        controller.readInputs()
+        start = time.time()
+        for i in xrange(iterations):
+            controller.readInputs()
+        elapsed = time.time() - start
+        results.add("%s/sweep/%dpins" % (prefix, count),
+                    elapsed * 1000.0 / iterations, 'ms')
+    controller.resetAllPins()
+
+
+def benchPinUpdate(results, prefix, controller, iterations):
+    """
+    pinUpdate throughput toggling a single OUTPUT pin
+    """
+    pin = boardPins(controller)[0]
+    controller.pinUpdate(pin, 0)
+    start = time.time()
+    for i in xrange(iterations):
+        controller.pinUpdate(pin, i & 1)
+    elapsed = time.time() - start
+    results.add("%s/pinupdate" % prefix, iterations / elapsed, 'writes/s', 'higher')
+    controller.resetAllPins()
+
+
+def benchGroupUpdate(results, prefix, controller, iterations):
+    """
+    groupUpdate throughput counting on a group of (up to) 8 OUTPUT pins
+    """
+    pins = boardPins(controller)[:8]
+    controller.definePinGroup('benchgroup', pins)
+    controller.groupUpdate('benchgroup', 0)
+    mask = (1 << len(pins)) - 1
+    start = time.time()
+    for i in xrange(iterations):
+        controller.groupUpdate('benchgroup', (i + 1) & mask)
+    elapsed = time.time() - start
+    results.add("%s/groupupdate/%d" % (prefix, len(pins)), iterations / elapsed, 'updates/s', 'higher')
+    controller.resetAllPins()
+
+
+def benchWaveform(results, prefix, controller, periods):
+    """
+    lateness of the steps of a square wave with 1 msec steps, measured
+    against the ideal times of the writes
+    """
+    pin = boardPins(controller)[0]
+    step = 0.001
+    writes = []
+    pinUpdate = controller.pinUpdate
+    def timedUpdate(pinName, value):
+        writes.append(S4AH_ST.monotonic())
+        pinUpdate(pinName, value)
+    controller.pinUpdate = timedUpdate
+    scheduler = S4AH_WF.WaveformScheduler(controller)
+    try:
+        waveform = scheduler.squareWave(pin, 2 * step, 50, periods)
+        while waveform.active:
+            time.sleep(0.05)
+    finally:
+        scheduler.close()
+        del controller.pinUpdate
+    # the missed steps are not written: each write is compared with the closest ideal time
+    start = writes[0]
+    lateness = sorted(((t - start + step / 2) % step - step / 2) * 1000.0 for t in writes[1:])
+    for p in (50, 99):
+        results.add("%s/waveform/p%d" % (prefix, p), percentile(lateness, p), 'ms')
+    results.add("%s/waveform/missed" % prefix, 2 * periods - len(writes), 'steps')
+    controller.resetAllPins()
+
+
+def benchDispatch(results, prefix, controller, iterations):
+    """
+    broadcast and sensor-update parse+dispatch throughput: handlers do
+    nothing, so only the resolution of the messages is measured
+    """
+    calls = [0]
+    def handler(pin, value):
+        calls[0] += 1
+    keys = ['pin', 'sensor', 'all', 'sghdebug', 'config', 'group', 'definegroup',
+            'wave', 'sequence', 'wavestop', 'filter', 'pwm', 'pwmperiod',
+            'gettime', 'getip', 'getversion', 'getqueuestats', 'getstats', 'dumplog', 'shutdown', 'stophandler']
+    handlers = dict((key, handler) for key in keys)
+    pins = boardPins(controller)
+    sensors = ['pin' + pin for pin in pins]
+
+    dispatcher = S4AH_DP.CommandDispatcher(controller, handlers)
+    start = time.time()
+    for i in xrange(iterations):
+        command = dispatcher.resolveBroadcast(BROADCASTS[i % len(BROADCASTS)])
+        if command:
+            command[0](command[1], command[2])
+    elapsed = time.time() - start
+    results.add("%s/dispatch/broadcast" % prefix, iterations / elapsed, 'msgs/s', 'higher')
+
+    start = time.time()
+    for i in xrange(iterations):
+        command = dispatcher.resolveSensor(sensors[i % len(sensors)])
+        if command:
+            command[0](command[1], i & 1)
+    elapsed = time.time() - start
+    results.add("%s/dispatch/sensor" % prefix, iterations / elapsed, 'msgs/s', 'higher')
+
+    # every message different: the memoization never helps
+    dispatcher = S4AH_DP.CommandDispatcher(controller, handlers)
+    messages = ['pin%s%s' % (pin, 'on' if i & 1 else 'off')
+                for i in range(2) for pin in pins]
+    messages += ['unknown%d' % i for i in xrange(max(iterations // 10 - len(messages), 0))]
+    start = time.time()
+    for msg in messages:
+        command = dispatcher.resolveBroadcast(msg)
+        if command:
+            command[0](command[1], command[2])
+    elapsed = time.time() - start
+    results.add("%s/dispatch/broadcastcold" % prefix, len(messages) / elapsed, 'msgs/s', 'higher')
+
+
+def openSession(results, prefix, board, engine, backend=S4AH.BACKEND_SYSFS):
+    """
+    start the handler with a fake mesh: None (and the test skipped) on failure.
+    With sysfs the inputs are changed writing the value files of the offline tree
+    """
+    try:
+        session = S4AH_FM.MeshSession(['-g', backend, '-b', board, '--engine', engine] + HANDLER_ARGS,
+                                      LATENCY_TIMEOUT)
+    except socket.error, e:
+        results.skip(prefix, "mesh port busy: %s" % e)
+        return None
+    if not session.connect():
+        results.skip(prefix, "the handler didn't connect")
+        session.close()
+        return None
+    return session
+
+
+def benchLatency(results, prefix, controller, board, engine, samples):
+    """
+    time from the change of an INPUT pin value file to the sensor-update
+    received by a fake Scratch mesh, with the handler in a child process
+    """
+    pin = boardPins(controller)[0]
+    valueFile = controller.pinPath(pin) + "/value"
+    sensor = '"pin%s"' % pin
+    with open(valueFile, 'w') as fh:
+        fh.write('0')
+
+    session = openSession(results, prefix, board, engine)
+    if session is None:
+        return
+    mesh = session.mesh
+    try:
+        mesh.broadcast('config' + pin + 'in')
+        if mesh.waitFor(sensor, LATENCY_TIMEOUT) is None:
+            results.skip(prefix, "no initial value of pin " + pin)
+            return
+        latencies = []
+        for i in xrange(samples):
+            value = (i + 1) & 1
+            mesh.drain()
+            start = time.time()
+            with open(valueFile, 'w') as fh:
+                fh.write(str(value))
+            received = mesh.waitFor('%s %d' % (sensor, value), LATENCY_TIMEOUT)
+            if received is None:
+                results.skip(prefix, "sensor-update lost")
+                return
+            latencies.append((received[0] - start) * 1000.0)
+        latencies.sort()
+        for p in (50, 90, 99):
+            results.add("%s/p%d" % (prefix, p), percentile(latencies, p), 'ms')
+    finally:
+        session.close()
+
+
+def benchMeshThroughput(results, prefix, controller, board, engine, count, backend):
+    """
+    messages per second handled by the handler with the GPIO backend:
+    pipelined pin broadcasts and sensor-updates are sent at once, the
+    getversion reply marks the end
+    """
+    pin = boardPins(controller)[0]
+    session = openSession(results, prefix, board, engine, backend)
+    if session is None:
+        return
+    mesh = session.mesh
+    try:
+        workloads = [('broadcast', [S4AH_SC.encodeBroadcast('pin%s%s' % (pin, 'on' if i & 1 else 'off'))
+                                    for i in xrange(count)]),
+                     ('sensorupdate', [S4AH_SC.encodeSensorUpdate([('pin' + pin, i & 1)])
+                                       for i in xrange(count)])]
+        for (name, frames) in workloads:
+            mesh.drain()
+            start = time.time()
+            mesh.sendFrames(frames + [S4AH_SC.encodeBroadcast('getversion')])
+            if mesh.waitFor('"version"', 60.0) is None:
+                results.skip("%s/%s" % (prefix, name), "no reply")
+                continue
+            results.add("%s/%s" % (prefix, name), count / (time.time() - start), 'msgs/s', 'higher')
+    finally:
+        session.close()
+
+
+def benchCodec(results, iterations):
+    """
+    throughput of the wire codec alone
+    """
+    data = [('pinPA23', 1), ('pinPA24', 0)]
+    start = time.time()
+    for i in xrange(iterations):
+        S4AH_SC.encodeSensorUpdate(data)
+    results.add("codec/encode", iterations / (time.time() - start), 'msgs/s', 'higher')
+
+    encoder = S4AH_SC.FrameEncoder()
+    payload = 'broadcast "pinPA23on"'
+    start = time.time()
+    for i in xrange(iterations):
+        encoder.frame(payload)
+    results.add("codec/frame", iterations / (time.time() - start), 'msgs/s', 'higher')
+
+    stream = ''.join([S4AH_SC.encodeBroadcast('pinPA23on'),
+                      S4AH_SC.encodeSensorUpdate(data),
+                      S4AH_SC.encodeSensorUpdate([('pinPA25', 'on')]),
+                      S4AH_SC.encodeBroadcast('sghdebug off')] * (iterations // 4))
+    decoder = S4AH_SC.FrameDecoder()
+    count = 0
+    start = time.time()
+    for offset in xrange(0, len(stream), 4096):
+        decoder.feed(stream[offset:offset + 4096])
+        for payload in decoder.frames():
+            S4AH_SC.parseMessage(payload)
+            count += 1
+    results.add("codec/decode", count / (time.time() - start), 'msgs/s', 'higher')
+
+
+FUZZ_CHARS = 'aZ09 _-"\t\xc3\xa8'
+
+
+def randomText(rand, minLength=0):
+    return ''.join([rand.choice(FUZZ_CHARS) for i in xrange(rand.randint(minLength, 12))])
+
+
+def fuzzCodec(rand, cases):
+    """
+    encode random messages, decode them from chunks of random size and
+    check they come back unchanged. Random bytes can only raise CodecError.
+    Return the number of failures
+    """
+    failures = 0
+    expected = []
+    stream = []
+    for i in xrange(cases):
+        if rand.random() < 0.5:
+            name = randomText(rand)
+            expected.append(('broadcast', name))
+            stream.append(S4AH_SC.encodeBroadcast(name))
+        else:
+            data = dict((randomText(rand), randomText(rand)) for j in xrange(rand.randint(1, 5)))
+            expected.append(('sensor-update', data))
+            stream.append(S4AH_SC.encodeSensorUpdate(data.items()))
+    stream = ''.join(stream)
+    decoder = S4AH_SC.FrameDecoder(size=64)
+    received = []
+    offset = 0
+    while offset < len(stream):
+        n = rand.randint(1, 300)
+        decoder.feed(stream[offset:offset + n])
+        offset += n
+        received.extend([S4AH_SC.parseMessage(payload) for payload in decoder.frames()])
+    for (sent, got) in zip(expected, received):
+        if sent != got:
+            failures += 1
+            print "FUZZ codec: sent %r got %r" % (sent, got)
+    if len(received) != len(expected):
+        failures += 1
+        print "FUZZ codec: %d messages sent, %d received" % (len(expected), len(received))
+
+    for i in xrange(cases):
+        garbage = ''.join([chr(rand.randint(0, 255)) for j in xrange(rand.randint(0, 64))])
+        decoder = S4AH_SC.FrameDecoder(size=16, maxFrame=4096)
+        try:
+            decoder.feed(garbage)
+            for payload in decoder.frames():
+                S4AH_SC.parseMessage(payload)
+        except S4AH_SC.CodecError:
+            pass
+        except Exception, e:
+            failures += 1
+            print "FUZZ codec: %r raises %r" % (garbage, e)
+    return failures
+
+
+def fuzzMesh(results, rand, board, engine, cases):
+    """
+    send random frames to the handler: it must survive and still answer.
+    Return the number of failures
+    """
+    prefix = "%s/fuzz/%s" % (board, engine)
+    session = openSession(results, prefix, board, engine)
+    if session is None:
+        return 1
+    try:
+        frames = []
+        for i in xrange(cases):
+            choice = rand.random()
+            if choice < 0.3:
+                frames.append(S4AH_SC.encodeBroadcast(randomText(rand)))
+            elif choice < 0.6:
+                frames.append(S4AH_SC.encodeSensorUpdate([(randomText(rand), randomText(rand))]))
+            else:
+                frames.append(S4AH_SC.encodeFrame(''.join([chr(rand.randint(0, 255))
+                                                            for j in xrange(rand.randint(0, 64))])))
+        session.mesh.sendFrames(frames)
+        if not session.alive():
+            print "FUZZ %s: the handler doesn't answer anymore" % prefix
+            return 1
+        print "FUZZ %s: %d random frames survived" % (prefix, cases)
+        return 0
+    finally:
+        session.close()
+
+
+def benchBoard(results, board, options):
+    """
+    measure the board with each GPIO backend: the dispatch and mesh measures
+    once, with the first backend available, the latency with sysfs (the
+    inputs are changed through its value files). Return False if no backend
+    was available
+    """
+    measured = []
+    for backend in options.backends:
+        prefix = "%s/%s" % (board, backend)
+        try:
+            controller = S4AH.GPIOController(board, True, backend)
+        except (KeyError, S4AH.S4AHException), e:
+            results.skip(prefix, "board not available in this ablib: %s" % e)
+            continue
+        if not controller.ValidPins:
+            results.skip(prefix, "no pins")
+            continue
+        benchSweep(results, prefix, controller, options.iterations)
+        benchPinUpdate(results, prefix, controller, options.iterations * 10)
+        benchGroupUpdate(results, prefix, controller, options.iterations * 10)
+        benchWaveform(results, prefix, controller, options.iterations)
+        if not measured:
+            benchDispatch(results, board, controller, options.iterations * 100)
+            for engine in options.engines:
+                if options.messages:
+                    benchMeshThroughput(results, "%s/mesh/%s" % (board, engine),
+                                        controller, board, engine, options.messages, backend)
+        if backend == S4AH.BACKEND_SYSFS:
+            for engine in options.engines:
+                if options.samples:
+                    benchLatency(results, "%s/latency/%s" % (board, engine),
+                                 controller, board, engine, options.samples)
+        measured.append(backend)
+        controller.backend.close()
+    if measured and options.samples and S4AH.BACKEND_SYSFS not in measured:
+        results.skip("%s/latency" % board, "needs the sysfs backend, not measured")
+    return bool(measured)
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option('-b','--boardname',dest="boards",default=','.join(sorted(S4AH.connector_name)),help='Comma separated list of the boards to measure. Default all the boards')
+    parser.add_option('-g','--gpiobackend',dest="backends",default=','.join(S4AH.backends),help='Comma separated list of the GPIO backends to measure. Default all')
+    parser.add_option('--engine',dest="engines",default=','.join(ENGINES),help='Comma separated list of the handler engines whose latency is measured. Default all')
+    parser.add_option('-n','--iterations',type='int',dest="iterations",default=200,help='Sweeps measured for each pin count (x10 pin updates, x100 dispatches). Default 200')
+    parser.add_option('-s','--samples',type='int',dest="samples",default=50,help='Input changes measured for the latency, 0 to skip. Default 50')
+    parser.add_option('-m','--messages',type='int',dest="messages",default=2000,help='Pipelined messages sent to the handler to measure its throughput, 0 to skip. Default 2000')
+    parser.add_option('--fuzz',type='int',dest="fuzz",default=0,help='Only fuzz the codec and the handler with this number of random messages')
+    parser.add_option('--seed',type='int',dest="seed",default=None,help='Seed of the random messages of --fuzz')
+    parser.add_option('-r','--results',dest="results",default=None,help='Write the results to this JSON file')
+    parser.add_option('--baseline',dest="baseline",default=DEFAULT_BASELINE,help='Baseline JSON file the results are compared with, stored on this machine by --save-baseline. Exits with 2 if missing. Default benchmark_baseline.json')
+    parser.add_option('--save-baseline',dest="savebaseline",action="store_true",default=False,help='Store the results as the new baseline')
+    parser.add_option('-t','--tolerance',type='float',dest="tolerance",default=DEFAULT_TOLERANCE,help='Percent of worsening reported as regression. Default %d' % DEFAULT_TOLERANCE)
+    parser.add_option('--gpioworker',dest="gpioworker",action="store_true",default=False,help='Start the handlers with --gpioworker: the latency and throughput are measured with the GPIO accessed by a separate process')
+    options,args = parser.parse_args()
+    if options.gpioworker:
+        HANDLER_ARGS.append('--gpioworker')
+    options.backends = options.backends.split(',')
+    options.engines = options.engines.split(',')
+
+    logging.basicConfig(level=logging.CRITICAL)
+    results = Results()
+
+    if options.fuzz:
+        seed = options.seed if options.seed is not None else int(time.time())
+        print "fuzz seed", seed
+        rand = random.Random(seed)
+        failures = fuzzCodec(rand, options.fuzz)
+        board = options.boards.split(',')[0]
+        for engine in options.engines:
+            failures += fuzzMesh(results, rand, board, engine, options.fuzz)
+        print "%d fuzz failures" % failures
+        sys.exit(1 if failures else 0)
+
+    benchCodec(results, options.iterations * 100)
+    unmeasured = [board for board in options.boards.split(',') if not benchBoard(results, board, options)]
+    current = results.toDict()
+
+    if options.results:
+        with open(options.results, 'w') as fh:
+            json.dump(current, fh, indent=1, sort_keys=True)
+
+    if unmeasured:
+        # their measures would be missing from the baseline or the comparison
+        print "NOTHING MEASURED for %s: none of the GPIO backends %s is available" % (
+            ', '.join(unmeasured), ', '.join(options.backends))
+        sys.exit(2)
+
+    if options.savebaseline:
+        with open(options.baseline, 'w') as fh:
+            json.dump(current, fh, indent=1, sort_keys=True)
+        print "baseline saved to", options.baseline
+        sys.exit(0)
+
+    if not os.path.exists(options.baseline):
+        # the measures depend on the machine: each one stores its own baseline
+        print "NO BASELINE %s to compare with: run with --save-baseline first" % options.baseline
+        sys.exit(2)
+    with open(options.baseline) as fh:
+        baseline = json.load(fh)
+    regressions = compare(current, baseline, options.tolerance)
+    for (name, old, new, change) in regressions:
+        print "REGRESSION %s: %.3f -> %.3f (%+.1f%%)" % (name, old, new, change)
+    if regressions:
+        sys.exit(1)
+    print "no regressions against", options.baseline
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#s4ah_replay - replay of the Scratch mesh sessions captured by scratch4acmeboards
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# The frames a Scratch peer sent in a capture (--capture option of the
+# handler) are sent again to an offline handler by a fake mesh, at the
+# recorded times or as fast as possible. A getversion probe every few
+# frames measures how late the handler is.
+
+import sys
+import json
+import time
+import Queue
+import socket
+import logging
+from optparse import OptionParser
+import s4ah_Capture as S4AH_CP
+import s4ah_FakeMesh as S4AH_FM
+import s4ah_ScratchCodec as S4AH_SC
+import s4ah_benchmark as S4AH_BM
+
+
+DEFAULT_PROBE = 50           # frames between two latency probes
+DRAIN_TIMEOUT = 60.0         # seconds waiting for the handler to catch up
+PROBE = S4AH_SC.encodeBroadcast('getversion')
+PROBE_REPLY = '"version"'
+
+# broadcasts of the capture not replayed: getversion would be taken for a
+# probe reply, the others would stop the handler or the PC running the replay
+SKIPPED = ['broadcast "getversion"', 'broadcast "stophandler"', 'broadcast "shutdown"']
+
+
+def loadInbound(path, host=None):
+    """
+    return (host, [(secs, payload)] sent by the peer, frames received
+    by the peer): the first peer of the capture if host is None
+    """
+    inbound = []
+    outbound = 0
+    for (secs, kind, peer, payload) in S4AH_CP.readCapture(path):
+        if host is None:
+            host = peer
+        if peer != host:
+            continue
+        if kind == S4AH_CP.INBOUND:
+            inbound.append((secs, payload))
+        else:
+            outbound += 1
+    return (host, inbound, outbound)
+
+
+def replay(mesh, frames, speed, probeEvery):
+    """
+    send the frames (secs, framed message), each at its time divided by
+    speed (0 as fast as possible) and a probe every probeEvery frames:
+    return the times the probes were sent
+    """
+    probes = []
+    pending = []
+    start = time.time()
+    first = frames[0][0] if frames else 0.0
+    for (n, (secs, frame)) in enumerate(frames):
+        if speed:
+            delay = start + (secs - first) / speed - time.time()
+            if delay > 0:
+                if pending:
+                    mesh.sendFrames(pending)
+                    pending = []
+                time.sleep(delay)
+        pending.append(frame)
+        if probeEvery and (n + 1) % probeEvery == 0:
+            pending.append(PROBE)
+            mesh.sendFrames(pending)
+            pending = []
+            probes.append(time.time())
+    pending.append(PROBE)
+    mesh.sendFrames(pending)
+    probes.append(time.time())
+    return probes
+
+
+def collect(mesh, probes, timeout):
+    """
+    match the probe replies to the probes: return (latencies in msecs,
+    frames received, time of the last reply or None)
+    """
+    latencies = []
+    received = 0
+    last = None
+    deadline = time.time() + timeout
+    while len(latencies) < len(probes):
+        try:
+            (arrival, payload) = mesh.receive(max(deadline - time.time(), 0.001))
+        except Queue.Empty:
+            break
+        if payload is None:
+            break
+        if PROBE_REPLY in payload:
+            latencies.append((arrival - probes[len(latencies)]) * 1000.0)
+            last = arrival
+        else:
+            received += 1
+    return (latencies, received, last)
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [options] capturefile")
+    parser.add_option('--peer',dest="peer",default=None,help='Host of the capture whose frames are replayed. Default the first one')
+    parser.add_option('--speed',type='float',dest="speed",default=1.0,help='Replay speed: 1 at the recorded times (default), 2 twice as fast, 0 as fast as possible')
+    parser.add_option('--probe',type='int',dest="probe",default=DEFAULT_PROBE,help='Frames between two getversion probes measuring the latency of the handler, 0 only at the end. Default %d' % DEFAULT_PROBE)
+    parser.add_option('--engine',dest="engine",default=S4AH_BM.ENGINES[0],help='Engine of the handler among threads (default) and eventloop')
+    parser.add_option('--handlerargs',dest="handlerargs",default='',help='More options of the handler, e.g. "-b Arietta_G25 --maxrate 0". It always runs with -o')
+    parser.add_option('-r','--results',dest="results",default=None,help='Write the results to this JSON file')
+    parser.add_option('--baseline',dest="baseline",default=None,help='Results JSON file of a previous replay to compare with')
+    parser.add_option('-t','--tolerance',type='float',dest="tolerance",default=S4AH_BM.DEFAULT_TOLERANCE,help='Percent of worsening reported as regression. Default %d' % S4AH_BM.DEFAULT_TOLERANCE)
+    options,args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("one capture file expected")
+
+    logging.basicConfig(level=logging.CRITICAL)
+    try:
+        (host, inbound, outbound) = loadInbound(args[0], options.peer)
+    except (IOError, S4AH_CP.CaptureError), e:
+        print "Unable to read the capture: %s" % e
+        sys.exit(1)
+    frames = [(secs, S4AH_SC.encodeFrame(payload)) for (secs, payload) in inbound
+              if payload not in SKIPPED]
+    if not frames:
+        print "no frames sent by %s in %s" % (host or 'any peer', args[0])
+        sys.exit(1)
+    print "%s: %d frames sent by %s in %.1f secs (%d skipped), %d received" % (
+        args[0], len(frames), host, inbound[-1][0] - inbound[0][0], len(inbound) - len(frames), outbound)
+
+    results = S4AH_BM.Results()
+    prefix = "replay/%s" % options.engine
+    try:
+        session = S4AH_FM.MeshSession(['--engine', options.engine] + options.handlerargs.split())
+    except socket.error, e:
+        print "mesh port busy: %s" % e
+        sys.exit(1)
+    try:
+        if not session.connect():
+            print "the handler didn't connect"
+            sys.exit(1)
+        start = time.time()
+        probes = replay(session.mesh, frames, options.speed, options.probe)
+        sent = time.time()
+        (latencies, received, last) = collect(session.mesh, probes, DRAIN_TIMEOUT)
+    finally:
+        session.close()
+
+    if len(latencies) < len(probes):
+        print "the handler didn't answer %d of %d probes" % (len(probes) - len(latencies), len(probes))
+        sys.exit(1)
+    results.add("%s/sent" % prefix, len(frames) / max(sent - start, 1e-6), 'msgs/s', 'higher')
+    results.add("%s/handled" % prefix, len(frames) / max(last - start, 1e-6), 'msgs/s', 'higher')
+    latencies.sort()
+    for p in (50, 90, 99):
+        results.add("%s/latency/p%d" % (prefix, p), S4AH_BM.percentile(latencies, p), 'ms')
+    print "%d frames received by the fake mesh, %d in the capture" % (received, outbound)
+    current = results.toDict()
+
+    if options.results:
+        with open(options.results, 'w') as fh:
+            json.dump(current, fh, indent=1, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = S4AH_BM.compare(current, baseline, options.tolerance)
+        for (name, old, new, change) in regressions:
+            print "REGRESSION %s: %.3f -> %.3f (%+.1f%%)" % (name, old, new, change)
+        if regressions:
+            sys.exit(1)
+        print "no regressions against", options.baseline
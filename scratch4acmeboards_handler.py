@@ -18,27 +18,36 @@
 #Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 __version__ = 'v1.1' # Feb 2015
+import time
+startupTime = time.time()   # start of the imports for --profile-startup
 import threading
 import socket
-import time
+import select
 import sys
-import datetime as dt
 import os
 import s4ah_GPIOController as S4AH
-import logging.handlers
-import subprocess
+import s4ah_SensorQueue as S4AH_SQ
+import s4ah_Dispatcher as S4AH_DP
+import s4ah_Stats as S4AH_ST
+import s4ah_Logging as S4AH_LOG
+import s4ah_ScratchCodec as S4AH_SC
+import s4ah_InputFilter as S4AH_IF
+import s4ah_PollScheduler as S4AH_PS
+import s4ah_Backoff as S4AH_BO
+import logging
 from optparse import OptionParser
 import scratch
 
 
 class ScratchSender(threading.Thread):
     """
-    Class used by the thread sending to Scratch
+    Class used by the thread reading the INPUT pins: the changes are put in
+    the shared outbound queue, read once and sent to all the Scratch peers
     """
-    def __init__(self, session):
+    def __init__(self, queue, edgeMonitor=None):
         threading.Thread.__init__(self)
-        self.session = session
-        self.scratch_socket = session.socket
+        self.queue = queue
+        self.edgeMonitor = edgeMonitor
         self._stop = threading.Event()
         logger.debug("Sender Init")
 
@@ -47,6 +56,9 @@ class ScratchSender(threading.Thread):
         Set the thread as stopped
         """
         self._stop.set()
+        if self.edgeMonitor:
+            self.edgeMonitor.wakeup()
+        pollScheduler.wakeup()
         logger.debug("Sender Stop Set")
 
     def stopped(self):
@@ -55,48 +67,110 @@ class ScratchSender(threading.Thread):
         """
         return self._stop.isSet()
 
+    def putChanges(self, changes):
+        """
+        put the filtered changes (PinData, value) in the outbound queue
+        """
+        if not changes:
+            return
+        bcast_dict = {}
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for (pin, currVal) in changes:
+            bcast_dict[pin.sensorName] = currVal
+            if debug:
+                logger.debug("Change detected in pin %s changed to %s", pin.name, currVal)
+        if debug:
+            logger.debug('sending: %s', bcast_dict)
+        S4AH_ST.stats.count('changes', len(bcast_dict))
+        self.queue.put(bcast_dict)
+
+    def timeout(self):
+        """
+        seconds until the next poll or the next value held by the input
+        filters is due, None if nothing is due
+        """
+        deadlines = [deadline for deadline in (pollScheduler.nextDeadline(), inputFilters.nextDeadline(),
+                                               analogInputs and analogInputs.nextDeadline())
+                     if deadline is not None]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.time(), 0)
+
+    def poll(self, pins):
+        """
+        read the pins whose poll is due: return the samples (PinData, value)
+        """
+        now = time.time()
+        pollScheduler.setPins(pins, now)
+        due = pollScheduler.due(now)
+        if not due:
+            return []
+        samples = s4ahGC.readInputs(due)
+        pollScheduler.update(samples, now)
+        return samples
+
+    def readAnalog(self):
+        """
+        the changes of the analog pins when their averages are due: already
+        filtered by the deadband
+        """
+        if analogInputs is None:
+            return []
+        now = time.time()
+        deadline = analogInputs.nextDeadline()
+        if deadline is None or deadline > now:
+            return []
+        return analogInputs.read(now)
+
+    def runEdge(self):
+        """
+        Sending thread routine driven by the edge interrupts of the INPUT pins.
+        The pins without edge support are still polled by the poll scheduler
+        """
+        logger.debug("Sender running in thread %s with edge monitor ...", self.name)
+        monitor = self.edgeMonitor
+        polledNames = None
+        while not self.stopped():
+            try:
+                monitor.sync()
+                if monitor.polledPins is not polledNames:
+                    polledNames = monitor.polledPins
+                    polled = [s4ahGC.ValidPins[key] for key in polledNames]
+                pollScheduler.setPins(polled, time.time())
+                # block until an edge arrives if there is nothing to poll
+                # or no value held by the input filters
+                timeout = self.timeout()
+                samples = [(s4ahGC.ValidPins[key], currVal)
+                           for (key, currVal) in monitor.wait(-1 if timeout is None else timeout)]
+                samples += self.poll([pin for pin in polled if pin.mode == s4ahGC.PINPUT])
+                self.putChanges(inputFilters.changes(samples) + inputFilters.expire() + self.readAnalog())
+
+            except (KeyboardInterrupt, SystemExit):
+                logger.debug("raise error")
+                raise
+            except socket.timeout:
+                continue
+            except Exception:
+                continue
+
     def run(self):
         """
-        This is the main sending thread routine
+        This is the main sending thread routine: each INPUT pin is read when
+        the poll scheduler says so, the thread sleeps while there are none
         """
+        if self.edgeMonitor:
+            self.runEdge()
+            return
+
         logger.debug("Sender running in thread %s ...", self.name)
-        lastTimeSinceLastSleep = time.time()
-        # I checked that the average time to poll all the 27 pins configured in 
-        # INPUT mode on Arietta goes from 43 to 45 msecs. So the 50 msecs time
-        # could be enough
-        self.sleepTime = 0.050
-        i=0.0
-        media=0
         while not self.stopped():
             try:
-                loopTime = time.time() - lastTimeSinceLastSleep
-                #loop_time_millis=loopTime*1000.0
-                #i+=1.0
-                #media=(media*(i-1)+loop_time_millis)/i
-                if loopTime < self.sleepTime:
-                    sleepdelay = self.sleepTime - loopTime
-                    #print loop_time_millis, sleepdelay*1000, loop_time_millis, media
-                    time.sleep(sleepdelay) # be kind to cpu :)
-                lastTimeSinceLastSleep = time.time()
-
-                bcast_dict = {}
+                pollScheduler.setPins(s4ahGC.inputPins, time.time())
+                pollScheduler.wait(self.timeout())
                 # check if there is a change in the input pins
-                for key in s4ahGC.ValidPins:
-                    if s4ahGC.ValidPins[key].mode == s4ahGC.PINPUT:
-                        currVal = s4ahGC.pinRead(s4ahGC.ValidPins[key].name)
-                        if currVal != s4ahGC.ValidPins[key].value:
-                            s4ahGC.ValidPins[key].value = currVal
-                            bcast_dict['pin'+s4ahGC.ValidPins[key].name] = currVal
-                            logger.debug("Change detected in pin %s changed to %s", s4ahGC.ValidPins[key].name, currVal)
-                            #time.sleep(0.05) # just to give Scratch a better chance to react to event
-
-                if bcast_dict:
-                    logger.debug('sending: %s', bcast_dict)
-                    self.session.sensorupdate(bcast_dict)
+                samples = self.poll(s4ahGC.inputPins)
+                self.putChanges(inputFilters.changes(samples) + inputFilters.expire() + self.readAnalog())
 
-            except scratch.ScratchError, e:
-                logger.debug("sender raise ScratchError %s", e)
-                cycle_trace = 'disconnected'
             except (KeyboardInterrupt, SystemExit):
                 logger.debug("raise error")
                 raise
@@ -107,26 +181,44 @@ class ScratchSender(threading.Thread):
                 continue
 
 
-class ScratchListener(threading.Thread):
+class ScratchCommands:
     """
-    Class used by the thread listening from Scratch
+    Handlers of the commands received from Scratch, shared by the engines.
+    The replies are put in the outbound queue, onStop is called to stop
+    the handler
     """
-    def __init__(self, session):
-        threading.Thread.__init__(self)
-        self.session = session
-        self.scratch_socket = session.socket
-        self._stop = threading.Event()
+    def __init__(self, queue, onStop):
+        self.queue = queue
+        self.onStop = onStop
         self.value = None
         self.valueNumeric = None
-        logger.debug("Listener Init")
 
-    def send_scratch_command(self, cmd):
+    def handlers(self):
         """
-        Send a message to Scratch
+        handlers table used by the CommandDispatcher
         """
-        n = len(cmd)
-        b = (chr((n >> 24) & 0xFF)) + (chr((n >> 16) & 0xFF)) + (chr((n >> 8) & 0xFF)) + (chr(n & 0xFF))
-        self.scratch_socket.send(b + cmd)
+        return {'pin': self.doPin,
+                'sensor': self.doSensor,
+                'all': self.doAll,
+                'sghdebug': self.doDebug,
+                'config': self.doConfig,
+                'group': self.doGroup,
+                'definegroup': self.doDefineGroup,
+                'wave': self.doWave,
+                'sequence': self.doSequence,
+                'wavestop': self.doWaveStop,
+                'filter': self.doFilter,
+                'pwm': self.doPwm,
+                'pwmperiod': self.doPwmPeriod,
+                'gettime': self.doGetTime,
+                'getip': self.doGetIp,
+                'getversion': self.doGetVersion,
+                'getqueuestats': self.doGetQueueStats,
+                'getstats': self.doGetStats,
+                'dumplog': self.doDumpLog,
+                'shutdown': self.doShutdown,
+                'stophandler': self.doStopHandler,
+                }
 
     def parseItemValue(self, inValue):
         """
@@ -151,6 +243,187 @@ class ScratchListener(threading.Thread):
         else:
             return False
 
+    def doPin(self, pin, value):
+        """
+        pinXXNNon, pinXXNNoff broadcasts
+        """
+        s4ahGC.pinUpdate(getattr(pin, 'name', pin), value)
+
+    def doSensor(self, pin, value):
+        """
+        pinXXNN sensor-update
+        """
+        if not self.parseItemValue(value):
+            logger.error("Unable to parse value %s ", value)
+            return
+        s4ahGC.pinUpdate(getattr(pin, 'name', pin), self.valueNumeric)
+
+    def doAll(self, arg, value):
+        s4ahGC.pinUpdateAll(value)
+
+    def doDebug(self, arg, value):
+        logPipeline.setDebug(value == "on")
+
+    def doConfig(self, pin, mode):
+        if pin == 'all':
+            s4ahGC.setAllPins(mode)
+        else:
+            s4ahGC.setPinMode(getattr(pin, 'name', pin), mode)
+
+    def doGroup(self, groupName, value):
+        """
+        pin group sensor-update: an integer (also 0x.. or 0b..) whose bit i
+        is the value of the pin i of the group
+        """
+        try:
+            value = int(str(value).strip(), 0)
+        except ValueError:
+            try:
+                value = int(float(value))
+            except ValueError:
+                logger.error("Unable to parse value %s of pin group %s", value, groupName)
+                return
+        s4ahGC.groupUpdate(groupName, value)
+
+    def doDefineGroup(self, groupName, pinNames):
+        """
+        groupNAME=XXNN,XXNN,... broadcast
+        """
+        s4ahGC.definePinGroup(groupName, pinNames)
+
+    def doWave(self, target, value):
+        """
+        waveNAME PERIOD DUTY [REPEAT] broadcast: period in msecs, duty in percent
+        """
+        (period, duty, repeat) = value
+        get_waveforms().squareWave(target, period / 1000.0, duty, repeat)
+
+    def doSequence(self, target, value):
+        """
+        seqNAME STEP V1,V2,... [REPEAT] broadcast: step in msecs
+        """
+        (stepTime, values, repeat) = value
+        try:
+            values = [int(v, 0) for v in values]
+        except ValueError:
+            logger.error("Unable to parse the values %s of sequence %s", values, target)
+            return
+        get_waveforms().sequence(target, stepTime / 1000.0, values, repeat)
+
+    def doWaveStop(self, target, value):
+        if waveforms is not None:
+            waveforms.stopWaveform(target)
+
+    def doFilter(self, pin, value):
+        """
+        debounceXXNN MSECS, majorityXXNN N M, intervalXXNN MSECS broadcasts
+        and deadbandADCN UNITS of the analog pins
+        """
+        (kind, args) = value
+        if kind == 'deadband':
+            if analogInputs is None:
+                logger.error("deadband: no analog pins on this board")
+                return
+            analogInputs.setDeadband(getattr(pin, 'name', pin), args[0])
+            return
+        inputFilters.configure(getattr(pin, 'name', pin), kind, args)
+
+    def doPwm(self, pin, value):
+        """
+        pwmXXNN sensor-update: duty cycle in percent
+        """
+        try:
+            duty = float(value)
+        except ValueError:
+            logger.error("Unable to parse the duty cycle %s of pin %s", value, pin)
+            return
+        s4ahGC.pwmUpdate(getattr(pin, 'name', pin), duty)
+
+    def doPwmPeriod(self, pin, value):
+        """
+        pwmperiodXXNN sensor-update: period in usecs
+        """
+        try:
+            period = float(value)
+        except ValueError:
+            logger.error("Unable to parse the pwm period %s of pin %s", value, pin)
+            return
+        s4ahGC.pwmSetPeriod(getattr(pin, 'name', pin), period)
+
+    def doGetTime(self, arg, value):
+        import datetime as dt
+        now = dt.datetime.now()
+        logger.debug("gettime %s", now)
+        fulldatetime = now.strftime('%Y%m%d%H%M%S')
+        hrs = fulldatetime[-6:-4]
+        minutes = fulldatetime[-4:-2]
+        secs = fulldatetime[-2:]
+        bcast_dict = {'fulldatetime':fulldatetime, 'hours':hrs, 'minutes':minutes, 'seconds':secs}
+        logger.debug('sending: %s', bcast_dict)
+        self.queue.put(bcast_dict)
+
+    def putReply(self, bcast_dict):
+        """
+        put the reply of a job run by the workers, None if there is no reply
+        """
+        if bcast_dict:
+            logger.debug('sending: %s', bcast_dict)
+            self.queue.put(bcast_dict)
+
+    def doGetIp(self, arg, value):
+        get_workers().submit('getip', find_ip, self.putReply)
+
+    def doGetVersion(self, arg, value):
+        bcast_dict = {'version':__version__}
+        logger.debug('sending: %s', bcast_dict)
+        self.queue.put(bcast_dict)
+
+    def doGetQueueStats(self, arg, value):
+        bcast_dict = self.queue.stats()
+        logger.debug('sending: %s', bcast_dict)
+        self.queue.put(bcast_dict)
+
+    def doGetStats(self, arg, value):
+        bcast_dict = S4AH_ST.stats.sensors()
+        logger.debug('sending: %s', bcast_dict)
+        self.queue.put(bcast_dict)
+        if statsFile:
+            S4AH_ST.stats.writeFile(statsFile)
+
+    def doDumpLog(self, arg, value):
+        bcast_dict = {'logrecords': logPipeline.dumpRing(), 'logdropped': logPipeline.dropped()}
+        logger.debug('sending: %s', bcast_dict)
+        self.queue.put(bcast_dict)
+
+    def doShutdown(self, arg, value):
+        get_workers().submit('shutdown', shutdown_board)
+
+    def doStopHandler(self, arg, value):
+        logger.debug("stop handler msgs sent from Scratch")
+        self.onStop()
+
+
+class ScratchListener(threading.Thread):
+    """
+    Class used by the thread listening from Scratch
+    """
+    def __init__(self, session, commands, peer):
+        threading.Thread.__init__(self)
+        self.session = session
+        self.scratch_socket = session.socket
+        self.peer = peer
+        self._stop = threading.Event()
+        self.dispatcher = S4AH_DP.CommandDispatcher(s4ahGC, commands.handlers())
+        self.decoder = S4AH_SC.FrameDecoder()
+        self.encoder = S4AH_SC.FrameEncoder()
+        logger.debug("Listener Init")
+
+    def send_scratch_command(self, cmd):
+        """
+        Send a message to Scratch
+        """
+        self.encoder.send(self.scratch_socket, cmd)
+
     def stop(self):
         """
         Set the thread as stopped
@@ -165,128 +438,51 @@ class ScratchListener(threading.Thread):
 
     def listen(self):
         """
-        Function to listen to messages from Scratch
+        Function to listen to messages from Scratch: the socket of the
+        session is read by the codec, so all the frames pipelined in a
+        single read are returned
         """
-        global cycle_trace
         while not self.stopped():
             try:
-                yield self.session.receive()
+                start = time.time()
+                n = self.decoder.receive(self.scratch_socket)
+                S4AH_ST.stats.record('receive', start)
+                if not n:
+                    raise scratch.ScratchConnectionError("Scratch closed the connection")
+                for payload in self.decoder.frames():
+                    capture = S4AH_SQ.capture
+                    if capture is not None:
+                        capture.inbound(self.peer.host, payload)
+                    msg = S4AH_SC.parseMessage(payload)
+                    if msg is None:
+                        S4AH_ST.stats.count('unknown')
+                        logger.error("Unknown message: %s", payload[:64])
+                        continue
+                    yield msg
+            except socket.timeout:
+                #logger.debug("No data received: socket timeout")
+                continue
+            except (socket.error, S4AH_SC.CodecError), e:
+                logger.debug("listener raises %s", e)
+                self.peer.disconnected(e)
+                raise scratch.ScratchConnectionError(str(e))
             except scratch.ScratchError, e:
                 logger.debug("listener raises ScratchError %s", e)
-                cycle_trace = 'disconnected'
+                self.peer.disconnected(e)
                 raise
             except (KeyboardInterrupt, SystemExit):
                 logger.debug("raise error")
                 raise
-            except socket.timeout:
-                #logger.debug("No data received: socket timeout")
-                continue
             except Exception, e:
                 logger.error("Unknown exception %s", e)
                 continue
 
-    def parseBroadcast(self, msgToParse):
-        """
-        Parse a broadcast message. Allowed messages:
-        pinXXNNon, pinXXNNoff (e.g pinPA25on, pinPA8off): to set the single pin XXNN on or off
-        allon, alloff: to set all the pins on the board on or foo
-        sghdebugon, sghdebugoff (or also sghdebug on, sghdebug off): to turn the debug on or off
-        gettime: to get the board date and time
-        getip: to get board ip address
-        getversion: to get the scratch4acmeboards version
-        shutdown: to shutdown the board
-        stophandler: to stop the handler
-        configXXNNin, configXXNNout, configXXNNnu (e.g configPA25in, configPA8out, configPA10nu):
-                        to configure the pin XXNN in OUTPUT or INPUT mode or NOT USED
-        """
-        (cmdItem, cmdItemNum, cmdItemValue) = ('', '', '')
-        cmdItemValueLen = 0
-
-        if msgToParse.startswith('pin'):
-            cmdItem = 'pin'
-            if msgToParse.endswith('on'):
-                cmdItemValue = 'on'
-                cmdItemValueLen = -2
-            elif msgToParse.endswith('off'):
-                cmdItemValue = 'off'
-                cmdItemValueLen = -3
-            else:
-                raise Exception("Unknown command: " + msgToParse)
-            cmdItemNum = msgToParse[3:cmdItemValueLen]
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        elif msgToParse.startswith('all'):
-            cmdItem = 'all'
-            if msgToParse.endswith('on'):
-                cmdItemValue = 'on'
-            elif msgToParse.endswith('off'):
-                cmdItemValue = 'off'
-            else:
-                raise Exception("Unknown command: " + msgToParse)
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        elif msgToParse.startswith('sghdebug'):
-            cmdItem = 'sghdebug'
-            if msgToParse.endswith('on'):
-                cmdItemValue = 'on'
-            elif msgToParse.endswith('off'):
-                cmdItemValue = 'off'
-            else:
-                raise Exception("Unknown command: " + msgToParse)
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        elif msgToParse.startswith('gettime'):
-            cmdItem = 'gettime'
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        elif msgToParse.startswith('getip'):
-            cmdItem = 'getip'
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        elif msgToParse.startswith('getversion'):
-            cmdItem = 'getversion'
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        elif msgToParse.startswith('shutdown'):
-            cmdItem = 'shutdown'
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        elif msgToParse.startswith('stophandler'):
-            cmdItem = 'stophandler'
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        elif msgToParse.startswith('config'):
-            cmdItem = 'config'
-            if msgToParse.endswith('in'):
-                cmdItemValue = s4ahGC.PINPUT
-                cmdItemValueLen = -2
-            elif msgToParse.endswith('out'):
-                cmdItemValue = s4ahGC.POUTPUT
-                cmdItemValueLen = -3
-            elif msgToParse.endswith('nu'):
-                cmdItemValue = s4ahGC.PUNUSED
-                cmdItemValueLen = -2
-            else:
-                raise Exception("Unknown command: " + msgToParse)
-            cmdItemNum = msgToParse[6:cmdItemValueLen]
-            return (cmdItem, cmdItemNum, cmdItemValue)
-        else:
-            raise Exception("Unknown command: " + msgToParse)
-
-
-    def parseSensorUpdate(self, msgToParse):
-        """
-        Parse a broadcast message. Allowed sensor:
-        pinXXNN, pinXXNN (e.g pinPA25, pinPA8)
-        """
-        (cmdItem, cmdItemNum) = ('', '')
-        if msgToParse.startswith('pin'):
-            cmdItem = 'pin'
-            cmdItemNum = msgToParse[3:]
-            return (cmdItem, cmdItemNum)
-
-
     def run(self):
         """
         This is the main listening thread routine
         """
-        global cycle_trace
-
         logger.debug("Listener running as thread %s ...", self.name)
 
-        debugLogging = True
         try:
             for msg in self.listen():
                 # if on Scratch you load a new project without stopping the
@@ -295,109 +491,162 @@ class ScratchListener(threading.Thread):
                     continue;
 
                 msgType = msg[0]
-
-                cmdList = []    # used to hold lists of all broadcasts or sensor updates
-                singleCmd = []  # singleCmd holds list of single broadcast or sensor update
+                start = time.time()
 
                 if msgType == 'broadcast':
                     for item in msg[1:]:
-                        try:
-                            (cmdItem, cmdItemNum, cmdItemValue) = self.parseBroadcast(msg[1])
-                            cmdList.append((cmdItem, cmdItemNum, cmdItemValue))
-                        except Exception as ex:
-                            #template = "{0} exception occured parsing " + msg[1] + ": {1!r}"
-                            #message = template.format(type(ex).__name__, ex.args)
-                            message = "Error parsing sensor-update " + msg[1]
-                            logger.error(message)
+                        command = self.dispatcher.resolveBroadcast(item)
+                        S4AH_ST.stats.record('parse', start)
+                        if command is None:
+                            S4AH_ST.stats.count('unknown')
+                            logger.error("Error parsing broadcast %s", item)
                             continue
+                        (handler, arg, value) = command
+                        handler(arg, value)
                 elif msgType == 'sensor-update':
                     for item in msg[1:]:
-                        for key in item.keys():
-                            try:
-                                (cmdItem, cmdItemNum) = self.parseSensorUpdate(key)
-                                cmdList.append((cmdItem, cmdItemNum, item[key]))
-                            except Exception as ex:
-                                #template = "{0} exception occured parsing " + key + ": {1!r}"
-                                #message = template.format(type(ex).__name__, ex.args)
-                                message = "Error parsing sensor-update " + key
-                                logger.error(message)
+                        commands = []
+                        for key in item:
+                            command = self.dispatcher.resolveSensor(key)
+                            if command is None:
+                                S4AH_ST.stats.count('unknown')
+                                logger.error("Error parsing sensor-update %s", key)
                                 continue
+                            commands.append((command, item[key]))
+                        S4AH_ST.stats.record('parse', start)
+                        for ((handler, arg, value), itemValue) in commands:
+                            handler(arg, itemValue)
                 else:
+                    S4AH_ST.stats.count('unknown')
                     logger.error("Unknown message type: %s", msgType)
 
-                logger.debug("cmdList: %s", cmdList)
+        except scratch.ScratchError, e:
+            logger.error("Error: %s", e)
+            #raise
 
-                for singleCmd in cmdList:
-                    (cmdItem, cmdItemNum, cmdItemValue) = singleCmd
+    ###  End of  ScratchListner Class
 
-                    if cmdItem == 'sghdebug':
-                        if (cmdItemValue == "on") and (debugLogging):
-                            logging.getLogger().setLevel(logging.DEBUG)
-                            debugLogging = True
-                        if (cmdItemValue == "off") and (debugLogging):
-                            logging.getLogger().setLevel(logging.INFO)
-                            debugLogging = False
 
-                    elif cmdItem == 'pin':
-                        if not self.parseItemValue(cmdItemValue):
-                            logger.error("Unable to parse value %s ", cmdItemValue)
-                            continue
-                        s4ahGC.pinUpdate(cmdItemNum, self.valueNumeric)
+class MeshPeer:
+    """
+    A Scratch mesh host served by the threaded engine, with its own session,
+    listener and writer. state is start, connecting, connected, refused,
+    running, disconnected or failed. The connection is opened by a thread
+    of the peer: an unreachable host doesn't hold up the main loop
+    """
+    def __init__(self, host):
+        self.host = host
+        self.state = 'start'
+        self.session = None
+        self.listener = None
+        self.writer = None
+        self.error = None
+        self.attempts = 0
+        self.nextAttempt = 0.0
+        self.backoff = S4AH_BO.Backoff()
+
+    def disconnected(self, e=None):
+        """
+        called by the listener or by the writer when the socket breaks
+        """
+        self.state = 'disconnected'
 
-                    elif cmdItem == 'all':
-                        if not self.parseItemValue(cmdItemValue):
-                            logger.error("Unable to parse value %s ", cmdItemValue)
-                            continue
-                        s4ahGC.pinUpdateAll(self.valueNumeric)
-
-                    elif cmdItem == 'config':
-                        if cmdItemNum == 'all':
-                            s4ahGC.setAllPins(cmdItemValue)
-                        else:
-                            s4ahGC.setPinMode(cmdItemNum, cmdItemValue)
-
-                    ### Check for other broadcast type messages being received
-
-                    if cmdItem == 'gettime':
-                        now = dt.datetime.now()
-                        logger.debug("gettime %s", now)
-                        fulldatetime = now.strftime('%Y%m%d%H%M%S')
-                        hrs = fulldatetime[-6:-4]
-                        minutes = fulldatetime[-4:-2]
-                        secs = fulldatetime[-2:]
-                        bcast_dict = {'fulldatetime':fulldatetime, 'hours':hrs, 'minutes':minutes, 'seconds':secs}
-                        logger.debug('sending: %s', bcast_dict)
-                        self.session.sensorupdate(bcast_dict)
-
-                    elif cmdItem == 'getip': #find ip address
-                        logger.debug("Finding IP")
-                        arg = 'ip route list'
-                        p = subprocess.Popen(arg, shell=True, stdout=subprocess.PIPE)
-                        ipdata = p.communicate()
-                        split_data = ipdata[0].split()
-                        ipaddr = split_data[split_data.index('src')+1]
-                        logger.debug("IP:%s", ipaddr)
-                        bcast_dict = {'ipaddress':ipaddr}
-                        self.session.sensorupdate(bcast_dict)
-
-                    elif cmdItem == 'getversion':
-                        bcast_dict = {'version':__version__}
-                        logger.debug('sending: %s', bcast_dict)
-                        self.session.sensorupdate(bcast_dict)
-
-                    elif cmdItem == 'shutdown':
-                        os.system('sudo shutdown -h "now"')
-
-                    elif cmdItem == 'stophandler':
-                        logger.debug("stop handler msgs sent from Scratch")
-                        cleanup_threads((listener, sender))
-                        sys.exit(0)
+    def connect(self):
+        """
+        open the session in a new thread: the state becomes connected or refused
+        """
+        self.state = 'connecting'
+        connector = threading.Thread(target=self.openSession, name='connect %s' % self.host)
+        connector.daemon = True
+        connector.start()
 
-        except scratch.ScratchError, e:
-            logger.error("Error: %s", e)
-            #raise
+    def openSession(self):
+        try:
+            self.session = scratch.Scratch(self.host)
+        except (scratch.ScratchError, socket.error), e:
+            self.error = e
+            self.state = 'refused'
+            return
+        self.state = 'connected'
+
+    def start(self, fanout, maxBacklog):
+        """
+        serve the connected session
+        """
+        self.writer = S4AH_SQ.PeerWriter(self.session, fanout, maxBacklog, self.host)
+        self.writer.onError = self.disconnected
+        self.listener = ScratchListener(self.session, ScratchCommands(self.writer, stop_handler), self)
+        self.state = 'running'
+        self.attempts = 0
+        self.backoff.connected()
+        self.writer.start()
+        self.listener.start()
+        fanout.addPeer(self.writer)
+
+    def close(self, fanout):
+        fanout.removePeer(self.writer)
+        cleanup_threads((self.listener, self.writer))
+        try:
+            self.session.socket.close()
+        except socket.error:
+            pass
+        self.state = 'start'
 
-    ###  End of  ScratchListner Class
+
+def get_waveforms():
+    """
+    the WaveformScheduler, created by the first waveform or sequence
+    """
+    global waveforms
+    with servicesLock:
+        if waveforms is None:
+            import s4ah_Waveform as S4AH_WF
+            waveforms = S4AH_WF.WaveformScheduler(s4ahGC)
+        return waveforms
+
+
+def get_workers():
+    """
+    the WorkerPool, created by the first command that can block
+    """
+    global workers
+    with servicesLock:
+        if workers is None:
+            import s4ah_Workers as S4AH_WK
+            workers = S4AH_WK.WorkerPool()
+            if workersDeliver is not None:
+                workers.deliver = workersDeliver
+        return workers
+
+
+def find_ip():
+    """
+    run by the workers: the interface addresses are cached until they change
+    """
+    import s4ah_NetInfo as S4AH_NI
+    logger.debug("Finding IP")
+    ipaddr = S4AH_NI.provider().address()
+    if ipaddr is None:
+        logger.error("No IP address found")
+        return None
+    logger.debug("IP:%s", ipaddr)
+    return {'ipaddress':ipaddr}
+
+
+def shutdown_board():
+    """
+    run by the workers
+    """
+    import subprocess
+    subprocess.call(['sudo', 'shutdown', '-h', 'now'])
+
+
+def stop_handler():
+    """
+    stophandler received by the threaded engine: the main loop does the cleanup
+    """
+    global stop_requested
+    stop_requested = True
 
 
 def cleanup_threads(threads):
@@ -412,13 +661,10 @@ def cleanup_threads(threads):
     logger.debug("Threads told to stop")
 
     logger.debug("Waiting for join on main threads to complete")
-    #for thread in threads:
-    #    thread.join(1)
-    main_thread = threading.currentThread()
-    for thread in threading.enumerate():
-        if thread is main_thread or thread.getName().startswith("Dummy"):
-            # debugging with Eclipse when stopped in break in one thread a lot of
-            # Dummy threads are created and an exception is raised when trying to stop them
+    # only the passed threads are joined: the threads of the other peers go on
+    current_thread = threading.currentThread()
+    for thread in threads:
+        if thread is current_thread or not thread.isAlive():
             continue
         logger.debug('joining %s', thread.getName())
         thread.join()
@@ -435,6 +681,9 @@ def cleanup_threads(threads):
 if __name__ == '__main__':
     #Set some constants and initialise lists
 
+    ENGINE_THREADS = 'threads'
+    ENGINE_EVENTLOOP = 'eventloop'
+
     # max number of connection attemps. If you like to try forever, set 0
     MAXATTEMPTS = 30
     PORT = 42001
@@ -442,105 +691,324 @@ if __name__ == '__main__':
     DEFAULT_BOARD = 'Arietta_G25'   # default board used
     BUFFER_SIZE = 512               # this value should be enough
 
+    profile = S4AH_ST.StartupProfile(startupTime)
+    profile.mark('imports')
+
     # options parsing
     parser = OptionParser("usage: %prog [options]")
-    parser.add_option('-o','--offline',dest="offline",action="store_true",default=False,help='option to use for local tests without Arietta board')
-    parser.add_option('-m','--mesh',type='string',dest="ipaddress",default=DEFAULT_HOST,help='ip address where mesh (Scratch) is running. Default 192.168.10.20')
+    parser.add_option('-o','--offline',dest="offline",action="store_true",default=False,help='option to use for local tests without Arietta board: the pins are virtual (kept in memory) unless a GPIO backend is chosen with -g')
+    parser.add_option('-m','--mesh',type='string',dest="ipaddress",default=DEFAULT_HOST,help='ip address where mesh (Scratch) is running, a comma separated list to serve several PCs. Default 192.168.10.20')
+    parser.add_option('--maxbacklog',type='int',dest="maxbacklog",default=S4AH_SQ.DEFAULT_MAX_BACKLOG,help='Max bytes waiting to be written to a single Scratch PC before resending only the latest values. Default %d' % S4AH_SQ.DEFAULT_MAX_BACKLOG)
     parser.add_option('-d','--debug',dest="debug",action="store_true",default=False,help='Set logging level to DEBUG. Default is WARNING')
     parser.add_option('-p','--printtostdout',dest="printtostdout",action="store_true",default=False,help='Print all log messages to stdout. Default logs to /tmp/scratch4acmeboards.log')
     parser.add_option('-b','--boardname',dest="boardname",default=DEFAULT_BOARD,help='ACMESystems board name among Arietta_G25 (default), Daisy, Acqua_A5, FOX_Board_G20, Aria_G25')
+    parser.add_option('-g','--gpiobackend',type='choice',dest="gpiobackend",choices=S4AH.backends,default=None,help='GPIO access among sysfs (default), gpiochip (character device, one ioctl for each PIO bank) and virtual (in memory, the default with -o)')
+    parser.add_option('--maxrate',type='int',dest="maxrate",default=S4AH_SQ.DEFAULT_MAX_RATE,help='Max sensor-update messages per second sent to Scratch, 0 for no limit. Default %d' % S4AH_SQ.DEFAULT_MAX_RATE)
+    parser.add_option('--maxbatch',type='int',dest="maxbatch",default=S4AH_SQ.DEFAULT_MAX_BATCH,help='Max sensors sent in a single sensor-update message. Default %d' % S4AH_SQ.DEFAULT_MAX_BATCH)
+    parser.add_option('--maxpending',type='int',dest="maxpending",default=S4AH_SQ.DEFAULT_MAX_PENDING,help='Max sensors waiting to be sent, others are dropped. Default %d' % S4AH_SQ.DEFAULT_MAX_PENDING)
+    parser.add_option('--engine',type='choice',dest="engine",choices=[ENGINE_THREADS, ENGINE_EVENTLOOP],default=ENGINE_THREADS,help='Runtime among threads (default, listener and sender threads) and eventloop (single thread epoll loop)')
+    parser.add_option('--gpioworker',dest="gpioworker",action="store_true",default=False,help='Access the GPIO from a separate process: the INPUT pins are read every 5 msecs by the worker and shared in memory, the writes are passed through a pipe. Not with -e')
+    parser.add_option('-e','--edge',dest="edge",action="store_true",default=False,help='Detect INPUT pins changes by edge interrupts. Pins without edge support are polled')
+    parser.add_option('--pollbudget',type='int',dest="pollbudget",default=S4AH_PS.DEFAULT_BUDGET,help='Max reads per second of the polled INPUT pins: a pin that changed is read every %d msecs, an idle one every %d msecs, the intervals are stretched to stay within the budget. 0 for no limit. Default %d' % (S4AH_PS.FAST_INTERVAL * 1000, S4AH_PS.SLOW_INTERVAL * 1000, S4AH_PS.DEFAULT_BUDGET))
+    parser.add_option('--adcrate',type='int',dest="adcrate",default=None,help='Samples per second of the analog pins ADC0, ADC1 ... (IIO buffered capture). 0 disables them. Default 100')
+    parser.add_option('--adcaverage',type='int',dest="adcaverage",default=None,help='Samples averaged in each value of an analog pin. Default 10')
+    parser.add_option('--adcdeadband',type='int',dest="adcdeadband",default=None,help='Least change of an analog pin value sent to Scratch. Default 4')
+    parser.add_option('--i2c',dest="i2c",default=None,help='File declaring the I2C sensors (bus, address, register, format, scale, rate) read by a background thread, see s4ah_I2C.py. With -o the buses are faked by the files of /tmp/i2c/')
+    parser.add_option('--group',dest="groups",action="append",default=[],help='Define a pin group as name=pin,pin,... (e.g. seg1=PA0,PA1,PA2): the sensor name sets the pins to the bits of its value, the first pin is the bit 0. Can be repeated')
+    parser.add_option('--synclog',dest="synclog",action="store_true",default=False,help='Write the log messages synchronously instead of by a background thread')
+    parser.add_option('--logring',type='int',dest="logring",default=S4AH_LOG.DEFAULT_RING_SIZE,help='Number of recent log messages (also DEBUG ones) kept in memory and written to %s on errors or on the dumplog broadcast. Default 0 (disabled)' % S4AH_LOG.RING_FILENAME)
+    parser.add_option('--statsfile',dest="statsfile",default=None,help='File where the latency statistics are written on getstats and on exit')
+    parser.add_option('--statssocket',dest="statssocket",default=None,help='UNIX socket sending the latency statistics to each client that connects')
+    parser.add_option('--resetgrace',type='float',dest="resetgrace",default=0,help='Seconds the pins keep their configuration and values after the last Scratch PC disconnected, -1 forever. Default 0 (reset at once)')
+    parser.add_option('--capture',dest="capture",default=None,help='Record all the frames exchanged with Scratch to this file, to be replayed by s4ah_replay.py')
+    parser.add_option('--virtualpins',type='int',dest="virtualpins",default=0,help='Number of pins V0, V1, ... of the virtual board. Default 0: the pins of the -b board, 64 if ablib is not installed')
+    parser.add_option('--stimulus',dest="stimulus",default=None,help='Script driving the INPUT pins of the virtual backend with square waves, random bursts and recorded traces')
+    parser.add_option('--cachedir',dest="cachedir",default=S4AH.BOARD_CACHE_DIR,help='Directory of the board descriptors cache, rebuilt when ablib changes. Empty to read the pins from ablib at each start. Default %s' % S4AH.BOARD_CACHE_DIR)
+    parser.add_option('--profile-startup',dest="profilestartup",action="store_true",default=False,help='Log the time spent in each startup phase')
     options,args = parser.parse_args()
+    profile.mark('options')
 
     offline = options.offline
-    host = options.ipaddress
+    hosts = [host.strip() for host in options.ipaddress.split(',') if host.strip()]
     debugflag = options.debug
     printFlag = options.printtostdout
     boardName = options.boardname
+    edgeFlag = options.edge
+    gpioBackend = options.gpiobackend or (S4AH.BACKEND_VIRTUAL if offline else S4AH.BACKEND_SYSFS)
+    statsFile = options.statsfile
 
-    if debugflag:
-        logLevel = logging.DEBUG
-    else:
-        logLevel = logging.INFO
-
-    # log on a rolling file in /tmp and error messages also in console
-    LOG_FILENAME = "/tmp/scratch4acmeboards.log"
+    # log on a rolling file in /tmp (or on stdout) written by a background
+    # thread, info and error messages also in console
     logger = logging.getLogger('s4ah_root_logger')
-    if printFlag:
-        logging.basicConfig(stream=sys.stdout,
-                            filemode='w', level=logLevel,
-                            format="%(asctime)s - %(module)s.%(funcName)s %(lineno)d: %(message)s",
-                            datefmt='%d/%m/%Y %H:%M:%S')
-        handler = logging.StreamHandler()
-    else:
-        logging.basicConfig(filename=LOG_FILENAME,
-                            filemode='w', level=logLevel,
-                            format="%(asctime)s - %(module)s.%(funcName)s %(lineno)d: %(message)s",
-                            datefmt='%d/%m/%Y %H:%M:%S')
-        handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=20000000, backupCount=2)
-
-    logger.addHandler(handler)
-    consoleHandler = logging.StreamHandler()
-    logger.addHandler(consoleHandler)
+    logPipeline = S4AH_LOG.LogPipeline(printFlag, debugflag, not options.synclog, options.logring)
+    profile.mark('logging')
 
     # create a controller instance
     try:
-        s4ahGC = S4AH.GPIOController(boardName, offline)
+        s4ahGC = S4AH.GPIOController(boardName, offline, gpioBackend, options.cachedir,
+                                     options.virtualpins)
     except S4AH.S4AHException, e:
         logger.error("Error: %s", e)
         logger.error("Exiting ... bye")
         sys.exit(1)
 
+    for group in options.groups:
+        (groupName, sep, pinNames) = group.partition('=')
+        if not sep or not s4ahGC.definePinGroup(groupName.strip(), pinNames.split(',')):
+            logger.error("Invalid pin group %s: expected name=pin,pin,...", group)
+            sys.exit(1)
+    if options.stimulus:
+        if gpioBackend != S4AH.BACKEND_VIRTUAL:
+            logger.error("--stimulus needs the virtual backend (-o)")
+            sys.exit(1)
+        import s4ah_VirtualGPIO as S4AH_VG
+        try:
+            s4ahGC.backend.loadStimulus(options.stimulus)
+        except S4AH_VG.StimulusError, e:
+            logger.error("Invalid stimulus script %s: %s", options.stimulus, e)
+            sys.exit(1)
+    if options.gpioworker:
+        if edgeFlag:
+            logger.error("--gpioworker can't be used with -e: the worker polls the INPUT pins")
+            sys.exit(1)
+        # forked before the other threads start
+        import s4ah_GPIOWorker as S4AH_GW
+        S4AH_GW.start(s4ahGC, logPipeline.afterFork)
+    profile.mark('board cached' if s4ahGC.descriptorCached else 'board')
+
+    # debounce and glitch filters between the reads of the INPUT pins and Scratch
+    inputFilters = S4AH_IF.InputFilters(s4ahGC)
+
+    # polling of the INPUT pins not driven by edges
+    pollScheduler = S4AH_PS.PollScheduler(s4ahGC, budget=options.pollbudget)
+
+    # waveforms and sequences on the OUTPUT pins (driven by a single thread)
+    # and the commands that can block (getip, shutdown, run by a few worker
+    # threads) are set up by the first command needing them
+    waveforms = None
+    workers = None
+    workersDeliver = None
+    servicesLock = threading.Lock()
+
+    # analog pins of the IIO ADC, if the board has one
+    analogInputs = None
+    if options.adcrate != 0:
+        import s4ah_ADC as S4AH_ADC
+        if options.adcrate is None:
+            options.adcrate = S4AH_ADC.DEFAULT_RATE
+        if options.adcaverage is None:
+            options.adcaverage = S4AH_ADC.DEFAULT_AVERAGE
+        if options.adcdeadband is None:
+            options.adcdeadband = S4AH_ADC.DEFAULT_DEADBAND
+    if options.adcrate > 0:
+        if offline:
+            S4AH_ADC.createOfflineDevice()
+            adcDevice = S4AH_ADC.findDevice(S4AH_ADC.OFFLINE_IIO_DEVICES, S4AH_ADC.OFFLINE_IIO_DEV)
+        else:
+            adcDevice = S4AH_ADC.findDevice()
+        if adcDevice is not None:
+            try:
+                analogInputs = S4AH_ADC.ADCMonitor(s4ahGC, adcDevice, options.adcrate,
+                                                   options.adcaverage, options.adcdeadband)
+            except (IOError, OSError), e:
+                logger.error("Unable to open the ADC %s: %s", adcDevice.devPath, e)
+
+    # I2C sensors, read by their own thread: deliver is set by the engine
+    i2cPoller = None
+    if options.i2c:
+        import s4ah_I2C as S4AH_I2C
+        try:
+            (i2cSensors, i2cInits) = S4AH_I2C.parseConfig(options.i2c)
+            i2cPoller = S4AH_I2C.I2CPoller(i2cSensors, i2cInits, None, offline)
+        except S4AH_I2C.I2CError, e:
+            logger.error("Error: %s", e)
+            logger.error("Exiting ... bye")
+            sys.exit(1)
+
+    edgeMonitor = None
+    if edgeFlag:
+        import s4ah_EdgeMonitor as S4AH_EM
+        edgeMonitor = S4AH_EM.EdgeMonitor(s4ahGC)
+
+    statsServer = None
+    if options.statssocket:
+        try:
+            statsServer = S4AH_ST.StatsServer(options.statssocket, S4AH_ST.stats)
+        except socket.error, e:
+            logger.error("Unable to open the stats socket %s: %s", options.statssocket, e)
+    if options.capture:
+        import s4ah_Capture as S4AH_CP
+        try:
+            S4AH_CP.start(options.capture)
+        except IOError, e:
+            logger.error("Unable to open the capture file %s: %s", options.capture, e)
+    profile.mark('services')
+
+    def report_startup():
+        if options.profilestartup:
+            for line in profile.report():
+                logger.info(line)
+
+    def close_services():
+        with servicesLock:
+            if waveforms:
+                waveforms.close()
+            if workers:
+                workers.close()
+        if i2cPoller:
+            i2cPoller.close()
+        if analogInputs:
+            analogInputs.close()
+        if options.capture:
+            S4AH_CP.stop()
+        if options.gpioworker:
+            s4ahGC.backend.close()
+        if statsServer:
+            statsServer.close()
+        if statsFile:
+            S4AH_ST.stats.writeFile(statsFile)
+
+    if options.engine == ENGINE_EVENTLOOP:
+        import s4ah_EventLoop as S4AH_EL
+        engine = S4AH_EL.EventLoopEngine(s4ahGC, hosts, PORT, ScratchCommands,
+                                         S4AH_SQ.SensorUpdateQueue(options.maxrate, options.maxbatch, options.maxpending),
+                                         edgeMonitor, maxAttempts=MAXATTEMPTS, maxBacklog=options.maxbacklog,
+                                         inputFilters=inputFilters, pollScheduler=pollScheduler,
+                                         resetGrace=options.resetgrace, analogInputs=analogInputs)
+        # the replies of the workers are put in the queues by the loop thread
+        workersDeliver = engine.callFromThread
+        if i2cPoller:
+            def deliverI2C(changes):
+                engine.callFromThread(engine.putSensors, changes)
+                return True
+            i2cPoller.deliver = deliverI2C
+            i2cPoller.start()
+        if statsServer:
+            engine.register(statsServer.fileno(), select.EPOLLIN,
+                            lambda events: statsServer.serveOne())
+        profile.mark('engine')
+        report_startup()
+        engine.run()
+        close_services()
+        logger.debug("CleanUp complete")
+        sys.exit(0)
+
+    if statsServer:
+        statsServer.start()
+    report_startup()
+
     #SCRIPTPATH = os.path.split(os.path.realpath(__file__))[0]
     #logger.debug("PATH:%s", SCRIPTPATH)
-    numAttempts = MAXATTEMPTS
-    cycle_trace = 'start'
+    peers = [MeshPeer(host) for host in hosts]
+    stop_requested = False
+    # the sender and the fanout are shared by all the peers: they run while
+    # at least one peer is connected
+    sender = None
+    fanout = None
+    resetAt = None      # time the pins are reset when no peer is connected
+
+    def start_shared():
+        global sender, fanout
+        queue = S4AH_SQ.SensorUpdateQueue(options.maxrate, options.maxbatch, options.maxpending)
+        fanout = S4AH_SQ.FrameFanout(queue)
+        sender = ScratchSender(queue, edgeMonitor)
+        fanout.start()
+        sender.start()
+
+    def deliverI2C(changes):
+        """
+        run by the I2C poller: the changes are kept by the poller while
+        there is no queue (no peer connected)
+        """
+        shared = fanout
+        if shared is None:
+            return False
+        logger.debug('sending: %s', changes)
+        S4AH_ST.stats.count('changes', len(changes))
+        shared.queue.put(changes)
+        return True
+
+    def stop_shared():
+        global sender, fanout
+        logger.debug("outbound queue stats: %s", fanout.queue.stats())
+        cleanup_threads((sender, fanout))
+        sender = None
+        fanout = None
+
+    if i2cPoller:
+        i2cPoller.deliver = deliverI2C
+        i2cPoller.start()
 
     while True:
         try:
-            if cycle_trace == 'start':
-                # open the socket trying each 3 seconds
-                logger.info('Trying to connect...')
-                time.sleep(3)
-                s = scratch.Scratch(host)
-                the_socket = s.socket
-                logger.info('Connected!')
-                listener = ScratchListener(s)
-                sender = ScratchSender(s)
-                cycle_trace = 'running'
-                logger.info("Running....")
-                listener.start()
-                sender.start()
-
-            if cycle_trace == 'disconnected':
-                logger.info("Scratch disconnected")
-                cleanup_threads((listener, sender))
-                logger.debug("Thread cleanup done after disconnect")
-                s4ahGC.resetAllPins()
-                logger.debug("Pin Reset Done")
-                time.sleep(1)
-                cycle_trace = 'start'
+            if stop_requested:
+                logger.debug("stop handler msgs sent from Scratch")
+                raise KeyboardInterrupt
+
+            for peer in peers:
+                if peer.state == 'start' and time.time() >= peer.nextAttempt:
+                    logger.info('Trying to connect to %s...', peer.host)
+                    peer.connect()
+
+                if peer.state == 'connected':
+                    if fanout is None:
+                        start_shared()
+                    peer.start(fanout, options.maxbacklog)
+                    logger.info('Connected to %s!', peer.host)
+                    logger.info("Running....")
+                elif peer.state == 'refused':
+                    logger.info("There was an error connecting to Scratch!")
+                    logger.info("I couldn't find a Mesh session at host: %s, port: %s (%s)", peer.host, PORT, peer.error)
+                    peer.attempts += 1
+                    peer.nextAttempt = time.time() + peer.backoff.next()
+                    peer.state = 'start'
+                    if MAXATTEMPTS != 0 and peer.attempts >= MAXATTEMPTS:
+                        peer.state = 'failed'
+
+                if peer.state == 'disconnected':
+                    logger.info("Scratch %s disconnected", peer.host)
+                    peer.close(fanout)
+                    logger.debug("Thread cleanup done after disconnect")
+                    peer.nextAttempt = time.time() + peer.backoff.next()
+
+            if [peer for peer in peers if peer.state == 'running']:
+                resetAt = None
+            elif fanout is not None:
+                # the last peer is gone: the shared threads keep the inputs
+                # up to date until the pins are reset
+                if resetAt is None:
+                    resetAt = time.time() + options.resetgrace
+                    if options.resetgrace > 0:
+                        logger.info("no Scratch connected: pins reset in %s secs", options.resetgrace)
+                if options.resetgrace >= 0 and time.time() >= resetAt:
+                    stop_shared()
+                    s4ahGC.resetAllPins()
+                    logger.debug("Pin Reset Done")
+                    resetAt = None
+
+            if not [peer for peer in peers if peer.state != 'failed']:
+                sys.exit(0)
 
             time.sleep(0.010) # needed to catch keyboard interrupts
 
-        except scratch.ScratchError:
-            logger.info("There was an error connecting to Scratch!")
-            logger.info("I couldn't find a Mesh session at host: %s, port: %s", host, PORT)
-            numAttempts -= 1
-            if MAXATTEMPTS != 0 and numAttempts == 0:
-                sys.exit(0)
         except KeyboardInterrupt:
             logger.debug("Keyboard Interrupt")
-            try:
-                cleanup_threads((listener, sender))
-                logger.debug("Thread cleanup done after disconnect")
-            except NameError:
-                # needed if the KeyboardInterrupt occurs during the connectins attempt
-                # before that a listener or sender instance is created
-                pass
+            for peer in peers:
+                if peer.state in ('running', 'disconnected'):
+                    peer.close(fanout)
+                elif peer.state == 'connected':
+                    # opened but not served yet
+                    peer.session.socket.close()
+            if fanout is not None:
+                stop_shared()
+            logger.debug("Thread cleanup done")
+            if edgeMonitor:
+                edgeMonitor.close()
             s4ahGC.resetAllPins()
             logger.debug("Pin Reset Done")
-            sys.exit(0)
+            close_services()
             logger.debug("CleanUp complete")
+            sys.exit(0)
         except scratch.ScratchConnectionError, e:
             logger.error("ScratchConnectionError %s", e)
         except Exception, e:
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#test_adc - decoding, averaging and deadband of the IIO ADC scans
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import struct
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_GPIOController as S4AH
+import s4ah_ADC as S4AH_ADC
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+
+class ScanLayoutTest(unittest.TestCase):
+
+    def testChannelDecode(self):
+        plain = S4AH_ADC.ScanChannel(0, 0, 'le:u16/16>>0')
+        self.assertTrue(plain.plain)
+        self.assertEqual(plain.decode((1, 65535)), (1, 65535))
+        masked = S4AH_ADC.ScanChannel(1, 1, 'le:u10/16>>0')
+        self.assertEqual(masked.decode([0xfc00 | 1023, 0x0400 | 5]), [1023, 5])
+        signed = S4AH_ADC.ScanChannel(2, 2, 'be:s12/16>>4')
+        self.assertEqual(signed.endian, '>')
+        self.assertEqual(signed.decode([0x7ff0, 0x8000, 0xfff0, 0x000f]), [2047, -2048, -1, 0])
+
+    def testUnsupportedType(self):
+        self.assertRaises(S4AH_ADC.ADCError, S4AH_ADC.ScanChannel, 0, 0, 'le:u10/24>>0')
+        self.assertRaises(S4AH_ADC.ADCError, S4AH_ADC.ScanChannel, 0, 0, 'garbage')
+
+    def testAlignment(self):
+        # in index order, each aligned to its size, the scan to the largest
+        layout = S4AH_ADC.ScanLayout([S4AH_ADC.ScanChannel(5, 2, 'le:u32/32>>0'),
+                                      S4AH_ADC.ScanChannel(3, 0, 'le:u8/8>>0'),
+                                      S4AH_ADC.ScanChannel(4, 1, 'le:u16/16>>0')])
+        self.assertEqual([channel.number for channel in layout.channels], [3, 4, 5])
+        self.assertEqual(layout.format, 'BxHI')
+        self.assertEqual(layout.size, 8)
+        data = struct.pack('<BxHI', 7, 300, 70000) + struct.pack('<BxHI', 8, 301, 70001)
+        self.assertEqual(layout.unpack(data, 2), (7, 300, 70000, 8, 301, 70001))
+        padded = S4AH_ADC.ScanLayout([S4AH_ADC.ScanChannel(0, 0, 'le:u32/32>>0'),
+                                      S4AH_ADC.ScanChannel(1, 1, 'le:u16/16>>0')])
+        self.assertEqual(padded.format, 'IHxx')
+
+    def testMixedEndianness(self):
+        self.assertRaises(S4AH_ADC.ADCError, S4AH_ADC.ScanLayout,
+                          [S4AH_ADC.ScanChannel(0, 0, 'le:u16/16>>0'),
+                           S4AH_ADC.ScanChannel(1, 1, 'be:u16/16>>0')])
+
+
+class ADCMonitorTest(unittest.TestCase):
+    """
+    the monitor on the fake ADC of createOfflineDevice: the tests write
+    the scans (two 10 bits channels, 16 bits little endian) to its FIFO
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        devicesDir = os.path.join(self.root, 'devices')
+        devDir = os.path.join(self.root, 'dev')
+        S4AH_ADC.createOfflineDevice(devicesDir, devDir)
+        device = S4AH_ADC.findDevice(devicesDir, devDir)
+        self.controller = S4AH.GPIOController('Arietta_G25', True, S4AH.BACKEND_VIRTUAL, virtualPins=8)
+        self.monitor = S4AH_ADC.ADCMonitor(self.controller, device, rate=100, average=4, deadband=5)
+        self.controller.setPinMode('ADC3', S4AH.PINPUT)
+        self.controller.setPinMode('ADC1', S4AH.PINPUT)
+        self.writer = os.open(device.devPath, os.O_WRONLY | os.O_NONBLOCK)
+
+    def tearDown(self):
+        os.close(self.writer)
+        self.monitor.close()
+        shutil.rmtree(self.root)
+
+    def scans(self, *pairs):
+        os.write(self.writer, ''.join(struct.pack('<HH', adc1, adc3) for (adc1, adc3) in pairs))
+
+    def values(self):
+        return sorted((pin.name, value) for (pin, value) in self.monitor.read())
+
+    def testLayoutOfTheInputPins(self):
+        self.assertEqual([pin.name for pin in self.monitor.active], ['ADC1', 'ADC3'])
+        self.assertEqual(self.monitor.layout.format, 'HH')
+
+    def testAverages(self):
+        self.scans((100, 1000), (102, 1000), (98, 1000))
+        self.assertEqual(self.values(), [])
+        self.scans((100, 1003))
+        self.assertEqual(self.values(), [('ADC1', 100), ('ADC3', 1001)])
+        # eight scans at once: two averages, the second one sent
+        self.scans(*([(100, 1001)] * 4 + [(200, 1001)] * 4))
+        self.assertEqual(self.values(), [('ADC1', 200)])
+
+    def testPartialScanIsKept(self):
+        data = ''.join(struct.pack('<HH', 500, 7) for i in xrange(4))
+        os.write(self.writer, data[:5])
+        self.assertEqual(self.values(), [])
+        os.write(self.writer, data[5:])
+        self.assertEqual(self.values(), [('ADC1', 500), ('ADC3', 7)])
+
+    def testDeadband(self):
+        self.scans(*[(500, 500)] * 4)
+        self.values()
+        self.scans(*[(504, 496)] * 4)
+        self.assertEqual(self.values(), [])
+        self.scans(*[(505, 495)] * 4)
+        self.assertEqual(self.values(), [('ADC1', 505), ('ADC3', 495)])
+        self.monitor.setDeadband('adc3', 20)
+        self.scans(*[(515, 510)] * 4)
+        self.assertEqual(self.values(), [('ADC1', 515)])
+
+    def testStoppedPinIsSentAgain(self):
+        self.scans(*[(10, 20)] * 4)
+        self.values()
+        self.controller.setPinMode('ADC1', S4AH.PUNUSED)
+        self.assertEqual([pin.name for pin in self.monitor.active], ['ADC3'])
+        self.controller.setPinMode('ADC1', S4AH.PINPUT)
+        self.scans(*[(10, 20)] * 4)
+        self.assertEqual(self.values(), [('ADC1', 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#test_edgemonitor - edges of the offline value files
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import select
+import shutil
+import logging
+import tempfile
+import unittest
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_EdgeMonitor as S4AH_EM
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+Pin = namedtuple('Pin', 'name')
+
+
+class OfflineController:
+    """
+    the part of GPIOController used by the EdgeMonitor, on a tree of
+    regular value files as the offline one of ablib
+    """
+    offline = True
+
+    def __init__(self, root, names):
+        self.root = root
+        self.modeListeners = []
+        self.inputPins = []
+        for name in names:
+            os.mkdir(self.pinPath(name))
+            self.setValue(name, 0)
+            self.inputPins.append(Pin(name))
+
+    def pinPath(self, pinName):
+        return os.path.join(self.root, pinName)
+
+    def setPinEdge(self, pinName, edge):
+        return True
+
+    def clearPinEdge(self, pinName):
+        pass
+
+    def setValue(self, pinName, value):
+        with open(self.pinPath(pinName) + "/value", 'w') as fh:
+            fh.write("%d\n" % value)
+
+
+class OfflineEdgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.controller = OfflineController(self.root, ['PA1', 'PA2', 'PC3'])
+        self.controller.setValue('PC3', 1)
+        self.monitor = S4AH_EM.EdgeMonitor(self.controller)
+        self.monitor.sync()
+
+    def tearDown(self):
+        self.monitor.close()
+        shutil.rmtree(self.root)
+
+    def testValueFilesAreWatched(self):
+        self.assertIsInstance(self.monitor.epoll, S4AH_EM.OfflineEdgePoller)
+        self.assertEqual(self.monitor.polledPins, [])
+        self.assertEqual(sorted(self.monitor.pinFds), ['PA1', 'PA2', 'PC3'])
+
+    def testInitialValues(self):
+        # returned at once by the first wait, as the first poll of the pins
+        self.assertEqual(sorted(self.monitor.wait(-1)), [('PA1', 0), ('PA2', 0), ('PC3', 1)])
+        self.assertEqual(self.monitor.wait(0), [])
+
+    def testEdgeUpdatesThePin(self):
+        self.monitor.wait(0)
+        self.controller.setValue('PA2', 1)
+        self.assertEqual(self.monitor.wait(1.0), [('PA2', 1)])
+        self.controller.setValue('PA2', 0)
+        self.controller.setValue('PC3', 0)
+        self.assertEqual(sorted(self.monitor.wait(1.0)), [('PA2', 0), ('PC3', 0)])
+        self.assertEqual(self.monitor.wait(0), [])
+
+    def testEventLoopWaitsOnTheFileno(self):
+        # the event loop engine registers the fileno in its own epoll
+        self.monitor.wait(0)
+        loop = select.epoll()
+        loop.register(self.monitor.epoll.fileno(), select.EPOLLIN)
+        try:
+            self.assertEqual(loop.poll(0), [])
+            self.controller.setValue('PA1', 1)
+            self.assertEqual(len(loop.poll(1.0)), 1)
+            self.assertEqual(self.monitor.wait(0), [('PA1', 1)])
+        finally:
+            loop.close()
+
+    def testModeChangeUnwatchesThePin(self):
+        self.monitor.wait(0)
+        self.controller.inputPins = [Pin('PA1')]
+        for listener in self.controller.modeListeners:
+            listener()
+        # the wakeup ends the wait at once, without changes
+        self.assertEqual(self.monitor.wait(1.0), [])
+        self.monitor.sync()
+        self.assertEqual(self.monitor.pinFds.keys(), ['PA1'])
+        self.controller.setValue('PC3', 0)
+        self.controller.setValue('PA1', 1)
+        self.assertEqual(self.monitor.wait(1.0), [('PA1', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#test_eventloop - the event loop engine and its peers on a local socket
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import socket
+import logging
+import threading
+import unittest
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_GPIOController as S4AH
+import s4ah_SensorQueue as S4AH_SQ
+import s4ah_ScratchCodec as S4AH_SC
+import s4ah_EventLoop as S4AH_EL
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+
+class NoCommands:
+    def __init__(self, replies, onStop):
+        pass
+
+    def handlers(self):
+        return {}
+
+
+class ReconnectTest(unittest.TestCase):
+    """
+    the engine loop is run a step at a time (run() installs the signal
+    handlers of the main program): the test plays the Scratch host
+    """
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.listener.settimeout(2.0)
+        self.controller = S4AH.GPIOController('Arietta_G25', True, S4AH.BACKEND_VIRTUAL, virtualPins=4)
+        self.controller.setPinMode('V1', S4AH.PINPUT)
+        self.pin = self.controller.lookupPin('V1')
+        # a negative grace never resets the pins: the values survive the disconnection
+        self.engine = S4AH_EL.EventLoopEngine(self.controller, ['127.0.0.1'], self.listener.getsockname()[1],
+                                              NoCommands, S4AH_SQ.SensorUpdateQueue(maxRate=0),
+                                              reconnectDelay=0.05, resetGrace=-1)
+        self.peer = self.engine.peers[0]
+        self.scratch = None
+
+    def tearDown(self):
+        self.peer.closeSocket()
+        for timer in self.engine.timers:
+            timer[2].cancel()
+        self.engine.epoll.close()
+        os.close(self.engine.wakeRead)
+        os.close(self.engine.wakeWrite)
+        if self.scratch is not None:
+            self.scratch.close()
+        self.listener.close()
+
+    def step(self, timeout=0.01):
+        """
+        one iteration of EventLoopEngine.run
+        """
+        self.engine.flush()
+        for (fd, event) in self.engine.epoll.poll(timeout):
+            self.engine.fdHandlers[fd](event)
+        self.engine.runTimers()
+
+    def stepUntil(self, condition, timeout=2.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            self.step()
+        self.assertTrue(condition())
+
+    def accept(self):
+        if self.peer.sock is None:
+            self.peer.connect()
+        self.scratch = self.listener.accept()[0]
+        self.scratch.settimeout(2.0)
+        self.stepUntil(lambda: self.peer.connected)
+
+    def received(self):
+        """
+        the sensor-updates received by the Scratch host, in order
+        """
+        decoder = S4AH_SC.FrameDecoder()
+        updates = []
+        self.scratch.settimeout(0.1)
+        try:
+            while decoder.receive(self.scratch):
+                updates.extend(S4AH_SC.parseMessage(payload)[1] for payload in decoder.frames())
+        except socket.timeout:
+            pass
+        return updates
+
+    def testChangeWithoutPeersIsKept(self):
+        self.accept()
+        self.engine.putChanges([(self.pin, 0)])
+        self.step()
+        self.assertEqual(self.received(), [{'pinV1': '0'}])
+
+        self.scratch.close()
+        self.scratch = None
+        self.stepUntil(lambda: not self.peer.connected)
+        # the input changes while no Scratch is connected
+        self.engine.putChanges([(self.pin, 1)])
+        self.assertEqual(self.pin.value, 1)
+
+        # reconnected by the backoff timer
+        self.stepUntil(lambda: self.peer.sock is not None)
+        self.accept()
+        self.step()
+        updates = self.received()
+        # the snapshot sent on connection already has the new value
+        self.assertEqual(updates[0], {'pinV1': '1'})
+        self.assertEqual(updates[-1]['pinV1'], '1')
+        self.assertEqual(self.engine.latest, {'pinV1': 1})
+
+    def testChangeBeforeTheFirstConnection(self):
+        self.engine.putChanges([(self.pin, 1)])
+        self.accept()
+        self.step()
+        self.assertEqual(self.received(), [{'pinV1': '1'}])
+
+class PausedCalls(deque):
+    """
+    calls queue holding the posting thread between the check of the wake
+    pipe and its write, until the loop thread is done or timeout
+    """
+    def __init__(self, timeout):
+        deque.__init__(self)
+        self.timeout = timeout
+        self.posting = threading.Event()
+        self.done = threading.Event()
+
+    def append(self, call):
+        deque.append(self, call)
+        self.posting.set()
+        self.done.wait(self.timeout)
+
+
+class CallFromThreadTest(unittest.TestCase):
+
+    def testCallDuringShutdown(self):
+        controller = S4AH.GPIOController('Arietta_G25', True, S4AH.BACKEND_VIRTUAL, virtualPins=4)
+        engine = S4AH_EL.EventLoopEngine(controller, [], 42001, NoCommands, S4AH_SQ.SensorUpdateQueue())
+        engine.calls = PausedCalls(0.2)
+        errors = []
+        def post():
+            try:
+                engine.callFromThread(len, ())
+            except Exception, e:
+                errors.append(e)
+        thread = threading.Thread(target=post)
+        thread.start()
+        engine.calls.posting.wait(1.0)
+        engine.shutdown()
+        # new pipes take the numbers of the closed fds: nothing is written there
+        pipes = [os.pipe() for i in xrange(2)]
+        engine.calls.done.set()
+        thread.join()
+        for (r, w) in pipes:
+            fcntl.fcntl(r, fcntl.F_SETFL, os.O_NONBLOCK)
+            try:
+                self.fail("%d bytes written to a closed wake pipe" % len(os.read(r, 4096)))
+            except OSError, e:
+                self.assertEqual(e.errno, errno.EAGAIN)
+            finally:
+                os.close(r)
+                os.close(w)
+        self.assertEqual(errors, [])
+        self.assertIsNone(engine.wakeWrite)
+        # and the calls after the shutdown are ignored
+        engine.callFromThread(len, ())
+
+
+if __name__ == '__main__':
+    unittest.main()
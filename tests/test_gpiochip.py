@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#test_gpiochip - line requests of the gpiochip backend, on the fake chips
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_GPIOController as S4AH
+try:
+    import s4ah_GPIOChip as S4AH_GC
+except ImportError:
+    S4AH_GC = None      # the backend needs ablib
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+
+class Controller:
+    boardName = 'Arietta_G25'
+
+
+class Pin:
+    def __init__(self, name):
+        self.name = name
+
+
+@unittest.skipIf(S4AH_GC is None, "ablib not installed")
+class LineRequestsTest(unittest.TestCase):
+    """
+    the released line requests are recorded: an output line released is
+    no longer driven by the kernel
+    """
+    def setUp(self):
+        self.chips = S4AH_GC.FakeGPIOChips()
+        self.released = []
+        close = self.chips.close
+        def record(fd):
+            self.released.extend(self.chips.lines.get(fd, (None, ()))[1])
+            close(fd)
+        self.chips.close = record
+        self.backend = S4AH_GC.GPIOChipBackend(Controller(), True, self.chips)
+        self.pins = dict((name, Pin(name)) for name in ('PA1', 'PA2', 'PA3', 'PA4', 'PB1'))
+
+    def tearDown(self):
+        self.backend.close()
+
+    def output(self, name, value):
+        self.backend.setMode(self.pins[name], S4AH.POUTPUT)
+        self.backend.write(self.pins[name], value)
+
+    def writeMany(self, values):
+        self.backend.writeMany([(self.pins[name], value) for (name, value) in values])
+
+    def testOutputsKeptWhileOtherPinsChange(self):
+        self.output('PA1', 1)
+        self.backend.setMode(self.pins['PA2'], S4AH.POUTPUT)
+        self.backend.setMode(self.pins['PA3'], S4AH.PINPUT)
+        self.backend.setMode(self.pins['PA3'], S4AH.PUNUSED)
+        self.backend.release(self.pins['PA2'])
+        self.assertNotIn(1, self.released)
+        self.assertEqual(self.chips.values[(0, 1)], 1)
+        self.assertEqual(self.backend.read(self.pins['PA1']), 1)
+
+    def testInputsOfABankReadTogether(self):
+        for name in ('PA1', 'PA2', 'PB1'):
+            self.backend.setMode(self.pins[name], S4AH.PINPUT)
+        self.chips.setValue(0, 2, 1)
+        ioctls = self.chips.ioctls
+        values = self.backend.readInputs([self.pins[name] for name in ('PA1', 'PA2', 'PB1')])
+        self.assertEqual([(pin.name, value) for (pin, value) in values], [('PA1', 0), ('PA2', 1), ('PB1', 0)])
+        self.assertEqual(self.chips.ioctls - ioctls, 2)
+
+    def testLinesWrittenTogetherAreMerged(self):
+        self.output('PA4', 1)
+        for name in ('PA1', 'PA2', 'PA3'):
+            self.backend.setMode(self.pins[name], S4AH.POUTPUT)
+        self.writeMany([('PA1', 1), ('PA2', 0), ('PA3', 1)])
+        self.assertEqual(sorted(self.released), [1, 2, 3])
+        request = self.backend.outputRequests[(0, 1)]
+        self.assertEqual(request.offsets, [1, 2, 3])
+        self.assertEqual([self.chips.values[(0, offset)] for offset in (1, 2, 3, 4)], [1, 0, 1, 1])
+        # one ioctl for the merged lines, none released
+        ioctls = self.chips.ioctls
+        self.writeMany([('PA1', 0), ('PA3', 0)])
+        self.assertEqual(self.chips.ioctls - ioctls, 1)
+        self.assertEqual(sorted(self.released), [1, 2, 3])
+        self.assertEqual([self.chips.values[(0, offset)] for offset in (1, 2, 3)], [0, 0, 0])
+
+    def testPartialWriteIsNotMerged(self):
+        self.output('PA1', 1)
+        self.output('PA2', 1)
+        self.writeMany([('PA1', 0), ('PA2', 0)])
+        del self.released[:]
+        self.output('PA3', 1)
+        # PA3 has a request of its own: PA1 and PA2 are not released to merge it
+        self.writeMany([('PA1', 1), ('PA3', 0)])
+        self.assertEqual(self.released, [])
+        self.assertEqual([self.chips.values[(0, offset)] for offset in (1, 2, 3)], [1, 0, 0])
+
+    def testLineLeavingAMergedRequest(self):
+        self.output('PA1', 1)
+        self.output('PA2', 1)
+        self.writeMany([('PA1', 0), ('PA2', 1)])
+        self.backend.setMode(self.pins['PA1'], S4AH.PINPUT)
+        # PA2 is requested again at its value
+        self.assertEqual(self.backend.outputRequests[(0, 2)].offsets, [2])
+        self.assertEqual(self.chips.values[(0, 2)], 1)
+        self.assertNotIn((0, 1), self.backend.outputRequests)
+        self.assertRaises(IOError, self.backend.write, self.pins['PA1'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
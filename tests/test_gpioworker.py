@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#test_gpioworker - the seqlock slots and the GPIO worker process
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import time
+import logging
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_GPIOController as S4AH
+import s4ah_GPIOWorker as S4AH_GW
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+
+class SharedPinsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shared = S4AH_GW.SharedPins(4)
+
+    def tearDown(self):
+        self.shared.close()
+
+    def testPublish(self):
+        self.assertEqual(self.shared.read(2), (0, S4AH_GW.UNSAMPLED))
+        self.shared.publish(2, 7, 1)
+        self.assertEqual(self.shared.read(2), (7, 1))
+        self.assertEqual(S4AH_GW.SLOT.unpack_from(self.shared.map, 2 * S4AH_GW.SLOT.size)[0], 2)
+        self.assertEqual(self.shared.read(1), (0, S4AH_GW.UNSAMPLED))
+
+    def testReadWaitsForTheWriter(self):
+        # a slot left odd is being written: read retries until it is even
+        S4AH_GW.SLOT.pack_into(self.shared.map, S4AH_GW.SLOT.size, 1, 3, 0)
+        def finish():
+            time.sleep(0.05)
+            S4AH_GW.SLOT.pack_into(self.shared.map, S4AH_GW.SLOT.size, 2, 4, 1)
+        writer = threading.Thread(target=finish)
+        writer.start()
+        start = time.time()
+        self.assertEqual(self.shared.read(1), (4, 1))
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        writer.join()
+
+    def testNoTornReadsAcrossProcesses(self):
+        # the child publishes generation == value: a torn read would mix them
+        pid = os.fork()
+        if pid == 0:
+            for n in xrange(1, 200001):
+                self.shared.publish(0, n, n)
+            os._exit(0)
+        reads = 0
+        last = 0
+        while True:
+            (generation, value) = self.shared.read(0)
+            if value != S4AH_GW.UNSAMPLED:
+                self.assertEqual(generation, value)
+                self.assertGreaterEqual(value, last)
+                last = value
+                reads += 1
+            if value == 200000 or os.waitpid(pid, os.WNOHANG)[0]:
+                break
+        self.assertEqual(self.shared.read(0), (200000, 200000))
+        self.assertGreater(reads, 0)
+
+
+class WorkerProcessTest(unittest.TestCase):
+    """
+    the worker forked with the virtual backend of a small board
+    """
+    def setUp(self):
+        self.controller = S4AH.GPIOController('Arietta_G25', True, S4AH.BACKEND_VIRTUAL, virtualPins=8)
+        self.virtual = self.controller.backend
+        self.backend = S4AH_GW.start(self.controller, interval=0.001)
+
+    def tearDown(self):
+        self.backend.close()
+
+    def waitInputs(self, expected, timeout=2.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            values = [(pin.name, value) for (pin, value) in self.controller.readInputs()]
+            if values == expected:
+                return values
+            time.sleep(0.002)
+        return values
+
+    def testBackendReplaced(self):
+        self.assertIsInstance(self.controller.backend, S4AH_GW.WorkerBackend)
+        self.assertIs(self.backend, self.controller.backend)
+
+    def testWritesAndReadsGoThroughTheWorker(self):
+        self.controller.pinUpdate('V2', 1)
+        self.controller.setPinMode('V1', S4AH.PINPUT)
+        self.assertEqual(self.waitInputs([('V1', 0)]), [('V1', 0)])
+        # the level written by the worker to its virtual pin is read back as INPUT
+        self.controller.setPinMode('V2', S4AH.PINPUT)
+        self.assertEqual(self.waitInputs([('V1', 0), ('V2', 1)]), [('V1', 0), ('V2', 1)])
+        # the handler's own virtual backend was never written
+        self.assertEqual(self.virtual.levels[self.controller.lookupPin('V2').index], 0)
+
+    def testStaleValueLeftOut(self):
+        self.controller.pinUpdate('V3', 1)
+        self.controller.setPinMode('V3', S4AH.PINPUT)
+        self.waitInputs([('V3', 1)])
+        pin = self.controller.lookupPin('V3')
+        # a new mode change: the value published before it is not returned
+        self.controller.setPinMode('V3', S4AH.PUNUSED)
+        self.assertIsNone(self.backend.sample(pin))
+
+    def testWorkerStopsWithThePipe(self):
+        pid = self.backend.pid
+        self.backend.close()
+        self.assertRaises(OSError, os.kill, pid, 0)
+        self.assertRaises(IOError, self.backend.write, self.controller.lookupPin('V1'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
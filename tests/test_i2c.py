@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#test_i2c - merging of the I2C sensors reads, against the fake bus
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import struct
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_I2C as S4AH_I2C
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+
+def sensor(name, address, register, fmt='>h', shift=0, scale=1, offset=0, period=0.1):
+    return S4AH_I2C.Sensor(name, 0, address, register, fmt, shift, scale, offset, period)
+
+
+class BuildBlocksTest(unittest.TestCase):
+
+    def testNearRegistersMerged(self):
+        sensors = [sensor('accz', 0x53, 0x36, '<h'), sensor('accx', 0x53, 0x32, '<h'),
+                   sensor('accy', 0x53, 0x34, '<h')]
+        blocks = S4AH_I2C.buildBlocks(sensors)
+        self.assertEqual(len(blocks), 1)
+        self.assertEqual((blocks[0].register, blocks[0].length), (0x32, 6))
+        self.assertEqual([(s.name, s.position) for s in blocks[0].sensors],
+                         [('accx', 0), ('accy', 2), ('accz', 4)])
+        self.assertEqual(blocks[0].messages(), [(0x53, [0x32]), (0x53, 6)])
+
+    def testFarRegistersSplit(self):
+        blocks = S4AH_I2C.buildBlocks([sensor('a', 0x40, 0x00), sensor('b', 0x40, 0x1e),
+                                       sensor('c', 0x40, 0x1f)])
+        # 0x1f + 2 bytes is beyond MAX_RANGE from 0x00
+        self.assertEqual([(b.register, b.length) for b in blocks], [(0x00, 0x20), (0x1f, 2)])
+
+    def testPlainReadsAndDevices(self):
+        blocks = S4AH_I2C.buildBlocks([sensor('light', 0x23, None, '>H'), sensor('t', 0x48, 0),
+                                       sensor('light2', 0x23, None, '>I')])
+        self.assertEqual([(b.address, b.register, b.length) for b in blocks],
+                         [(0x23, None, 2), (0x23, None, 4), (0x48, 0, 2)])
+        self.assertEqual(blocks[0].messages(), [(0x23, 2)])
+
+
+class FakeBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.bus = S4AH_I2C.FakeI2CBus(0, self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def device(self, address, registers):
+        data = bytearray(256)
+        for (register, value) in registers.items():
+            data[register:register + len(value)] = value
+        with open(self.bus.devicePath(address), 'wb') as fh:
+            fh.write(data)
+
+    def testOneTransactionForAllTheBlocks(self):
+        self.device(0x48, {0: struct.pack('>h', 400 << 4)})
+        self.device(0x53, {0x32: struct.pack('<hhh', 256, -256, 0)})
+        self.device(0x23, {0: struct.pack('>H', 1200)})
+        sensors = [sensor('temp', 0x48, 0, '>h', 4, 0.0625), sensor('accx', 0x53, 0x32, '<h', 0, 0.0039),
+                   sensor('accy', 0x53, 0x34, '<h', 0, 0.0039), sensor('light', 0x23, None, '>H')]
+        group = S4AH_I2C.PollGroup(self.bus, 0.1, sensors)
+        self.assertEqual(len(group.transactions), 1)
+        blocks = group.read()
+        self.assertEqual(self.bus.ioctls, 1)
+        self.assertEqual(len(blocks), 3)
+        values = dict((s.name, s.decode(s.block.buffer)) for s in sensors)
+        self.assertEqual(values, {'temp': 25.0, 'accx': 0.9984, 'accy': -0.9984, 'light': 1200})
+
+    def testTransactionsWithinTheMessagesLimit(self):
+        # 30 devices, 2 messages each: 42 messages at most per ioctl
+        for address in xrange(0x10, 0x10 + 30):
+            self.device(address, {0: chr(address)})
+        sensors = [sensor('s%d' % address, address, 0, 'B') for address in xrange(0x10, 0x10 + 30)]
+        group = S4AH_I2C.PollGroup(self.bus, 0.1, sensors)
+        self.assertEqual([len(blocks) for (transaction, blocks) in group.transactions], [21, 9])
+        self.assertEqual(len(group.read()), 30)
+        self.assertEqual(self.bus.ioctls, 2)
+        self.assertEqual([s.decode(s.block.buffer) for s in sensors], range(0x10, 0x10 + 30))
+        self.assertRaises(S4AH_I2C.I2CError, S4AH_I2C.Transaction, [(0x10, 1)] * 43)
+
+    def testDeviceNotAnsweringIsSkipped(self):
+        self.device(0x48, {0: struct.pack('>h', 7)})
+        sensors = [sensor('t', 0x48, 0), sensor('ghost', 0x10, 0)]
+        group = S4AH_I2C.PollGroup(self.bus, 0.1, sensors)
+        blocks = group.read()
+        # the shared transaction, then each block alone
+        self.assertEqual(self.bus.ioctls, 3)
+        self.assertEqual([b.address for b in blocks], [0x48])
+        self.assertEqual(sensors[0].decode(sensors[0].block.buffer), 7)
+        self.assertTrue(sensors[1].block.failing)
+        # the device comes back
+        self.device(0x10, {0: struct.pack('>h', -3)})
+        self.assertEqual(len(group.read()), 2)
+        self.assertFalse(sensors[1].block.failing)
+        self.assertEqual(sensors[1].decode(sensors[1].block.buffer), -3)
+
+    def testPointerOfPlainReads(self):
+        # a plain read starts where the last write left the register pointer
+        self.device(0x23, {0: '\x01\x02', 5: '\x05\x06'})
+        S4AH_I2C.Transaction([(0x23, [5])]).run(self.bus)
+        plain = S4AH_I2C.Transaction([(0x23, 2)])
+        plain.run(self.bus)
+        self.assertEqual(list(plain.buffers[0]), [5, 6])
+        plain.run(self.bus)
+        self.assertEqual(list(plain.buffers[0]), [5, 6])
+
+
+class ParseConfigTest(unittest.TestCase):
+
+    def parse(self, text):
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, text)
+        os.close(fd)
+        try:
+            return S4AH_I2C.parseConfig(path)
+        finally:
+            os.remove(path)
+
+    def testLines(self):
+        (sensors, inits) = self.parse("# comment\n"
+                                      "init 0 0x53 0x2d 0x08\n"
+                                      "temp 0 0x48 0x00 >h>>4 0.0625\n"
+                                      "light 1 0x23 - H 0.8333 0 200  # plain read\n")
+        self.assertEqual(inits, [(0, 0x53, [0x2d, 0x08])])
+        self.assertEqual([(s.name, s.bus, s.address, s.register, s.format.format, s.shift, s.period)
+                          for s in sensors],
+                         [('temp', 0, 0x48, 0, '>h', 4, 0.1), ('light', 1, 0x23, None, '>H', 0, 0.2)])
+
+    def testErrors(self):
+        for text in ["temp 0 0x48 0x00 >q\n", "temp 0 0x48\n", "temp 0 0x48 0 B 1 0 0\n",
+                     "t 0 0x48 0 B\nt 0 0x49 0 B\n", "init 0 0x53\n"]:
+            self.assertRaises(S4AH_I2C.I2CError, self.parse, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
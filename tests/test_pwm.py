@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#test_pwm - order of the writes to the sysfs pwm channels
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_PWM as S4AH_PWM
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+
+class PWMOrderTest(unittest.TestCase):
+    """
+    the kernel refuses a duty cycle longer than the period: the writes are
+    recorded and the duty cycle checked against the period at each one
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        S4AH_PWM.createOfflineTree(self.root, 2)
+        self.pwm = S4AH_PWM.PWMOutputs(None, {'PB11': 0, 'PB12': 1})
+        # the fake tree of the test instead of /sys/class/pwm
+        self.pwm.chip = S4AH_PWM.findChip(self.root, 2)
+        self.pwm.seek = True
+        self.writes = []
+        self.written = {}       # channel path -> {'period': ..., 'duty': ...}
+        self.pwm.writeDuty = self.recordDuty
+        self.channelWrite = S4AH_PWM.PWMChannel.write
+        S4AH_PWM.PWMChannel.write = lambda channel, name, value: self.recordWrite(channel, name, value)
+
+    def tearDown(self):
+        S4AH_PWM.PWMChannel.write = self.channelWrite
+        self.pwm.close()
+        shutil.rmtree(self.root)
+
+    def record(self, channel, name, value):
+        state = self.written.setdefault(channel.path, {'period': 0, 'duty': 0})
+        if name in state:
+            state[name] = value
+            self.assertLessEqual(state['duty'], state['period'] or state['duty'],
+                                 "duty %d over period %d" % (state['duty'], state['period']))
+        self.writes.append((name, value))
+
+    def recordDuty(self, channel, duty):
+        self.record(channel, 'duty', duty)
+        S4AH_PWM.PWMOutputs.writeDuty(self.pwm, channel, duty)
+
+    def recordWrite(self, channel, name, value):
+        self.record(channel, name, value)
+        self.channelWrite(channel, name, value)
+
+    def read(self, pinName, name):
+        with open(os.path.join(self.pwm.channels[pinName].path, name)) as fh:
+            return fh.read()
+
+    def testFirstDutyCycle(self):
+        self.pwm.setDuty('PB11', 50)
+        # the duty cycle left by a previous user is cleared first
+        self.assertEqual(self.writes, [('duty', 0), ('period', 1000000), ('duty', 500000), ('enable', 1)])
+        self.assertEqual(self.read('PB11', 'duty_cycle'), '500000')
+        self.assertEqual(self.read('PB11', 'period'), '1000000')
+
+    def testLongerPeriodFirst(self):
+        self.pwm.setDuty('PB11', 50)
+        del self.writes[:]
+        self.pwm.setPeriod('PB11', 20000000)
+        self.assertEqual(self.writes, [('period', 20000000), ('duty', 10000000)])
+
+    def testShorterDutyCycleFirst(self):
+        self.pwm.setPeriod('PB11', 20000000)
+        self.pwm.setDuty('PB11', 75)
+        del self.writes[:]
+        self.pwm.setPeriod('PB11', 1000000)
+        self.assertEqual(self.writes, [('duty', 750000), ('period', 1000000)])
+        # the shorter value left no digits of the longer one in the fake file
+        self.assertEqual(self.read('PB11', 'duty_cycle'), '750000')
+
+    def testPeriodWaitsForTheDutyCycle(self):
+        self.pwm.setPeriod('PB12', 20000000)
+        self.assertEqual(self.writes, [])
+        self.pwm.setDuty('PB12', 7.5)
+        self.assertEqual(self.writes, [('duty', 0), ('period', 20000000), ('duty', 1500000), ('enable', 1)])
+
+    def testUnchangedValuesAreSkipped(self):
+        self.pwm.setDuty('PB11', 50)
+        del self.writes[:]
+        self.pwm.setDuty('PB11', 50)
+        self.pwm.setPeriod('PB11', S4AH_PWM.DEFAULT_PERIOD)
+        self.assertEqual(self.writes, [])
+        self.pwm.setDuty('PB11', 25)
+        self.assertEqual(self.writes, [('duty', 250000)])
+
+    def testRelease(self):
+        self.pwm.setDuty('PB11', 50)
+        del self.writes[:]
+        self.pwm.release('PB11')
+        self.assertEqual(self.writes, [('enable', 0)])
+        self.assertNotIn('PB11', self.pwm.channels)
+        # exported again: nothing is assumed about the values left there
+        self.pwm.setDuty('PB11', 50)
+        self.assertEqual(self.writes[1:], [('duty', 0), ('period', 1000000), ('duty', 500000), ('enable', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
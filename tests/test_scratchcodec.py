@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#test_scratchcodec - the Scratch wire-protocol codec
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import socket
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_ScratchCodec as S4AH_SC
+
+
+def decodeAll(data, size=S4AH_SC.RECV_SIZE, chunk=None):
+    """
+    feed data to a decoder (chunk bytes at a time): return the payloads
+    """
+    decoder = S4AH_SC.FrameDecoder(size)
+    payloads = []
+    chunk = chunk or len(data)
+    for offset in xrange(0, len(data), chunk):
+        decoder.feed(data[offset:offset + chunk])
+        payloads.extend(decoder.frames())
+    return (payloads, decoder)
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def testBroadcast(self):
+        for name in ['pinPA3on', 'say "hi"', 'a b  c', '']:
+            (payloads, decoder) = decodeAll(S4AH_SC.encodeBroadcast(name))
+            self.assertEqual(payloads, ['broadcast ' + S4AH_SC.quote(name)])
+            self.assertEqual(S4AH_SC.parseMessage(payloads[0]), ('broadcast', name))
+            self.assertEqual(decoder.pending(), 0)
+
+    def testSensorUpdate(self):
+        data = [('pinPA5', 1), ('foo', 'bar baz'), ('quo"te', '""'), ('x', -2.5)]
+        (payloads, decoder) = decodeAll(S4AH_SC.encodeSensorUpdate(data))
+        self.assertEqual(S4AH_SC.parseMessage(payloads[0]),
+                         ('sensor-update', {'pinPA5': '1', 'foo': 'bar baz', 'quo"te': '""', 'x': '-2.5'}))
+
+    def testUnicodeIsSentAsUtf8(self):
+        frame = S4AH_SC.encodeFrame(u'broadcast "caf\xe9"')
+        self.assertEqual(frame[4:], 'broadcast "caf\xc3\xa9"')
+        self.assertEqual(S4AH_SC.HEADER.unpack(frame[:4])[0], len(frame) - 4)
+
+    def testEncoderReusesItsBuffer(self):
+        encoder = S4AH_SC.FrameEncoder(8)
+        self.assertEqual(encoder.frame('ab').tobytes(), S4AH_SC.encodeFrame('ab'))
+        text = 'x' * 100
+        self.assertEqual(encoder.frame(text).tobytes(), S4AH_SC.encodeFrame(text))
+        self.assertEqual(encoder.frame('cd').tobytes(), S4AH_SC.encodeFrame('cd'))
+
+
+class PartialFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = ['broadcast "m%d"' % i for i in xrange(20)] + ['sensor-update "s" ' + 'y' * 300]
+        self.stream = ''.join(S4AH_SC.encodeFrame(m) for m in self.messages)
+
+    def testOneByteAtATime(self):
+        (payloads, decoder) = decodeAll(self.stream, chunk=1)
+        self.assertEqual(payloads, self.messages)
+        self.assertEqual(decoder.pending(), 0)
+
+    def testOddChunksInASmallBuffer(self):
+        # frames cut anywhere, moved to the front and longer than the buffer
+        for chunk in (3, 7, 64, 1000):
+            (payloads, decoder) = decodeAll(self.stream, size=16, chunk=chunk)
+            self.assertEqual(payloads, self.messages)
+
+    def testIncompleteFrameWaits(self):
+        frame = S4AH_SC.encodeBroadcast('wait')
+        decoder = S4AH_SC.FrameDecoder()
+        decoder.feed(frame[:2])
+        self.assertEqual(list(decoder.frames()), [])
+        decoder.feed(frame[2:-1])
+        self.assertEqual(list(decoder.frames()), [])
+        self.assertEqual(decoder.pending(), len(frame) - 1)
+        decoder.feed(frame[-1:])
+        self.assertEqual(list(decoder.frames()), ['broadcast "wait"'])
+
+    def testTooLongFrame(self):
+        decoder = S4AH_SC.FrameDecoder(maxFrame=10)
+        decoder.feed(S4AH_SC.encodeFrame('x' * 11))
+        self.assertRaises(S4AH_SC.CodecError, list, decoder.frames())
+
+    def testReceiveFromSocket(self):
+        (a, b) = socket.socketpair()
+        try:
+            decoder = S4AH_SC.FrameDecoder(16)
+            payloads = []
+            a.sendall(self.stream)
+            a.close()
+            while decoder.receive(b):
+                payloads.extend(decoder.frames())
+            self.assertEqual(payloads, self.messages)
+        finally:
+            b.close()
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def testFastAndSlowPathsAgree(self):
+        for payload in ['sensor-update "a b" 1 "c" "d e"',
+                        'sensor-update "a""b" 1',
+                        'sensor-update ab"c 1',
+                        'sensor-update  "x"  2 ',
+                        'sensor-update "open']:
+            self.assertEqual(S4AH_SC.tokenize(payload), S4AH_SC.tokenizeSlow(payload), payload)
+
+    def testMessages(self):
+        self.assertEqual(S4AH_SC.tokenize('sensor-update "a""b" "c d" 3'),
+                         ['sensor-update', 'a"b', 'c d', '3'])
+        self.assertEqual(S4AH_SC.parseMessage('broadcast "x"'), ('broadcast', 'x'))
+        self.assertEqual(S4AH_SC.parseMessage('broadcast unquoted'), ('broadcast', 'unquoted'))
+        self.assertEqual(S4AH_SC.parseMessage('peer-name "x"'), None)
+        self.assertEqual(S4AH_SC.parseMessage(''), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
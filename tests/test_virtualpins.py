@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#test_virtualpins - a board of thousands of virtual pins
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_GPIOController as S4AH
+import s4ah_PollScheduler as S4AH_PS
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+PINS = 3000
+
+
+class VirtualPinsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = S4AH.GPIOController('Arietta_G25', True, S4AH.BACKEND_VIRTUAL,
+                                              virtualPins=PINS)
+        self.notified = []
+        self.controller.modeListeners.append(lambda: self.notified.append(1))
+
+    def loadStimulus(self, text):
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, text)
+        os.close(fd)
+        try:
+            self.controller.backend.loadStimulus(path)
+        finally:
+            os.remove(path)
+
+    def testConfigAllNotifiesOnce(self):
+        start = time.time()
+        self.controller.setAllPins(S4AH.PINPUT)
+        elapsed = time.time() - start
+        self.assertEqual(len(self.notified), 1)
+        self.assertEqual(len(self.controller.inputPins), PINS)
+        self.assertEqual([pin.index for pin in self.controller.inputPins], range(PINS))
+        # linear: a few msecs per thousand pins, seconds when it was quadratic
+        self.assertLess(elapsed, 1.0)
+        self.controller.resetAllPins()
+        self.assertEqual(len(self.notified), 2)
+        self.assertEqual(self.controller.inputPins, [])
+
+    def testSinglePinsKeepTheIndex(self):
+        self.controller.setAllPins(S4AH.PINPUT)
+        before = self.controller.inputPins
+        self.controller.pinUpdate('V10', 1)
+        self.controller.setPinMode('V20', S4AH.PUNUSED)
+        self.assertIsNot(self.controller.inputPins, before)
+        names = [pin.name for pin in self.controller.inputPins]
+        self.assertEqual(len(names), PINS - 2)
+        self.assertNotIn('V10', names)
+        self.assertNotIn('V20', names)
+        self.controller.setPinMode('V10', S4AH.PINPUT)
+        self.assertIn('V10', [pin.name for pin in self.controller.inputPins])
+        # a change not touching the INPUT set keeps the same list
+        self.controller.pinUpdate('V30', 1)
+        unchanged = self.controller.inputPins
+        self.controller.pinUpdate('V30', 0)
+        self.controller.setPinMode('V20', S4AH.POUTPUT)
+        self.assertIs(self.controller.inputPins, unchanged)
+        self.assertEqual(len(unchanged), PINS - 2)
+
+    def testBurstStimulusOnAllPins(self):
+        self.loadStimulus("V* burst 50 3 5 1\n")
+        self.controller.setAllPins(S4AH.PINPUT)
+        scheduler = S4AH_PS.PollScheduler(self.controller, budget=0)
+        now = time.time()
+        scheduler.setPins(self.controller.inputPins, now)
+        self.assertEqual(len(scheduler.due(now)), PINS)
+        changed = set()
+        first = dict((pin.name, value) for (pin, value) in self.controller.readInputs())
+        deadline = time.time() + 2.0
+        while len(changed) < PINS / 2 and time.time() < deadline:
+            for (pin, value) in self.controller.readInputs():
+                if value != first[pin.name]:
+                    changed.add(pin.name)
+        self.assertGreater(len(changed), PINS / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
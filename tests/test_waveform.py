@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#test_waveform - timing of the waveforms and sequences on the pins
+#Copyright (C) 2015 by Francesco Rotondella
+
+#This program is free software; you can redistribute it and/or
+#modify it under the terms of the GNU General Public License
+#as published by the Free Software Foundation; either version 2
+#of the License, or (at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import time
+import logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s4ah_GPIOController as S4AH
+import s4ah_Stats as S4AH_ST
+import s4ah_Waveform as S4AH_WF
+
+logging.getLogger('s4ah_root_logger').addHandler(logging.NullHandler())
+
+# the deadlines are sums of the step times: the steps are run a bit after
+# them, not to depend on the rounding
+EPSILON = 1e-9
+
+
+class ManualScheduler(S4AH_WF.WaveformScheduler):
+    """
+    a scheduler whose thread never starts: the tests call runDue with
+    the times of the steps
+    """
+    def start(self):
+        pass
+
+
+class WaveformSchedulerTest(unittest.TestCase):
+    """
+    the timing of the steps on a virtual controller, without the thread:
+    the writes of the controller are recorded
+    """
+    def setUp(self):
+        self.controller = S4AH.GPIOController('Arietta_G25', True, S4AH.BACKEND_VIRTUAL, virtualPins=4)
+        self.controller.definePinGroup('leds', ['V1', 'V2', 'V3'])
+        self.writes = []
+        pinUpdate = self.controller.pinUpdate
+        groupUpdate = self.controller.groupUpdate
+        def recordPin(pinName, value):
+            self.writes.append((pinName, value))
+            pinUpdate(pinName, value)
+        def recordGroup(groupName, value):
+            self.writes.append((groupName, value))
+            groupUpdate(groupName, value)
+        self.controller.pinUpdate = recordPin
+        self.controller.groupUpdate = recordGroup
+        self.scheduler = ManualScheduler(self.controller)
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def started(self, waveform):
+        """
+        time of the first step, written by add: deadline is the next one
+        """
+        return waveform.deadline - waveform.steps[0][1]
+
+    def runAt(self, start, offset):
+        """
+        run the scheduler offset seconds after start: return the new writes
+        and the seconds until the next step
+        """
+        writes = len(self.writes)
+        timeout = self.scheduler.runDue(start + offset + EPSILON)
+        return (self.writes[writes:], timeout)
+
+    def testSquareWave(self):
+        waveform = self.scheduler.squareWave('v0', 0.02, 25, repeat=3)
+        self.assertEqual(waveform.steps, [(1, 0.005), (0, 0.015)])
+        # the first step is written before squareWave returns
+        self.assertEqual(self.writes, [('V0', 1)])
+        self.assertEqual(self.controller.ValidPins['V0'].mode, S4AH.POUTPUT)
+        start = self.started(waveform)
+        (writes, timeout) = self.runAt(start, 0.004)
+        self.assertEqual(writes, [])
+        self.assertAlmostEqual(timeout, 0.001)
+        for (offset, value) in [(0.005, 0), (0.02, 1), (0.025, 0), (0.04, 1)]:
+            (writes, timeout) = self.runAt(start, offset)
+            self.assertEqual(writes, [('V0', value)], "step at %.3f" % offset)
+        self.assertAlmostEqual(timeout, 0.005)
+        # the last step ends the waveform: its value stays
+        self.assertEqual(self.runAt(start, 0.045), ([('V0', 0)], None))
+        self.assertNotIn('V0', self.scheduler.waveforms)
+        self.assertEqual(self.controller.ValidPins['V0'].value, 0)
+
+    def testFullDutyCycles(self):
+        self.assertEqual(self.scheduler.squareWave('V0', 0.01, 0, repeat=1).steps, [(0, 0.01)])
+        self.assertEqual(self.scheduler.squareWave('V1', 0.01, 100, repeat=1).steps, [(1, 0.01)])
+
+    def testGroupSequence(self):
+        waveform = self.scheduler.sequence('LEDS', 0.01, [1, 2, 4, 7], repeat=2)
+        start = self.started(waveform)
+        for i in xrange(1, 8):
+            self.runAt(start, 0.01 * i)
+        self.assertEqual(self.writes, [('leds', value) for value in [1, 2, 4, 7] * 2])
+        self.assertEqual(self.scheduler.waveforms, {})
+        # the last value stays on the pins
+        self.assertEqual([self.controller.ValidPins[name].value for name in ('V1', 'V2', 'V3')], [1, 1, 1])
+
+    def testStopWaveform(self):
+        start = self.started(self.scheduler.squareWave('V0', 0.01, 50))
+        self.runAt(start, 0.005)
+        self.scheduler.stopWaveform('V0')
+        self.assertNotIn('V0', self.scheduler.waveforms)
+        self.assertEqual(self.runAt(start, 1.0), ([], None))
+        self.assertEqual(self.writes, [('V0', 1), ('V0', 0)])
+        self.assertEqual(self.controller.ValidPins['V0'].mode, S4AH.POUTPUT)
+
+    def testReplacedWaveform(self):
+        old = self.scheduler.squareWave('V0', 0.01, 50)
+        new = self.scheduler.sequence('V0', 0.01, [0, 1], repeat=1)
+        self.assertFalse(old.active)
+        self.assertIs(self.scheduler.waveforms['V0'], new)
+        start = self.started(new)
+        # the step of the old waveform is due, but it is no longer active
+        self.assertEqual(self.runAt(start, 0.005)[0], [])
+        self.assertEqual(self.runAt(start, 0.01), ([('V0', 1)], None))
+        self.assertEqual(self.writes, [('V0', 1), ('V0', 0), ('V0', 1)])
+
+    def testStoppedByModeChange(self):
+        start = self.started(self.scheduler.squareWave('V0', 0.01, 50))
+        self.scheduler.sequence('leds', 0.01, [1, 2], repeat=0)
+        self.controller.setPinMode('V2', S4AH.PINPUT)
+        self.assertNotIn('leds', self.scheduler.waveforms)
+        self.assertIn('V0', self.scheduler.waveforms)
+        self.controller.setPinMode('V0', S4AH.PUNUSED)
+        self.assertEqual(self.scheduler.waveforms, {})
+        writes = len(self.writes)
+        self.assertEqual(self.runAt(start, 1.0), ([], None))
+        self.assertEqual(len(self.writes), writes)
+
+    def testRejected(self):
+        self.assertIsNone(self.scheduler.squareWave('nopin', 0.01, 50))
+        self.assertIsNone(self.scheduler.sequence('V0', S4AH_WF.MIN_STEP / 2, [0, 1]))
+        self.assertIsNone(self.scheduler.sequence('V0', 0.01, [0, 2]))
+        self.assertIsNone(self.scheduler.sequence('leds', 0.01, [8]))
+        self.assertEqual(self.writes, [])
+        self.assertEqual(self.scheduler.heap, [])
+
+
+class SchedulerThreadTest(unittest.TestCase):
+    """
+    the real thread: late steps can be skipped, so only the order of the
+    writes and the final state are checked
+    """
+    def setUp(self):
+        self.controller = S4AH.GPIOController('Arietta_G25', True, S4AH.BACKEND_VIRTUAL, virtualPins=4)
+        self.controller.definePinGroup('leds', ['V1', 'V2', 'V3'])
+        self.scheduler = S4AH_WF.WaveformScheduler(self.controller)
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def testSequenceRunsToTheEnd(self):
+        values = []
+        groupUpdate = self.controller.groupUpdate
+        def recordGroup(groupName, value):
+            values.append(value)
+            groupUpdate(groupName, value)
+        self.controller.groupUpdate = recordGroup
+        self.scheduler.sequence('leds', 0.005, [1, 2, 4, 7], repeat=2)
+        self.assertIsNotNone(self.scheduler.ident)
+        deadline = time.time() + 5.0
+        while 'leds' in self.scheduler.waveforms and time.time() < deadline:
+            time.sleep(0.005)
+        self.assertNotIn('leds', self.scheduler.waveforms)
+        # a subsequence of the steps, always with the first and the last one
+        expected = iter([1, 2, 4, 7] * 2)
+        self.assertTrue(all(value in expected for value in values), values)
+        self.assertEqual((values[0], values[-1]), (1, 7))
+        self.assertEqual([self.controller.ValidPins[name].value for name in ('V1', 'V2', 'V3')], [1, 1, 1])
+
+
+class MissedStepsTest(unittest.TestCase):
+    """
+    fire() called late, without the scheduler thread: the steps already
+    over are skipped and the phase of the waveform is kept
+    """
+    def setUp(self):
+        self.controller = S4AH.GPIOController('Arietta_G25', True, S4AH.BACKEND_VIRTUAL, virtualPins=4)
+        self.scheduler = S4AH_WF.WaveformScheduler(self.controller)
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def testPhaseKept(self):
+        waveform = S4AH_WF.Waveform('V0', False, [(1, 0.01), (0, 0.01)])
+        missed = S4AH_ST.stats.counters.get(S4AH_WF.MISSED_COUNTER, 0)
+        self.scheduler.fire(waveform, 0.025)
+        # 0-10 ms and 10-20 ms are over: the step of 20-30 ms is written
+        self.assertEqual(self.controller.ValidPins['V0'].value, 1)
+        self.assertEqual((waveform.index, waveform.cycles), (1, 1))
+        self.assertAlmostEqual(waveform.deadline, 0.03)
+        self.assertEqual(self.scheduler.heap[0][2], waveform)
+        self.assertEqual(S4AH_ST.stats.counters.get(S4AH_WF.MISSED_COUNTER, 0), missed + 2)
+
+    def testLastStepNeverSkipped(self):
+        waveform = S4AH_WF.Waveform('V0', False, [(1, 0.01), (0, 0.01)], repeat=1)
+        self.scheduler.waveforms['V0'] = waveform
+        self.scheduler.fire(waveform, 1.0)
+        self.assertEqual(self.controller.ValidPins['V0'].value, 0)
+        self.assertFalse(waveform.active)
+        self.assertEqual(self.scheduler.heap, [])
+
+
+if __name__ == '__main__':
+    unittest.main()